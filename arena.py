@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+
+# 扁平的表达式存储（arena）
+#
+# syntax.py 中的每个表达式都是一个对象，语句序列和 let rec 还各带一个列表，很大的程序会占用大量内存，
+# 遍历时也要在对象之间来回跳转。Arena 把表达式存放在几个并行的数组中，每个表达式是其中的一个下标（节点）：
+# 节点 i 的种类是 kinds[i]，a[i]、b[i]、c[i] 的含义由种类决定（见 NodeKind），starts[i] 和 ends[i] 是它在源代码中的范围。
+# 名字和字符串字面量存放在 strings 中，相同的字符串只存一次，a 中放不下的整数字面量存放在 ints 中；
+# 语句序列中的各个语句和 let rec 中的各个绑定存放在 extra 中。
+# 子表达式总是在父表达式之前创建，所以子节点的下标总是小于父节点，root 是整个程序的节点。
+# strings 同时是名字的符号表：同名的变量和绑定在 a 中是同一个整数。
+#
+# resolve 在推导之前解析作用域：每个绑定（λ 的参数、let 和 let rec 的名字）分到一个槽，
+# 变量记下它所指的绑定的槽，return 记下它所在的函数的参数的槽，都存放在 slots 中。
+# 推导时类型方案存放在按槽编号的列表里，查找变量就是按下标取值，不必为每个作用域创建环境，
+# 只有 slots 为 -1 的变量（没有绑定的名字，例如内建函数）才在 TypeEnv 中按名字查找。
+#
+# ArenaBuilder 是解析器的构造器（见 parse.py 中的 ExprBuilder），parse_arena 直接把 Token 解析成 Arena，
+# from_expr 和 Arena.to_expr 在 Arena 和 syntax.py 的表达式之间转换。
+# infer 直接在 Arena 上运行算法 J，结果和错误信息都与 pl9je 相同
+
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Callable, Generator, Iterable
+
+from ghaik import Greek
+from syntax import *
+from parse import Token, tokenize_compact, parse
+from scc import strongly_connected_components
+from diagnostic import Frame, FrameKind, TyckException
+from trampoline import trampoline
+from pl9je import (InferContext, TypeEnv, TypeScheme, Type, TypeVar, IntType, BoolType, StrType, UnitType,
+                   current_context, default_env, entry_context, fn_type, generalize, unify)
+
+
+class NodeKind(IntEnum):
+    # 整数字面量 a；超出 32 位整数范围时 b 是 1，值是 ints[a]
+    INT = 0
+    # 布尔字面量，a 是 0 或 1
+    BOOL = 1
+    # 字符串字面量 strings[a]
+    STR = 2
+    # 变量 strings[a]，slots 是它所指的绑定的槽，没有绑定时是 -1
+    VAR = 3
+    # λstrings[a]. b，slots 是参数的槽
+    ABS = 4
+    # a b
+    APP = 5
+    # let strings[a] = b in c，slots 是 strings[a] 的槽
+    LET = 6
+    # 语句序列，extra[a] 到 extra[a + b - 1] 是各个语句
+    STMT = 7
+    # return a，没有返回值时 a 是 -1；slots 是所在函数的参数的槽，不在函数中时是 -1
+    RETURN = 8
+    # if a then b else c
+    IF = 9
+    # let rec，从 extra[a] 开始的 b 对 (strings 中的名字, 表达式) 是各个绑定，c 是主体；
+    # 第 i 个绑定的槽是 slots + i
+    LETREC = 10
+
+
+# 遍历时比较的是整数常量：访问 NodeKind 的成员比访问模块中的全局变量慢得多
+KIND_INT = NodeKind.INT.value
+KIND_BOOL = NodeKind.BOOL.value
+KIND_STR = NodeKind.STR.value
+KIND_VAR = NodeKind.VAR.value
+KIND_ABS = NodeKind.ABS.value
+KIND_APP = NodeKind.APP.value
+KIND_LET = NodeKind.LET.value
+KIND_STMT = NodeKind.STMT.value
+KIND_RETURN = NodeKind.RETURN.value
+KIND_IF = NodeKind.IF.value
+KIND_LETREC = NodeKind.LETREC.value
+
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class Arena:
+    kinds: array
+    a: array
+    b: array
+    c: array
+    starts: array
+    ends: array
+    extra: array
+    strings: list[str]
+    ints: list[int]
+    string_ids: dict[str, int]
+    root: int
+    # 作用域的解析结果（见 resolve）：slots 的含义由种类决定，nslots 是槽的个数，
+    # rec_groups 是每个 let rec 的绑定按依赖关系分成的组，resolved 是解析时的根节点
+    slots: array
+    nslots: int
+    rec_groups: dict[int, list[list[int]]]
+    resolved: int
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.extra = array('i')
+        self.strings = []
+        self.ints = []
+        self.string_ids = {}
+        self.root = -1
+        self.slots = array('i')
+        self.nslots = 0
+        self.rec_groups = {}
+        self.resolved = -1
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def add(self, kind: NodeKind, a: int, b: int, c: int, start: int, end: int) -> int:
+        self.kinds.append(kind)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        self.starts.append(start)
+        self.ends.append(end)
+        return len(self.kinds) - 1
+
+    def intern_string(self, s: str) -> int:
+        id = self.string_ids.get(s)
+        if id is None:
+            id = len(self.strings)
+            self.strings.append(s)
+            self.string_ids[s] = id
+        return id
+
+
+    # 数组占用的字节数，不含 strings 和 ints 中的对象
+    def nbytes(self) -> int:
+        return sum(arr.itemsize * len(arr) for arr in (self.kinds, self.a, self.b, self.c, self.starts, self.ends, self.extra, self.slots))
+
+    def children(self, node: int) -> list[int]:
+        kind = self.kinds[node]
+        if kind == KIND_ABS:
+            return [self.b[node]]
+        elif kind == KIND_APP:
+            return [self.a[node], self.b[node]]
+        elif kind == KIND_LET:
+            return [self.b[node], self.c[node]]
+        elif kind == KIND_STMT:
+            offset = self.a[node]
+            return self.extra[offset:offset + self.b[node]].tolist()
+        elif kind == KIND_RETURN:
+            return [self.a[node]] if self.a[node] >= 0 else []
+        elif kind == KIND_IF:
+            return [self.a[node], self.b[node], self.c[node]]
+        elif kind == KIND_LETREC:
+            offset = self.a[node]
+            return self.extra[offset + 1:offset + 2 * self.b[node]:2].tolist() + [self.c[node]]
+        return []
+
+    # let rec 的各个绑定：(名字, 表达式的节点)
+    def decls(self, node: int) -> list[tuple[str, int]]:
+        offset = self.a[node]
+        extra = self.extra
+        return [(self.strings[extra[i]], extra[i + 1]) for i in range(offset, offset + 2 * self.b[node], 2)]
+
+    # 转换成 syntax.py 中的表达式。子节点的下标总是小于父节点，先标记出 node 能到达的节点，再按下标从小到大构造
+    def to_expr(self, node: int | None = None) -> Expr:
+        if node is None:
+            node = self.root
+        reachable = bytearray(node + 1)
+        reachable[node] = 1
+        low = node
+        stack = [node]
+        while len(stack) > 0:
+            for child in self.children(stack.pop()):
+                if not reachable[child]:
+                    reachable[child] = 1
+                    low = min(low, child)
+                    stack.append(child)
+
+        kinds, a, b, c, starts, ends, strings = self.kinds, self.a, self.b, self.c, self.starts, self.ends, self.strings
+        built: dict[int, Expr] = {}
+        for i in range(low, node + 1):
+            if not reachable[i]:
+                continue
+            kind = kinds[i]
+            if kind == KIND_INT:
+                e: Expr = ExprLitInt(self.ints[a[i]] if b[i] else a[i], starts[i], ends[i])
+            elif kind == KIND_BOOL:
+                e = ExprLitBool(a[i] != 0, starts[i], ends[i])
+            elif kind == KIND_STR:
+                e = ExprLitStr(strings[a[i]], starts[i], ends[i])
+            elif kind == KIND_VAR:
+                e = ExprVar(strings[a[i]], starts[i], ends[i])
+            elif kind == KIND_ABS:
+                e = ExprAbs(strings[a[i]], built[b[i]], starts[i], ends[i])
+            elif kind == KIND_APP:
+                e = ExprApp(built[a[i]], built[b[i]], starts[i], ends[i])
+            elif kind == KIND_LET:
+                e = ExprLet(strings[a[i]], built[b[i]], built[c[i]], starts[i], ends[i])
+            elif kind == KIND_STMT:
+                e = ExprStmt([built[stmt] for stmt in self.children(i)], starts[i], ends[i])
+            elif kind == KIND_RETURN:
+                e = ExprReturn(built[a[i]] if a[i] >= 0 else None, starts[i], ends[i])
+            elif kind == KIND_IF:
+                e = ExprIf(built[a[i]], built[b[i]], built[c[i]], starts[i], ends[i])
+            else:
+                e = ExprLetRec([(name, built[decl]) for (name, decl) in self.decls(i)], built[c[i]], starts[i], ends[i])
+            built[i] = e
+        return built[node]
+
+    # 解析 node 中的作用域，填写 slots、nslots 和 rec_groups。
+    # 变量所指的绑定和 pl9je 中推导到这个变量时环境里的绑定相同：let rec 的各组按推导的顺序依次绑定，
+    # 所以有同名的绑定时，结果也和 pl9je 一样
+    def resolve(self, node: int | None = None):
+        if node is None:
+            node = self.root
+        kinds, a, b, c, extra = self.kinds, self.a, self.b, self.c, self.extra
+        slots = array('i', [-1]) * len(kinds)
+        rec_groups: dict[int, list[list[int]]] = {}
+        nslots = 0
+        # bound[名字] 是这个名字的各层绑定的槽，最内层的在最后
+        bound: list[list[int]] = [[] for _ in range(len(self.strings))]
+        # 当前所在的函数的参数的槽
+        function = -1
+        # 栈中的项是节点，或者 (名字, 槽)：进入绑定的作用域，或者 (名字, -1)：离开绑定的作用域，
+        # 或者 [槽]：离开函数时恢复外层的函数
+        stack: list[Any] = [node]
+        push, pop = stack.append, stack.pop
+        while len(stack) > 0:
+            n = pop()
+            if type(n) is tuple:
+                if n[1] >= 0:
+                    bound[n[0]].append(n[1])
+                else:
+                    bound[n[0]].pop()
+                continue
+            elif type(n) is list:
+                function = n[0]
+                continue
+
+            kind = kinds[n]
+            if kind == KIND_VAR:
+                scope = bound[a[n]]
+                if len(scope) > 0:
+                    slots[n] = scope[-1]
+            elif kind == KIND_ABS:
+                slots[n] = nslots
+                bound[a[n]].append(nslots)
+                push((a[n], -1))
+                push([function])
+                push(b[n])
+                function = nslots
+                nslots += 1
+            elif kind == KIND_LET:
+                slots[n] = nslots
+                push((a[n], -1))
+                push(c[n])
+                push((a[n], nslots))
+                push(b[n])
+                nslots += 1
+            elif kind == KIND_LETREC:
+                offset, count = a[n], b[n]
+                groups = let_rec_groups(self, self.decls(n))
+                rec_groups[n] = groups
+                slots[n] = nslots
+                # 按推导的顺序：每一组先绑定组中的名字，再推导组中的绑定，最后是主体
+                items: list[Any] = []
+                for group in groups:
+                    items.extend((extra[offset + 2 * idx], nslots + idx) for idx in group)
+                    items.extend(extra[offset + 2 * idx + 1] for idx in group)
+                items.append(c[n])
+                items.extend((extra[offset + 2 * idx], -1) for group in groups for idx in group)
+                stack.extend(reversed(items))
+                nslots += count
+            elif kind == KIND_RETURN:
+                slots[n] = function
+                if a[n] >= 0:
+                    push(a[n])
+            elif kind != KIND_INT and kind != KIND_BOOL and kind != KIND_STR:
+                stack.extend(reversed(self.children(n)))
+
+        self.slots = slots
+        self.nslots = nslots
+        self.rec_groups = rec_groups
+        self.resolved = node
+
+    # 节点中的自由变量，和 syntax.free_vars 相同
+    def free_vars(self, node: int) -> set[str]:
+        free: set[str] = set()
+        bound: dict[str, int] = {}
+        kinds, a, b, c, strings = self.kinds, self.a, self.b, self.c, self.strings
+        stack: list[int | tuple[list[str], bool]] = [node]
+        while len(stack) > 0:
+            n = stack.pop()
+            if isinstance(n, tuple):
+                names, enter = n
+                for name in names:
+                    bound[name] = bound.get(name, 0) + (1 if enter else -1)
+                continue
+            kind = kinds[n]
+            if kind == KIND_VAR:
+                if bound.get(strings[a[n]], 0) == 0:
+                    free.add(strings[a[n]])
+            elif kind == KIND_APP:
+                stack.append(b[n])
+                stack.append(a[n])
+            elif kind == KIND_ABS:
+                x = [strings[a[n]]]
+                stack.append((x, False))
+                stack.append(b[n])
+                stack.append((x, True))
+            elif kind == KIND_LET:
+                x = [strings[a[n]]]
+                stack.append((x, False))
+                stack.append(c[n])
+                stack.append((x, True))
+                stack.append(b[n])
+            elif kind == KIND_LETREC:
+                decls = self.decls(n)
+                names = [name for (name, _) in decls]
+                stack.append((names, False))
+                stack.append(c[n])
+                stack.extend(reversed([decl for (_, decl) in decls]))
+                stack.append((names, True))
+            else:
+                stack.extend(reversed(self.children(n)))
+        return free
+
+
+# 解析器的构造器：在 arena 中创建节点，表达式就是节点的下标
+class ArenaBuilder:
+    arena: Arena
+    add: Callable[[int, int, int, int, int, int], int]
+    intern_string: Callable[[str], int]
+
+    def __init__(self, arena: Arena | None = None):
+        self.arena = arena if arena is not None else Arena()
+        self.add = self.arena.add
+        self.intern_string = self.arena.intern_string
+
+    def lit_int(self, value: int, start: int, end: int) -> int:
+        if INT_MIN <= value <= INT_MAX:
+            return self.add(KIND_INT, value, 0, 0, start, end)
+        self.arena.ints.append(value)
+        return self.add(KIND_INT, len(self.arena.ints) - 1, 1, 0, start, end)
+
+    def lit_bool(self, value: bool, start: int, end: int) -> int:
+        return self.add(KIND_BOOL, int(value), 0, 0, start, end)
+
+    def lit_str(self, value: str, start: int, end: int) -> int:
+        return self.add(KIND_STR, self.intern_string(value), 0, 0, start, end)
+
+    def var(self, x: str, start: int, end: int) -> int:
+        return self.add(KIND_VAR, self.intern_string(x), 0, 0, start, end)
+
+    def abs(self, x: str, body: int, start: int, end: int) -> int:
+        return self.add(KIND_ABS, self.intern_string(x), body, 0, start, end)
+
+    def app(self, e1: int, e2: int, start: int, end: int) -> int:
+        return self.add(KIND_APP, e1, e2, 0, start, end)
+
+    def let(self, x: str, e1: int, e2: int, start: int, end: int) -> int:
+        return self.add(KIND_LET, self.intern_string(x), e1, e2, start, end)
+
+    def stmt(self, stmts: list[int], start: int, end: int) -> int:
+        extra = self.arena.extra
+        offset = len(extra)
+        extra.extend(stmts)
+        return self.add(KIND_STMT, offset, len(stmts), 0, start, end)
+
+    def ret(self, e: int | None, start: int, end: int) -> int:
+        return self.add(KIND_RETURN, e if e is not None else -1, 0, 0, start, end)
+
+    def if_(self, e1: int, e2: int, e3: int, start: int, end: int) -> int:
+        return self.add(KIND_IF, e1, e2, e3, start, end)
+
+    def let_rec(self, decls: list[tuple[str, int]], body: int, start: int, end: int) -> int:
+        extra = self.arena.extra
+        offset = len(extra)
+        for (name, decl) in decls:
+            extra.append(self.intern_string(name))
+            extra.append(decl)
+        return self.add(KIND_LETREC, offset, len(decls), body, start, end)
+
+    def start(self, node: int) -> int:
+        return self.arena.starts[node]
+
+    def end(self, node: int) -> int:
+        return self.arena.ends[node]
+
+    def set_span(self, node: int, start: int, end: int):
+        self.arena.starts[node] = start
+        self.arena.ends[node] = end
+
+    def is_nothing(self, node: int) -> bool:
+        arena = self.arena
+        return arena.kinds[node] == NodeKind.VAR and arena.strings[arena.a[node]] == 'nothing'
+
+
+def parse_arena(tokens: Iterable[Token], spans: Iterable[tuple[int, int]] | None = None) -> Arena:
+    builder = ArenaBuilder()
+    builder.arena.root = parse(tokens, spans, builder)
+    return builder.arena
+
+
+# 按后序把表达式逐个加入 arena。同一个表达式对象出现在不同的作用域中时，变量所指的绑定可能不同，
+# 所以每次出现都创建新的节点，arena 中的表达式总是一棵树
+def from_expr(expr: Expr, arena: Arena | None = None) -> Arena:
+    builder = ArenaBuilder(arena)
+    # 已经加入的子表达式的节点，父表达式从末尾取出自己的子节点
+    nodes: list[int] = []
+    stack: list[tuple[Expr, bool]] = [(expr, False)]
+    while len(stack) > 0:
+        e, visited = stack.pop()
+        if not visited:
+            stack.append((e, True))
+            stack.extend((child, False) for child in reversed(children(e)))
+            continue
+
+        if isinstance(e, ExprLitInt):
+            n = builder.lit_int(e.value, e.start, e.end)
+        elif isinstance(e, ExprLitBool):
+            n = builder.lit_bool(e.value, e.start, e.end)
+        elif isinstance(e, ExprLitStr):
+            n = builder.lit_str(e.value, e.start, e.end)
+        elif isinstance(e, ExprVar):
+            n = builder.var(e.x, e.start, e.end)
+        elif isinstance(e, ExprAbs):
+            n = builder.abs(e.x, nodes.pop(), e.start, e.end)
+        elif isinstance(e, ExprApp):
+            e2 = nodes.pop()
+            n = builder.app(nodes.pop(), e2, e.start, e.end)
+        elif isinstance(e, ExprLet):
+            e2 = nodes.pop()
+            n = builder.let(e.x, nodes.pop(), e2, e.start, e.end)
+        elif isinstance(e, ExprStmt):
+            stmts = nodes[len(nodes) - len(e.stmts):]
+            del nodes[len(nodes) - len(e.stmts):]
+            n = builder.stmt(stmts, e.start, e.end)
+        elif isinstance(e, ExprReturn):
+            n = builder.ret(nodes.pop() if e.e is not None else None, e.start, e.end)
+        elif isinstance(e, ExprIf):
+            e3, e2 = nodes.pop(), nodes.pop()
+            n = builder.if_(nodes.pop(), e2, e3, e.start, e.end)
+        elif isinstance(e, ExprLetRec):
+            body = nodes.pop()
+            decls = nodes[len(nodes) - len(e.decls):]
+            del nodes[len(nodes) - len(e.decls):]
+            n = builder.let_rec([(name, decl) for ((name, _), decl) in zip(e.decls, decls)], body, e.start, e.end)
+        else:
+            raise Exception(f'未知的表达式 {e}')
+        nodes.append(n)
+    builder.arena.root = nodes.pop()
+    return builder.arena
+
+
+def children(e: Expr) -> list[Expr]:
+    if isinstance(e, ExprAbs):
+        return [e.body]
+    elif isinstance(e, ExprApp) or isinstance(e, ExprLet):
+        return [e.e1, e.e2]
+    elif isinstance(e, ExprStmt):
+        return e.stmts
+    elif isinstance(e, ExprReturn):
+        return [e.e] if e.e is not None else []
+    elif isinstance(e, ExprIf):
+        return [e.e1, e.e2, e.e3]
+    elif isinstance(e, ExprLetRec):
+        return [decl for (_, decl) in e.decls] + [e.body]
+    return []
+
+
+# 错误信息中的表达式：需要显示时才把节点转换成表达式
+@dataclass(slots=True)
+class NodeRef:
+    arena: Arena
+    node: int
+
+    @property
+    def start(self) -> int:
+        return self.arena.starts[self.node]
+
+    @property
+    def end(self) -> int:
+        return self.arena.ends[self.node]
+
+    def __str__(self) -> str:
+        return str(self.arena.to_expr(self.node))
+
+
+NodeGenerator = Generator[tuple[int], Type, Type]
+
+
+# 在 arena 上运行的算法 J，每一步和 pl9je 中的 j_step、j_node、j_bindings 一一对应。
+# arena 要先用 resolve 解析作用域：有绑定的变量的类型方案在 schemes 中按槽查找，
+# 函数的返回值类型在 return_tys 中按参数的槽查找，env 只用于没有绑定的变量
+class ArenaInference:
+    arena: Arena
+    env: TypeEnv
+    schemes: list[TypeScheme | None]
+    return_tys: list[Type | None]
+
+    def __init__(self, arena: Arena, env: TypeEnv):
+        self.arena = arena
+        self.env = env
+        self.schemes = [None] * arena.nslots
+        self.return_tys = [None] * arena.nslots
+
+    def j(self, node: int) -> Type:
+        return trampoline(self.step, node)
+
+    def step(self, node: int) -> Type | NodeGenerator:
+        arena = self.arena
+        kind = arena.kinds[node]
+        if kind == KIND_VAR:
+            slot = arena.slots[node]
+            if slot >= 0:
+                scheme = self.schemes[slot]
+            else:
+                scheme = self.env.lookup(arena.strings[arena.a[node]])
+            if scheme is not None:
+                return scheme.instantiate()
+            e = TyckException('变量或函数 {} 尚未定义', arena.strings[arena.a[node]])
+            e.add_frame(Frame(FrameKind.Expr, expr=NodeRef(arena, node)))
+            raise e
+        elif kind == KIND_INT:
+            return IntType
+        elif kind == KIND_BOOL:
+            return BoolType
+        elif kind == KIND_STR:
+            return StrType
+        return self.step_node(node, kind)
+
+    # 产生的子问题是 (子节点,)
+    def step_node(self, node: int, kind: int) -> NodeGenerator:
+        arena = self.arena
+        try:
+            if kind == KIND_ABS:
+                slot = arena.slots[node]
+                beta = TypeVar(Greek.Beta)
+                self.schemes[slot] = TypeScheme([], beta)
+                return_ty = TypeVar(Greek.Eta)
+                self.return_tys[slot] = return_ty
+                t1 = yield (arena.b[node],)
+                unify(return_ty, t1)
+                return fn_type(beta, t1)
+            elif kind == KIND_APP:
+                pi = TypeVar(Greek.Pi)
+                t1 = yield (arena.a[node],)
+                t2 = yield (arena.b[node],)
+                unify(fn_type(t2, pi), t1)
+                if pi.find() is pi:
+                    eta = TypeVar(Greek.Eta)
+                    pi.greek = Greek.Eta
+                    pi.timestamp = eta.timestamp
+                return pi
+            elif kind == KIND_LET or kind == KIND_LETREC:
+                yield from self.bindings(node)
+                return (yield (arena.c[node],))
+            elif kind == KIND_STMT:
+                offset, count = arena.a[node], arena.b[node]
+                for idx in range(offset, offset + count - 1):
+                    yield (arena.extra[idx],)
+                return (yield (arena.extra[offset + count - 1],))
+            elif kind == KIND_RETURN:
+                slot = arena.slots[node]
+                return_ty = self.return_tys[slot] if slot >= 0 else self.env.closest_return_ty()
+                if return_ty is None:
+                    raise TyckException('错误：return 只能在函数体内使用')
+                if arena.a[node] >= 0:
+                    t_ret = yield (arena.a[node],)
+                else:
+                    t_ret = UnitType
+                unify(return_ty, t_ret)
+                return TypeVar(Greek.Eta)
+            elif kind == KIND_IF:
+                t1 = yield (arena.a[node],)
+                t2 = yield (arena.b[node],)
+                t3 = yield (arena.c[node],)
+                unify(t1, BoolType)
+                unify(t2, t3)
+                return t2
+            else:
+                raise Exception(f'表达式 {arena.to_expr(node)} 的类型未知')
+        except TyckException as e:
+            e.add_frame(Frame(FrameKind.Expr, expr=NodeRef(arena, node)))
+            raise e
+
+    def bindings(self, node: int) -> Generator[tuple[int], Type, None]:
+        arena = self.arena
+        schemes = self.schemes
+        slot = arena.slots[node]
+        store = current_context().store
+        if arena.kinds[node] == KIND_LET:
+            store.enter_level()
+            try:
+                t1 = yield (arena.b[node],)
+            finally:
+                store.leave_level()
+            schemes[slot] = generalize(t1)
+            return
+
+        offset = arena.a[node]
+        for group in arena.rec_groups[node]:
+            type_vars = []
+            store.enter_level()
+            try:
+                for idx in group:
+                    tvar = TypeVar(Greek.Gamma)
+                    type_vars.append(tvar)
+                    schemes[slot + idx] = TypeScheme([], tvar)
+                for (idx, tvar) in zip(group, type_vars):
+                    actual_ty = yield (arena.extra[offset + 2 * idx + 1],)
+                    unify(tvar, actual_ty)
+            finally:
+                store.leave_level()
+            for (idx, tvar) in zip(group, type_vars):
+                schemes[slot + idx] = generalize(tvar)
+
+
+# 和 pl9je.let_rec_groups 相同
+def let_rec_groups(arena: Arena, decls: list[tuple[str, int]]) -> list[list[int]]:
+    index = {name: idx for (idx, (name, _)) in enumerate(decls)}
+    successors = []
+    for (_, decl) in decls:
+        successors.append(sorted(index[x] for x in arena.free_vars(decl) if x in index))
+    return strongly_connected_components(successors)
+
+
+def infer(arena: Arena, env: TypeEnv | None = None, node: int | None = None) -> TypeScheme:
+    if env is None:
+        env = default_env()
+    if node is None:
+        node = arena.root
+    if arena.resolved != node or len(arena.slots) != len(arena):
+        arena.resolve(node)
+    with entry_context():
+        store = current_context().store
+        store.enter_level()
+        try:
+            t = ArenaInference(arena, env).j(node)
+        finally:
+            store.leave_level()
+        return generalize(t)
+
+
+def try_inference(arena: Arena, env: TypeEnv | None = None):
+    expr = arena.to_expr()
+    try:
+        t_scheme = infer(arena, env)
+        print(f'j(Γ, {expr}) = {t_scheme}')
+    except TyckException as e:
+        print(f'j(Γ, {expr})\n错误: {e.text}')
+    print()
+
+
+if __name__ == '__main__':
+    try_inference(parse_arena(tokenize_compact('let rec f = \\x. x, g = f in g')))
+    try_inference(parse_arena(tokenize_compact(r'''
+    let rec g = f,
+        f = \x.
+            let ret = if (condint x) then
+                    (print "电灯熄灭 物换星移 移牛入海");
+                    (return 42)
+                else
+                    (print "独脚大盗 百万富翁 摸爬滚打");
+                    x
+                in
+                    (print "黑暗好像 一颗巨石 按在胸口");
+            ret
+        in g
+    ''')))
+    try_inference(parse_arena(tokenize_compact('let id = \\x. x in (id id) (id id)')))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# 批量类型检查：检查一个目录中的所有文件，或者 JSONL 文件中的每个程序，结果以 JSONL 的形式输出。
+#
+# JSONL 输入的每一行是 {"id": ..., "source": "..."}，没有 id 时使用行号；目录输入以相对路径作为 id。
+# 每个程序输出一行：通过检查时是 {"id": ..., "ok": true, "type": "..."}，
+# 否则是 {"id": ..., "ok": false, "error": "..."}，类型错误还附带出错位置：span 和 column 按字符计，
+# byte_span 是同一范围的 UTF-8 字节偏移，line 和 column 从 1 开始。
+# 检查器不支持程序使用的语法时（算法 W 只支持 λ 演算和 let，不支持 if、字符串、语句序列、return 和 let rec），
+# 输出 {"id": ..., "ok": false, "unsupported": true, "error": "..."}，同样附带位置，不算作类型错误。
+#
+# 程序分批交给 ProcessPoolExecutor 中的工作进程。每个工作进程只在启动时构造一次环境，
+# 每个程序在新的推导上下文（InferContext）中检查，所以结果与程序被分到哪个进程、之前检查过什么无关
+
+import argparse
+import importlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Iterable, Iterator
+
+from diagnostic import TyckException, UnsupportedSyntax, byte_offset, line_starts, locate
+from parse import tokenize_compact, parse
+
+# (id, 源代码)
+Program = tuple[Any, str]
+
+CHECKERS = {
+    'j': 'pl9je',
+    'w': 'pl9',
+    'c': 'constraints',
+}
+
+# 工作进程中的类型检查器（CHECKERS 中的模块）、环境和结果缓存，由 init_worker 设置
+checker: ModuleType | None = None
+worker_env: Any = None
+worker_cache: Any = None
+
+
+def init_worker(algorithm: str, cache_dir: Path | None = None):
+    global checker, worker_env, worker_cache
+    checker = importlib.import_module(CHECKERS[algorithm])
+    worker_env = checker.default_env()
+    worker_cache = None
+    if cache_dir is not None:
+        from cache import TypeCache
+        worker_cache = TypeCache(cache_dir, worker_env)
+
+
+def check_program(program: Program) -> dict[str, Any]:
+    assert checker is not None
+    id, source = program
+    if worker_cache is not None:
+        return check_cached(id, source)
+    try:
+        with checker.InferContext():
+            scheme = checker.infer(parse(tokenize_compact(source)), worker_env)
+            return {'id': id, 'ok': True, 'type': str(scheme)}
+    except TyckException as e:
+        e.source = source
+        return with_location({'id': id, 'ok': False, 'error': e.text}, source, e.span)
+    except UnsupportedSyntax as e:
+        return with_location({'id': id, 'ok': False, 'unsupported': True, 'error': str(e)}, source, e.span)
+    except Exception as e:
+        return {'id': id, 'ok': False, 'error': str(e)}
+
+
+def check_cached(id: Any, source: str) -> dict[str, Any]:
+    try:
+        result = worker_cache.check(source)
+    except Exception as e:
+        return {'id': id, 'ok': False, 'error': str(e)}
+    if result.ok:
+        return {'id': id, 'ok': True, 'type': str(result.scheme)}
+    return with_location({'id': id, 'ok': False, 'error': result.error}, source, result.span)
+
+
+# 结果中附带出错的位置
+def with_location(ret: dict[str, Any], source: str, span: tuple[int, int] | None) -> dict[str, Any]:
+    if span is not None:
+        line, column = locate(line_starts(source), span[0])
+        ret.update(span=list(span), byte_span=[byte_offset(source, span[0]), byte_offset(source, span[1])],
+                   line=line, column=column)
+    return ret
+
+
+def read_programs(path: Path, pattern: str = '*') -> Iterator[Program]:
+    if path.is_dir():
+        for file in sorted(path.rglob(pattern)):
+            if file.is_file():
+                yield file.relative_to(path).as_posix(), file.read_text(encoding='utf-8')
+        return
+
+    with open(path, encoding='utf-8') as f:
+        for (lineno, line) in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+            item = json.loads(line)
+            yield item.get('id', lineno), item['source']
+
+
+# 按输入的顺序返回每个程序的检查结果。jobs 为 1 时在当前进程中检查，不启动工作进程
+def check_batch(programs: Iterable[Program],
+                algorithm: str = 'j',
+                jobs: int | None = None,
+                chunksize: int | None = None,
+                cache_dir: Path | None = None) -> Iterator[dict[str, Any]]:
+    programs = list(programs)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if jobs == 1:
+        init_worker(algorithm, cache_dir)
+        yield from map(check_program, programs)
+        return
+
+    # 程序通常很小，一次交给工作进程一批，减少进程间通信的次数；但每个进程至少分到几批，以便负载均衡
+    if chunksize is None:
+        chunksize = max(1, min(64, len(programs) // (jobs * 4)))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(algorithm, cache_dir)) as executor:
+        yield from executor.map(check_program, programs, chunksize=chunksize)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='批量类型检查')
+    parser.add_argument('input', type=Path, help='包含程序的目录，或者每行一个程序的 JSONL 文件')
+    parser.add_argument('-o', '--output', type=Path, help='输出的 JSONL 文件，默认输出到标准输出')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='工作进程数，默认为 CPU 核数')
+    parser.add_argument('-a', '--algorithm', choices=sorted(CHECKERS), default='j', help='使用算法 J（pl9je）、算法 W（pl9，只支持 λ 演算和 let），或者先生成约束再求解（constraints）')
+    parser.add_argument('--glob', default='*', help='输入为目录时，只检查文件名匹配的文件')
+    parser.add_argument('--chunksize', type=int, default=None, help='每次交给工作进程的程序数')
+    parser.add_argument('--cache', type=Path, default=None, help='类型检查结果的缓存目录，源代码没有变化的程序直接使用缓存的结果（只支持算法 J）')
+    args = parser.parse_args(argv)
+    if args.cache is not None and args.algorithm != 'j':
+        parser.error('--cache 只支持算法 J')
+
+    programs = read_programs(args.input, args.glob)
+    out = open(args.output, 'w', encoding='utf-8') if args.output is not None else sys.stdout
+    failed = 0
+    try:
+        for result in check_batch(programs, args.algorithm, args.jobs, args.chunksize, args.cache):
+            if not result['ok']:
+                failed += 1
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    # 有程序没有通过检查时返回非零值，便于在 CI 中使用
+    return 1 if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+
+# 性能测试：用程序生成的大规模输入测量各个阶段的耗时
+
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+import pl9
+import pl9je
+import arena
+import printer
+import constraints
+from incremental import IncrementalChecker
+from parse import TOKEN_REGEX, KEYWORDS, PUNCTUATIONS, Token, TokenKind, lex_error, make_token, tokenize, tokenize_compact, parse
+from syntax import Expr, ExprLitInt, ExprLitBool, ExprLitStr, ExprVar, ExprAbs, ExprApp, ExprLet, ExprStmt, ExprReturn, ExprIf, ExprLetRec, free_vars
+
+
+# f x0 x1 x2 ... xn
+def gen_app_spine(n: int) -> str:
+    return 'f ' + ' '.join(f'x{i}' for i in range(n))
+
+
+# f x0 y0; f x1 y1; ...; f xn yn
+def gen_stmts(n: int) -> str:
+    return '; '.join(f'f x{i} y{i}' for i in range(n))
+
+
+# let x0 = 1 in let x1 = square x0 in ... let xn = square x(n-1) in xn
+def gen_let_chain(n: int) -> str:
+    return 'let x0 = 1 in ' + ' '.join(f'let x{i + 1} = square x{i} in' for i in range(n)) + f' x{n}'
+
+
+# 重复 n 次一段接近真实代码的程序，用于测量词法分析的吞吐量
+def gen_program(n: int) -> str:
+    block = r'''
+let rec g = f,
+    f = \x.
+        let ret = if (condint x) then
+                (print "电灯熄灭 物换星移 移牛入海");
+                (return 42)
+            else
+                (print "独脚大盗 百万富翁 摸爬滚打");
+                x
+            in
+                (print "黑暗好像 一颗巨石 按在胸口");
+        ret
+    in g
+'''
+    return ';'.join([block] * n)
+
+
+# 和 timeit 一样，计时期间关闭循环垃圾回收，避免大量存活对象造成的 GC 开销干扰结果。
+# setup 在每次计时之前运行，不计入耗时
+# 返回 repeat 次中最短的耗时（秒）
+def measure(fn: Callable[[], object], repeat: int = 3, setup: Callable[[], object] | None = None) -> float:
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    assert best is not None
+    return best
+
+
+def bench(name: str, fn: Callable[[], object], repeat: int = 3, setup: Callable[[], object] | None = None):
+    print(f'{name:<32} {measure(fn, repeat, setup) * 1000:10.2f} ms')
+
+
+# 返回 fn 执行期间（峰值）和执行之后（保留）分配的内存，单位为字节
+def measure_memory(fn: Callable[[], object]) -> tuple[int, int]:
+    tracemalloc.start()
+    try:
+        ret = fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del ret
+    return peak, current
+
+
+# 峰值是执行期间最多占用的内存，保留是结果本身占用的内存
+def bench_memory(name: str, fn: Callable[[], object]):
+    peak, current = measure_memory(fn)
+    print(f'{name:<32} {peak / 1024 / 1024:10.2f} MiB peak {current / 1024 / 1024:10.2f} MiB retained')
+
+
+# 新的词法分析与旧的逐字符分析的耗时之比，tokenize 应当至少快 5 倍
+def bench_tokenize():
+    for n in [1000, 10000]:
+        input = gen_program(n)
+        mb = len(input.encode()) / 1024 / 1024
+        old = measure(lambda: old_tokenize(input))
+        print(f'{f"old tokenize program ({mb:.1f} MiB)":<32} {old * 1000:10.2f} ms')
+        for (name, fn) in [('tokenize', tokenize), ('tokenize_compact', tokenize_compact), ('tokenize_objects', tokenize_objects)]:
+            elapsed = measure(lambda: fn(input))
+            print(f'{f"{name} program ({mb:.1f} MiB)":<32} {elapsed * 1000:10.2f} ms {old / elapsed:8.1f}x')
+
+
+# 作为对照的旧词法分析：逐个字符判断，每个 Token 都是一个新的对象
+def old_tokenize(input: str) -> list[Token]:
+    ret = []
+
+    index = 0
+    while index < len(input):
+        index = old_skip_whitespace(index, input)
+        if index == len(input):
+            break
+        ch = input[index]
+        if ch.isdigit():
+            start = index
+            while index < len(input) and input[index].isdigit():
+                index += 1
+            ret.append(Token(TokenKind.Int, int(input[start:index])))
+        elif ch == '"':
+            index += 1
+            start = index
+            while index < len(input) and input[index] != '"':
+                index += 1
+            ret.append(Token(TokenKind.String, input[start:index]))
+            index += 1
+        elif ch.isalpha():
+            index, token = old_tokenize_ident_or_keyword(index, input)
+            ret.append(token)
+        elif ch == '\\':
+            ret.append(Token(TokenKind.Backslash))
+            index += 1
+        elif ch == '.':
+            ret.append(Token(TokenKind.Dot))
+            index += 1
+        elif ch == ',':
+            ret.append(Token(TokenKind.Comma))
+            index += 1
+        elif ch == ';':
+            ret.append(Token(TokenKind.Semicolon))
+            index += 1
+        elif ch == '(':
+            ret.append(Token(TokenKind.LParen))
+            index += 1
+        elif ch == ')':
+            ret.append(Token(TokenKind.RParen))
+            index += 1
+        elif ch == '=':
+            ret.append(Token(TokenKind.Eq))
+            index += 1
+        else:
+            raise Exception(f'未知字符：{ch}')
+    ret.append(Token(TokenKind.EOI))
+    return ret
+
+
+def old_skip_whitespace(index: int, input: str) -> int:
+    while index < len(input) and input[index].isspace():
+        index += 1
+    return index
+
+
+def old_tokenize_ident_or_keyword(index: int, input: str) -> tuple[int, Token]:
+    start = index
+    while index < len(input) and input[index].isalnum():
+        index += 1
+    ident = input[start:index]
+    if ident == 'true' or ident == 'false':
+        return index, Token(TokenKind.Boolean, ident == 'true')
+    elif ident == 'let':
+        return index, Token(TokenKind.Let)
+    elif ident == 'rec':
+        return index, Token(TokenKind.Rec)
+    elif ident == 'in':
+        return index, Token(TokenKind.In)
+    elif ident == 'if':
+        return index, Token(TokenKind.If)
+    elif ident == 'then':
+        return index, Token(TokenKind.Then)
+    elif ident == 'else':
+        return index, Token(TokenKind.Else)
+    elif ident == 'return':
+        return index, Token(TokenKind.Return)
+    else:
+        return index, Token(TokenKind.Ident, ident)
+
+
+# 作为对照的常规做法：每个 Token 是一个对象，带有自己的种类、值和在输入中的范围
+@dataclass(slots=True)
+class TokenObject:
+    kind: TokenKind
+    data: int | bool | str | None
+    start: int
+    end: int
+
+
+def tokenize_objects(input: str) -> list[TokenObject]:
+    ret: list[TokenObject] = []
+    for match in TOKEN_REGEX.finditer(input):
+        text = match.group(1)
+        token = KEYWORDS.get(text) or PUNCTUATIONS.get(text) or make_token(text)
+        if token is None:
+            raise lex_error(input, text)
+        ret.append(TokenObject(token.kind, token.data, match.start(1), match.end(1)))
+    ret.append(TokenObject(TokenKind.EOI, None, len(input), len(input)))
+    return ret
+
+
+def bench_token_memory():
+    input = gen_program(10000)
+    n = len(tokenize_compact(input))
+    bench_memory(f'list[TokenObject] ({n} tokens)', lambda: tokenize_objects(input))
+    bench_memory(f'TokenStore ({n} tokens)', lambda: tokenize_compact(input))
+
+
+# 作为对照的旧解析器：递归下降，每次都尝试继续解析函数应用，失败时抛出异常回溯。
+# 应用按右结合构造，嵌套深度与输入的长度成正比，输入很长时会超出递归深度的限制
+def old_parse(tokens: Any) -> Expr:
+    return old_parse_expr(tokens, 0)[0]
+
+
+def old_parse_expr(tokens: Any, index: int) -> tuple[Expr, int]:
+    e1, index = old_parse_simple_expr(tokens, index)
+    if tokens[index].kind == TokenKind.Semicolon:
+        e2, index = old_parse_expr(tokens, index + 1)
+        if isinstance(e2, ExprStmt):
+            return ExprStmt([e1] + e2.stmts), index
+        else:
+            return ExprStmt([e1, e2]), index
+    else:
+        try:
+            e2, index = old_parse_expr(tokens, index)
+            return ExprApp(e1, e2), index
+        except Exception:
+            return e1, index
+
+
+def old_parse_simple_expr(tokens: Any, index: int) -> tuple[Expr, int]:
+    cur = tokens[index]
+    if cur.kind == TokenKind.EOI:
+        raise Exception('解析到末尾')
+
+    if cur.kind == TokenKind.Int:
+        return ExprLitInt(cur.data), index + 1
+    elif cur.kind == TokenKind.Boolean:
+        return ExprLitBool(cur.data), index + 1
+    elif cur.kind == TokenKind.String:
+        return ExprLitStr(cur.data), index + 1
+    elif cur.kind == TokenKind.Ident:
+        return ExprVar(cur.data), index + 1
+    elif cur.kind == TokenKind.Backslash:
+        assert tokens[index + 1].kind == TokenKind.Ident
+        var_name = tokens[index + 1].data
+        assert tokens[index + 2].kind == TokenKind.Dot
+        e1, index = old_parse_expr(tokens, index + 3)
+        return ExprAbs(var_name, e1), index
+    elif cur.kind == TokenKind.LParen:
+        e1, index = old_parse_expr(tokens, index + 1)
+        assert tokens[index].kind == TokenKind.RParen
+        return e1, index + 1
+    elif cur.kind == TokenKind.Let:
+        if tokens[index + 1].kind == TokenKind.Rec:
+            return old_parse_let_rec(tokens, index + 2)
+        else:
+            return old_parse_let(tokens, index + 1)
+    elif cur.kind == TokenKind.If:
+        return old_parse_if(tokens, index + 1)
+    elif cur.kind == TokenKind.Return:
+        e1, index = old_parse_expr(tokens, index + 1)
+        if isinstance(e1, ExprVar) and e1.x == 'nothing':
+            return ExprReturn(None), index
+        else:
+            return ExprReturn(e1), index
+    else:
+        raise Exception(f'未知 Token: {cur}')
+
+
+def old_parse_let_rec(tokens: Any, index: int) -> tuple[Expr, int]:
+    bindings: list[tuple[str, Expr]] = []
+    while tokens[index].kind == TokenKind.Ident:
+        var_name = tokens[index].data
+        assert tokens[index + 1].kind == TokenKind.Eq
+        e1, index = old_parse_expr(tokens, index + 2)
+        bindings.append((var_name, e1))
+        if tokens[index].kind == TokenKind.Comma:
+            index += 1
+        else:
+            break
+    assert tokens[index].kind == TokenKind.In
+    e, index = old_parse_expr(tokens, index + 1)
+    return ExprLetRec(bindings, e), index
+
+
+def old_parse_let(tokens: Any, index: int) -> tuple[Expr, int]:
+    assert tokens[index].kind == TokenKind.Ident
+    var_name = tokens[index].data
+    assert tokens[index + 1].kind == TokenKind.Eq
+    e1, index = old_parse_expr(tokens, index + 2)
+    assert tokens[index].kind == TokenKind.In
+    e2, index = old_parse_expr(tokens, index + 1)
+    return ExprLet(var_name, e1, e2), index
+
+
+def old_parse_if(tokens: Any, index: int) -> tuple[Expr, int]:
+    e1, index = old_parse_expr(tokens, index)
+    assert tokens[index].kind == TokenKind.Then
+    e2, index = old_parse_expr(tokens, index + 1)
+    assert tokens[index].kind == TokenKind.Else
+    e3, index = old_parse_expr(tokens, index + 1)
+    return ExprIf(e1, e2, e3), index
+
+
+# 新旧解析器在同样的输入上的耗时。旧解析器的递归深度与输入的长度成正比，
+# 为它临时放宽递归深度的限制，仍然超出时只报告失败
+def bench_parse():
+    for (name, gen) in [('app-spine', gen_app_spine), ('stmts', gen_stmts)]:
+        for n in [1000, 10000, 100000]:
+            tokens = tokenize(gen(n))
+            bench(f'parse {name} ({len(tokens)} tokens)', lambda: parse(tokens))
+            store = tokenize_compact(gen(n))
+            bench(f'parse {name} from TokenStore', lambda: parse(store))
+            limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(max(limit, 4 * len(tokens) + 1000))
+            try:
+                bench(f'old parse {name} ({len(tokens)} tokens)', lambda: old_parse(tokens))
+            except RecursionError:
+                print(f'{f"old parse {name} ({len(tokens)} tokens)":<32} 超出递归深度')
+            finally:
+                sys.setrecursionlimit(limit)
+
+
+# \x0. (\x1. ... (\xn. xn) (\f. f x(n-1) x(n-1)) ...) (\f. f x0 x0)
+# x(i+1) 的类型中两次引用 xi 的类型，类型作为树的大小随 n 指数增长，但作为共享子树的图只有线性大小
+def gen_shared_types(n: int) -> str:
+    src = f'x{n}'
+    for i in range(n - 1, -1, -1):
+        src = f'(\\x{i + 1}. {src}) (\\f. f x{i} x{i})'
+    return '\\x0. ' + src
+
+
+# 签名很多、很长的环境：n 个内建函数，每个的类型都是 int→int→...→int（arity 个参数）。
+# 程序依次把每个内建函数应用到 arity 个整数上
+def gen_signature_program(n: int, arity: int) -> str:
+    args = ' '.join(['1'] * arity)
+    return '; '.join(f'(f{i} {args})' for i in range(n))
+
+
+def signature_env(n: int, arity: int):
+    env = pl9je.default_env()
+    for i in range(n):
+        t = pl9je.IntType
+        for _ in range(arity):
+            t = pl9je.fn_type(pl9je.IntType, t)
+        env.bind(f'f{i}', pl9je.TypeScheme([], t))
+    return env
+
+
+def bench_signatures():
+    n, arity = 2000, 20
+    bench_memory(f'pl9je env ({n} signatures)', lambda: signature_env(n, arity))
+    env = signature_env(n, arity)
+    expr = parse(tokenize(gen_signature_program(n, arity)))
+    bench(f'pl9je j ({n} signatures)', lambda: pl9je.j(env, expr))
+
+
+def bench_occurs():
+    for n in [20, 200]:
+        expr = parse(tokenize(gen_shared_types(n)))
+        bench(f'pl9 w shared types (n={n})', lambda: pl9.w(pl9.TypeEnv(), expr))
+        bench(f'pl9je j shared types (n={n})', lambda: pl9je.j(pl9je.default_env(), expr))
+
+        def deferred():
+            with pl9je.InferContext(defer_occurs_check=True):
+                pl9je.generalize(pl9je.j(pl9je.default_env(), expr))
+        bench(f'pl9je j deferred occurs (n={n})', deferred)
+
+
+# let t = (gen_shared_types(k)) in t 0; t 1; ...; t (n-1)
+# t 的类型方案作为图只有线性大小，每次实例化都应该保持其中的共享，而不是复制出指数大小的树
+def gen_poly_uses(k: int, n: int) -> str:
+    return f'let t = {gen_shared_types(k)} in ' + '; '.join(f't {i}' for i in range(n))
+
+
+def bench_instantiate():
+    k, n = 10, 200
+    expr = parse(tokenize(gen_poly_uses(k, n)))
+    bench_memory(f'pl9je instantiate (k={k}, n={n})', lambda: pl9je.infer(expr))
+    bench(f'pl9je instantiate (k={k}, n={n})', lambda: pl9je.infer(expr))
+
+
+# 在很深的 let 链的最内层出现类型错误：只关心是否通过检查时，不应该为错误信息付出代价
+def bench_type_error():
+    for n in [100, 1000]:
+        expr = parse(tokenize(gen_let_chain(n).removesuffix(f'x{n}') + '(square true)'))
+
+        def run():
+            try:
+                pl9je.j(pl9je.default_env(), expr)
+            except pl9je.TyckException:
+                pass
+        bench(f'pl9je j type error ({n} lets)', run)
+
+
+def bench_w():
+    for n in [100, 400, 1600]:
+        expr = parse(tokenize(gen_let_chain(n)))
+        bench(f'pl9 w let-chain ({n} lets)', lambda: pl9.w(pl9.default_env(), expr))
+
+
+# \x0. \x1. ... \xn. x0
+def gen_lambda_nest(n: int) -> str:
+    return ' '.join(f'\\x{i}.' for i in range(n)) + ' x0'
+
+
+# 嵌套很深的输入：推导使用显式的栈，耗时应当与嵌套深度成线性关系
+def bench_deep():
+    for n in [10000, 100000]:
+        expr = parse(tokenize(gen_let_chain(n)))
+        bench(f'pl9je j let-chain ({n} lets)', lambda: pl9je.j(pl9je.default_env(), expr), repeat=1)
+        bench(f'pl9 w let-chain ({n} lets)', lambda: pl9.w(pl9.default_env(), expr), repeat=1)
+
+        expr = parse(tokenize(gen_lambda_nest(n)))
+        bench(f'pl9je j lambdas ({n} levels)', lambda: pl9je.generalize(pl9je.j(pl9je.default_env(), expr)), repeat=1)
+
+
+# let f0 = \x. square x in let f1 = \x. f0 (square x) in ... in fn，其中第 edit 个绑定的函数体替换为 body
+def gen_bindings(n: int, edit: int = -1, body: str = '') -> str:
+    lines = ['let f0 = \\x. square x in']
+    for i in range(1, n):
+        lines.append(f'let f{i} = \\x. {body if i == edit else f"f{i - 1} (square x)"} in')
+    lines.append(f'f{n - 1}')
+    return '\n'.join(lines)
+
+
+# 修改文件中间的一个绑定之后重新检查：完整检查与增量检查（不含词法分析和解析）
+def bench_incremental():
+    n = 10000
+    src = gen_bindings(n)
+    edited = gen_bindings(n, n // 2, f'f{n // 2 - 1} (square (square x))')
+    expr = parse(tokenize_compact(src))
+    edited_expr = parse(tokenize_compact(edited))
+
+    def full():
+        with pl9je.InferContext():
+            pl9je.infer(edited_expr)
+    bench(f'pl9je full check ({n} bindings)', full)
+
+    checker = IncrementalChecker()
+    bench(f'pl9je incremental ({n} bindings)', lambda: checker.check(edited_expr, edited),
+          setup=lambda: checker.check(expr, src))
+
+
+# let rec idr = \x. x, a0 = ..., b0 = ..., a1 = ... in a(n-1)：每对 ai 和 bi 相互递归，并且调用前一对中的函数。
+# idr 分别用于 bool 和 int，只有把 let rec 按强连通分量拆分之后 idr 才是多态的，程序才能通过检查
+def gen_rec_module(n: int) -> str:
+    decls = ['idr = \\x. x',
+             'a0 = \\x. if (idr (condint x)) then x else b0 (square x)',
+             'b0 = \\x. a0 (idr x)']
+    for i in range(1, n):
+        decls.append(f'a{i} = \\x. if (idr (condint x)) then a{i - 1} x else b{i} (square x)')
+        decls.append(f'b{i} = \\x. a{i} (b{i - 1} (idr x))')
+    return 'let rec ' + ',\n'.join(decls) + f' in a{n - 1}'
+
+
+def bench_let_rec():
+    for n in [500, 2000]:
+        expr = parse(tokenize(gen_rec_module(n)))
+
+        def run():
+            with pl9je.InferContext():
+                pl9je.infer(expr)
+        bench(f'pl9je let rec ({2 * n + 1} decls)', run)
+
+
+# 约束生成和求解分开计时，与算法 J 对比
+def bench_constraints():
+    n = 10000
+    expr = parse(tokenize(gen_let_chain(n)))
+    cs = constraints.generate(expr)
+    env = pl9je.default_env()
+
+    def solve():
+        with pl9je.InferContext():
+            constraints.solve(cs, env)
+
+    def j():
+        with pl9je.InferContext():
+            pl9je.j(env, expr)
+    bench(f'generate let chain (n={n})', lambda: constraints.generate(expr))
+    bench(f'solve let chain (n={n})', solve)
+    bench(f'pl9je j let chain (n={n})', j)
+
+
+def bench_arena():
+    n = 100000
+    store = tokenize_compact(gen_square_stmts(n))
+    expr = parse(store)
+    ast = arena.parse_arena(store)
+    env = pl9je.default_env()
+    bench_memory(f'Expr stmts ({len(ast)} nodes)', lambda: parse(store))
+    bench_memory(f'Arena stmts ({len(ast)} nodes)', lambda: arena.parse_arena(store))
+    bench(f'parse stmts (n={n})', lambda: parse(store))
+    bench(f'parse_arena stmts (n={n})', lambda: arena.parse_arena(store))
+
+    def j():
+        with pl9je.InferContext():
+            pl9je.infer(expr, env)
+
+    def j_arena():
+        with pl9je.InferContext():
+            arena.infer(ast, env)
+    bench(f'pl9je infer stmts (n={n})', j)
+    bench(f'arena infer stmts (n={n})', j_arena)
+
+    # 绑定很多的程序：arena 上的推导按槽查找变量，不再为每个作用域创建环境
+    for (name, gen, m) in [('let chain', gen_let_chain, 20000), ('lambda nest', gen_lambda_nest, 20000)]:
+        nested_store = tokenize_compact(gen(m))
+        nested_expr = parse(nested_store)
+        nested_ast = arena.parse_arena(nested_store)
+
+        def j_nested():
+            with pl9je.InferContext():
+                pl9je.infer(nested_expr, env)
+
+        def j_nested_arena():
+            with pl9je.InferContext():
+                arena.infer(nested_ast, env)
+        bench(f'pl9je infer {name} (n={m})', j_nested)
+        bench(f'arena infer {name} (n={m})', j_nested_arena)
+        bench(f'resolve {name} (n={m})', nested_ast.resolve)
+    bench(f'free_vars Expr (n={n})', lambda: free_vars(expr))
+    bench(f'free_vars Arena (n={n})', lambda: ast.free_vars(ast.root))
+
+
+# 打印很大的程序和很深的类型
+def bench_print():
+    for (name, gen, n) in [('stmts', gen_square_stmts, 100000), ('let chain', gen_let_chain, 100000)]:
+        expr = parse(tokenize_compact(gen(n)))
+        bench(f'str {name} (n={n})', lambda: str(expr))
+        bench(f'to_string {name} (width=80)', lambda: printer.to_string(expr, 80))
+    # 换行时一串应用和一串 λ 各是一组，输出的长度和耗时都应当与 n 成线性关系
+    for (name, gen, n) in [('app spine', gen_app_spine, 200000), ('lambda nest', gen_lambda_nest, 100000)]:
+        expr = parse(tokenize_compact(gen(n)))
+        bench(f'to_string {name} (width=80)', lambda: printer.to_string(expr, 80))
+        bench_memory(f'to_string {name} (width=80)', lambda: printer.to_string(expr, 80))
+    with pl9je.InferContext():
+        n = 11
+        ty: pl9je.Type = pl9je.IntType
+        for _ in range(n):
+            ty = pl9je.fn_type(pl9je.product_type(ty, ty), ty)
+        bench(f'str shared type (n={n})', lambda: str(ty))
+
+
+# let id = \x. x in id id ... id 1：很长的应用链，每个 id 都要实例化一次
+def gen_id_spine(n: int) -> str:
+    return 'let id = \\x. x in id ' + ' '.join(['id'] * n) + ' 1'
+
+
+# square 0; square 1; ...; square (n-1)
+def gen_square_stmts(n: int) -> str:
+    return '; '.join(f'square {i}' for i in range(n))
+
+
+# let rec f0 = \x. f1 (square x), f1 = \x. f2 (square x), ..., f(n-1) = \x. f0 (square x) in f0：
+# 所有绑定构成一个强连通分量，必须在同一个单态的作用域中推导
+def gen_rec_group(n: int) -> str:
+    return 'let rec ' + ',\n'.join(f'f{i} = \\x. f{(i + 1) % n} (square x)' for i in range(n)) + ' in f0'
+
+
+# let x0 = 1 in let x1 = \f. f x0 x0 in ... in xn：xi 被泛化之后每次使用都实例化出一份新的副本，
+# 类型的大小随 n 指数增长，这是 Hindley-Milner 最坏情况的经典例子（通常写作 let x1 = (x0, x0) in ...）
+def gen_exp_pairs(n: int) -> str:
+    return 'let x0 = 1 in ' + ' '.join(f'let x{i + 1} = \\f. f x{i} x{i} in' for i in range(n)) + f' x{n}'
+
+
+# 深度为 n 的完全二叉的 if 树，共 2^n 个叶子
+def gen_if_tree(n: int) -> str:
+    parts: list[str] = []
+    stack: list[tuple[int, int] | str] = [(n, 1)]
+    while len(stack) > 0:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        depth, i = item
+        if depth == 0:
+            parts.append(f'square {i}')
+            continue
+        parts.append(f'if (condint {i}) then (')
+        stack.extend([')', (depth - 1, 2 * i + 1), ') else (', (depth - 1, 2 * i)])
+    return ''.join(parts)
+
+
+# 基准测试套件：每个用例是一个程序生成器和若干规模，分别测量 tokenize、parse、pl9 的 w 和 pl9je 的 j 的耗时，
+# 以及每个阶段分配内存的峰值（用 tracemalloc 单独运行一次测得）。
+# 结果可以保存为基线（JSON），之后的运行与基线比较，耗时或内存超出基线一定比例的项目标为回退。
+# 基线与机器有关，换了机器之后应当先在原来的版本上重新生成基线
+@dataclass
+class Case:
+    name: str
+    gen: Callable[[int], str]
+    sizes: list[int]
+    # pl9 只支持 lambda、函数调用和 let
+    w: bool = True
+
+
+CASES = [
+    Case('let-chain', gen_let_chain, [1000, 10000]),
+    Case('app-spine', gen_id_spine, [1000, 10000]),
+    Case('stmts', gen_square_stmts, [1000, 10000], w=False),
+    Case('let-rec-group', gen_rec_group, [100, 1000], w=False),
+    Case('exp-pairs', gen_exp_pairs, [6, 9]),
+    Case('if-tree', gen_if_tree, [8, 12], w=False),
+]
+
+# 每一项的结果：{'ms': 耗时, 'peak_mib': 分配内存的峰值}
+Results = dict[str, dict[str, float]]
+
+
+def run_suite(pattern: str = '', repeat: int = 3) -> Results:
+    results: Results = {}
+    for case in CASES:
+        for n in case.sizes:
+            prefix = f'{case.name}/{n}'
+            if pattern not in prefix:
+                continue
+            source = case.gen(n)
+            tokens = tokenize(source)
+            expr = parse(tokens)
+
+            def j():
+                with pl9je.InferContext():
+                    pl9je.infer(expr)
+
+            def w():
+                with pl9.InferContext():
+                    pl9.infer(expr)
+
+            phases: list[tuple[str, Callable[[], object]]] = [
+                ('tokenize', lambda: tokenize(source)),
+                ('parse', lambda: parse(tokens)),
+                ('j', j),
+            ]
+            if case.w:
+                phases.append(('w', w))
+            for (phase, fn) in phases:
+                name = f'{prefix}/{phase}'
+                elapsed = measure(fn, repeat)
+                peak, _ = measure_memory(fn)
+                results[name] = {'ms': round(elapsed * 1000, 3), 'peak_mib': round(peak / 1024 / 1024, 3)}
+                print(f'{name:<32} {elapsed * 1000:10.2f} ms {peak / 1024 / 1024:10.2f} MiB', flush=True)
+    return results
+
+
+# 与基线比较，返回回退的项目数。只在两者之差超过噪声的下限时才认为是回退
+def compare(results: Results, baseline: Results, tolerance: float) -> int:
+    regressions = 0
+    print()
+    print(f'{"":<32} {"基线":>10} {"本次":>10} {"变化":>8}')
+    for (name, now) in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for (metric, unit, floor) in [('ms', 'ms', 1.0), ('peak_mib', 'MiB', 0.1)]:
+            change = now[metric] / base[metric] - 1 if base[metric] > 0 else 0.0
+            regressed = change > tolerance and now[metric] - base[metric] > floor
+            if regressed:
+                regressions += 1
+            mark = '  回退' if regressed else ''
+            print(f'{name:<32} {base[metric]:10.2f} {now[metric]:10.2f} {change:+8.1%} {unit}{mark}')
+    print()
+    print(f'{regressions} 项回退（容差 {tolerance:.0%}）')
+    return regressions
+
+
+def run_benchmarks():
+    bench_tokenize()
+    bench_token_memory()
+    bench_parse()
+    bench_w()
+    bench_signatures()
+    bench_occurs()
+    bench_instantiate()
+    bench_type_error()
+    bench_deep()
+    bench_incremental()
+    bench_let_rec()
+    bench_constraints()
+    bench_arena()
+    bench_print()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='性能测试')
+    parser.add_argument('--suite', action='store_true', help='运行基准测试套件，而不是各个专项测试')
+    parser.add_argument('-k', '--pattern', default='', help='只运行名字中含有这个字符串的用例，例如 let-chain 或 /10000')
+    parser.add_argument('--repeat', type=int, default=3, help='每一项重复的次数，取最短的耗时')
+    parser.add_argument('--baseline', type=Path, help='与这个基线文件比较，有回退时返回非零值')
+    parser.add_argument('--save', type=Path, help='把结果保存为基线文件')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='超出基线多少比例算作回退，默认为 0.25')
+    args = parser.parse_args(argv)
+
+    if not args.suite:
+        run_benchmarks()
+        return 0
+
+    results = run_suite(args.pattern, args.repeat)
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline: Results = json.load(f)
+        if compare(results, baseline, args.tolerance) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+
+# 类型检查结果的磁盘缓存：源代码没有变化时，直接读出上一次的结果，跳过 tokenize、parse 和 j
+#
+# 缓存项以源代码的内容散列和类型环境的指纹为键，每项是缓存目录中的一个文件，内容是紧凑的二进制格式：
+#   文件头：MAGIC、格式版本、绑定和语法树两节的偏移
+#   结果：程序的类型方案，或者错误信息和出错位置
+#   绑定：顶层的每个 let 和 let rec 绑定的名字和类型方案
+#   语法树：按后序编码的表达式
+# 每节有自己的字符串表和类型表，可以单独解码。读取时把整个文件读入内存（缓存项都很小），只解码结果一节，
+# 绑定和语法树在第一次访问时才解码，所以命中缓存的代价大致是读一次文件。
+# 不用 mmap：每个结果都要保留文件的内容，映射会一直占用到结果被回收，很长的批量检查中映射会越积越多
+#
+# 整数用变长编码（LEB128），有符号的整数先做 zigzag 变换。类型按后序编码成一张表，
+# 共享的子树只编码一次；类型变量记录希腊字母和 timestamp，解码出的类型方案显示得和原来一样。
+#
+# 写入时先写临时文件，再用 os.replace 原子地替换，多个进程可以共享同一个缓存目录，
+# 读到的要么是完整的旧文件，要么是完整的新文件。按最近使用的时间（文件的 mtime，命中时更新）淘汰，
+# 缓存目录的总大小超过上限时，从最久没有使用的缓存项开始删除。
+# 目录的总大小只在第一次写入时统计一次，之后加上写入的大小来估计；估计值超过上限，
+# 或者自上次统计以来写入了上限的八分之一（其他进程的写入要通过重新统计才能知道）时才重新统计，
+# 所以统计的代价均摊到每次写入上是常数
+
+from __future__ import annotations
+import hashlib
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import Any
+
+from ghaik import Greek
+from syntax import *
+from parse import tokenize_compact, parse
+from diagnostic import Frame, FrameKind, TyckException
+from trampoline import drive
+from pl9je import InferContext, TypeEnv, TypeScheme, Type, TypeVar, TypeOp, default_env, infer, j_bindings, j_step, \
+    type_op
+
+MAGIC = b'9T56'
+FORMAT_VERSION = 1
+# MAGIC、格式版本、绑定一节的偏移、语法树一节的偏移
+HEADER = struct.Struct('<4sBII')
+
+GREEK = list(Greek)
+
+
+class Writer:
+    out: bytearray
+    strings: dict[str, int]
+
+    def __init__(self, strings: dict[str, int] | None = None):
+        self.out = bytearray()
+        self.strings = strings if strings is not None else {}
+
+    def uint(self, value: int):
+        out = self.out
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    def int(self, value: int):
+        self.uint(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def string(self, s: str):
+        idx = self.strings.get(s)
+        if idx is None:
+            idx = self.strings[s] = len(self.strings)
+        self.uint(idx)
+
+
+class Reader:
+    data: memoryview
+    pos: int
+    strings: list[str]
+
+    def __init__(self, data: memoryview, pos: int):
+        self.data = data
+        self.pos = pos
+        self.strings = []
+        for _ in range(self.uint()):
+            length = self.uint()
+            self.strings.append(str(data[self.pos:self.pos + length], 'utf-8'))
+            self.pos += length
+
+    def uint(self) -> int:
+        data = self.data
+        pos = self.pos
+        ret = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            ret |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return ret
+
+    def int(self) -> int:
+        value = self.uint()
+        return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+    def string(self) -> str:
+        return self.strings[self.uint()]
+
+
+# 类型表：每个节点是类型变量（标记 0、希腊字母、timestamp）或者类型算子（标记 1、运算符、参数个数、参数的编号），
+# 参数总是排在类型算子之前
+class TypeWriter:
+    nodes: Writer
+    index: dict[Type, int]
+
+    def __init__(self, strings: dict[str, int]):
+        self.nodes = Writer(strings)
+        self.index = {}
+
+    def type(self, ty: Type) -> int:
+        nodes = self.nodes
+        root = ty.find()
+        stack: list[Type] = [root]
+        while len(stack) > 0:
+            t = stack[-1]
+            if t in self.index:
+                stack.pop()
+                continue
+            if isinstance(t, TypeVar):
+                stack.pop()
+                nodes.uint(0)
+                nodes.uint(t.greek.ordinal)
+                nodes.uint(t.timestamp)
+                self.index[t] = len(self.index)
+                continue
+            assert isinstance(t, TypeOp)
+            args = [arg.find() for arg in t.args]
+            pending = [arg for arg in args if arg not in self.index]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            nodes.uint(1)
+            nodes.string(t.op)
+            nodes.uint(len(args))
+            for arg in args:
+                nodes.uint(self.index[arg])
+            self.index[t] = len(self.index)
+        return self.index[root]
+
+    # 在 out 中写入类型方案：被泛化的类型变量的个数和编号，以及类型的编号
+    def scheme(self, scheme: TypeScheme, out: Writer):
+        free = [self.type(item) for item in scheme.free]
+        ty = self.type(scheme.ty)
+        out.uint(len(free))
+        for item in free:
+            out.uint(item)
+        out.uint(ty)
+
+
+# 一节的内容：字符串表（个数、每个字符串的长度和内容），类型表（节点数和节点），最后是正文
+def section(body: Writer, types: TypeWriter | None = None) -> bytes:
+    w = Writer()
+    w.uint(len(body.strings))
+    for s in body.strings:
+        data = s.encode('utf-8')
+        w.uint(len(data))
+        w.out.extend(data)
+    if types is not None:
+        w.uint(len(types.index))
+        w.out.extend(types.nodes.out)
+    w.out.extend(body.out)
+    return bytes(w.out)
+
+
+# 解码出的类型变量放在一个新的上下文中，随解码的结果一起被回收，不会留在调用者的上下文里
+def read_types(reader: Reader) -> list[Type]:
+    types: list[Type] = []
+    with InferContext():
+        for _ in range(reader.uint()):
+            if reader.uint() == 0:
+                tvar = TypeVar(GREEK[reader.uint()])
+                tvar.timestamp = reader.uint()
+                types.append(tvar)
+            else:
+                op = reader.string()
+                types.append(type_op(op, [types[reader.uint()] for _ in range(reader.uint())]))
+    return types
+
+
+def read_scheme(reader: Reader, types: list[Type]) -> TypeScheme:
+    free: list[Any] = [types[reader.uint()] for _ in range(reader.uint())]
+    return TypeScheme(free, types[reader.uint()])
+
+
+# 表达式按后序编码：每个节点是标记、字段和位置，子表达式排在它之前，解码时用一个栈依次构造
+EXPR_TAGS: dict[type, int] = {
+    ExprLitInt: 0, ExprLitBool: 1, ExprLitStr: 2, ExprVar: 3, ExprAbs: 4, ExprApp: 5,
+    ExprLet: 6, ExprStmt: 7, ExprReturn: 8, ExprIf: 9, ExprLetRec: 10,
+}
+
+
+def encode_expr(expr: Expr) -> bytes:
+    w = Writer()
+    stack: list[tuple[Expr, bool]] = [(expr, False)]
+    while len(stack) > 0:
+        e, expanded = stack.pop()
+        if not expanded:
+            stack.append((e, True))
+            stack.extend((child, False) for child in reversed(children(e)))
+            continue
+        w.uint(EXPR_TAGS[type(e)])
+        w.int(e.start)
+        w.int(e.end)
+        if isinstance(e, ExprLitInt):
+            w.int(e.value)
+        elif isinstance(e, ExprLitBool):
+            w.uint(1 if e.value else 0)
+        elif isinstance(e, ExprLitStr):
+            w.string(e.value)
+        elif isinstance(e, ExprVar) or isinstance(e, ExprAbs) or isinstance(e, ExprLet):
+            w.string(e.x)
+        elif isinstance(e, ExprStmt):
+            w.uint(len(e.stmts))
+        elif isinstance(e, ExprReturn):
+            w.uint(1 if e.e is not None else 0)
+        elif isinstance(e, ExprLetRec):
+            w.uint(len(e.decls))
+            for (name, _) in e.decls:
+                w.string(name)
+    return section(w)
+
+
+def children(e: Expr) -> list[Expr]:
+    if isinstance(e, ExprAbs):
+        return [e.body]
+    elif isinstance(e, ExprApp) or isinstance(e, ExprLet):
+        return [e.e1, e.e2]
+    elif isinstance(e, ExprStmt):
+        return e.stmts
+    elif isinstance(e, ExprReturn):
+        return [e.e] if e.e is not None else []
+    elif isinstance(e, ExprIf):
+        return [e.e1, e.e2, e.e3]
+    elif isinstance(e, ExprLetRec):
+        return [decl for (_, decl) in e.decls] + [e.body]
+    return []
+
+
+def decode_expr(reader: Reader, end: int) -> Expr:
+    stack: list[Expr] = []
+    while reader.pos < end:
+        tag = reader.uint()
+        start = reader.int()
+        stop = reader.int()
+        if tag == 0:
+            e: Expr = ExprLitInt(reader.int(), start, stop)
+        elif tag == 1:
+            e = ExprLitBool(reader.uint() == 1, start, stop)
+        elif tag == 2:
+            e = ExprLitStr(reader.string(), start, stop)
+        elif tag == 3:
+            e = ExprVar(reader.string(), start, stop)
+        elif tag == 4:
+            e = ExprAbs(reader.string(), stack.pop(), start, stop)
+        elif tag == 5:
+            e2 = stack.pop()
+            e = ExprApp(stack.pop(), e2, start, stop)
+        elif tag == 6:
+            e2 = stack.pop()
+            e = ExprLet(reader.string(), stack.pop(), e2, start, stop)
+        elif tag == 7:
+            n = reader.uint()
+            stmts = stack[len(stack) - n:]
+            del stack[len(stack) - n:]
+            e = ExprStmt(stmts, start, stop)
+        elif tag == 8:
+            e = ExprReturn(stack.pop() if reader.uint() == 1 else None, start, stop)
+        elif tag == 9:
+            e3 = stack.pop()
+            e2 = stack.pop()
+            e = ExprIf(stack.pop(), e2, e3, start, stop)
+        elif tag == 10:
+            names = [reader.string() for _ in range(reader.uint())]
+            body = stack.pop()
+            decls = stack[len(stack) - len(names):]
+            del stack[len(stack) - len(names):]
+            e = ExprLetRec(list(zip(names, decls)), body, start, stop)
+        else:
+            raise Exception(f'错误：缓存中有未知的表达式标记 {tag}')
+        stack.append(e)
+    assert len(stack) == 1
+    return stack[0]
+
+
+# 一个程序的检查结果。ok 时 scheme 是程序的类型方案，否则 error 是错误信息，span 是出错的位置。
+# bindings（顶层绑定的名字和类型方案）和 expr（语法树）从缓存读出时在第一次访问时才解码
+class CachedResult:
+    hit: bool
+    ok: bool
+    scheme: TypeScheme | None
+    error: str | None
+    span: tuple[int, int] | None
+
+    def __init__(self, hit: bool, scheme: TypeScheme | None, error: str | None, span: tuple[int, int] | None,
+                 bindings: list[tuple[str, TypeScheme]] | None = None, expr: Expr | None = None,
+                 data: memoryview | None = None):
+        self.hit = hit
+        self.ok = scheme is not None
+        self.scheme = scheme
+        self.error = error
+        self.span = span
+        self._bindings = bindings
+        self._expr = expr
+        self._data = data
+
+    @property
+    def bindings(self) -> list[tuple[str, TypeScheme]]:
+        if self._bindings is None:
+            assert self._data is not None
+            _, _, bindings_offset, _ = HEADER.unpack_from(self._data)
+            reader = Reader(self._data, bindings_offset)
+            types = read_types(reader)
+            names = [reader.string() for _ in range(reader.uint())]
+            self._bindings = [(name, read_scheme(reader, types)) for name in names]
+            self.release()
+        return self._bindings
+
+    @property
+    def expr(self) -> Expr:
+        if self._expr is None:
+            assert self._data is not None
+            _, _, _, ast_offset = HEADER.unpack_from(self._data)
+            self._expr = decode_expr(Reader(self._data, ast_offset), len(self._data))
+            self.release()
+        return self._expr
+
+    # 两节都解码之后不再需要文件的内容
+    def release(self):
+        if self._bindings is not None and self._expr is not None:
+            self._data = None
+
+
+def encode_result(result: CachedResult) -> bytes:
+    head = Writer()
+    types = TypeWriter(head.strings)
+    if result.scheme is not None:
+        head.uint(1)
+        types.scheme(result.scheme, head)
+    else:
+        assert result.error is not None
+        head.uint(0)
+        head.string(result.error)
+        span = result.span if result.span is not None else (-1, -1)
+        head.int(span[0])
+        head.int(span[1])
+    result_section = section(head, types)
+
+    body = Writer()
+    types = TypeWriter(body.strings)
+    body.uint(len(result.bindings))
+    for (name, _) in result.bindings:
+        body.string(name)
+    for (_, scheme) in result.bindings:
+        types.scheme(scheme, body)
+    bindings_section = section(body, types)
+
+    ast_section = encode_expr(result.expr)
+    bindings_offset = HEADER.size + len(result_section)
+    ast_offset = bindings_offset + len(bindings_section)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, bindings_offset, ast_offset) + result_section + bindings_section + ast_section
+
+
+def decode_result(data: memoryview) -> CachedResult:
+    magic, version, _, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError('缓存文件的格式不符')
+    reader = Reader(data, HEADER.size)
+    types = read_types(reader)
+    if reader.uint() == 1:
+        return CachedResult(True, read_scheme(reader, types), None, None, data=data)
+    error = reader.string()
+    span = (reader.int(), reader.int())
+    return CachedResult(True, None, error, span if span[0] >= 0 else None, data=data)
+
+
+# 推导顶层的每个绑定和最后的表达式，返回顶层绑定的类型方案和程序的类型方案。
+# 出错时和完整地推导整个程序一样，外层的每个 let 都补充一条上下文
+def infer_top_level(expr: Expr, env: TypeEnv) -> tuple[list[tuple[str, TypeScheme]], TypeScheme]:
+    bindings: list[tuple[str, TypeScheme]] = []
+    spine: list[Expr] = []
+    try:
+        while isinstance(expr, ExprLet) or isinstance(expr, ExprLetRec):
+            spine.append(expr)
+            env = drive(j_step, j_bindings(env, expr))
+            if isinstance(expr, ExprLet):
+                names = [expr.x]
+                expr = expr.e2
+            else:
+                names = list(dict.fromkeys(name for (name, _) in expr.decls))
+                expr = expr.body
+            for name in names:
+                scheme = env.lookup(name)
+                assert scheme is not None
+                bindings.append((name, scheme))
+        return bindings, infer(expr, env)
+    except TyckException as e:
+        for outer in reversed(spine):
+            e.add_frame(Frame(FrameKind.Expr, expr=outer))
+        raise e
+
+
+class TypeCache:
+    root: Path
+    env: TypeEnv
+    max_bytes: int
+    fingerprint: bytes
+    # 估计的目录总大小（还没有统计过时是 None），以及上次统计之后写入的字节数
+    total: int | None
+    unscanned: int
+
+    def __init__(self, root: str | Path, env: TypeEnv | None = None, max_bytes: int = 256 * 1024 * 1024):
+        self.root = Path(root)
+        self.env = env if env is not None else default_env()
+        self.max_bytes = max_bytes
+        self.fingerprint = env_fingerprint(self.env)
+        self.total = None
+        self.unscanned = 0
+
+    def path(self, source: str) -> Path:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.fingerprint)
+        h.update(source.encode('utf-8'))
+        key = h.hexdigest()
+        return self.root / key[:2] / (key + '.bin')
+
+    # 检查一个程序：命中缓存时直接返回缓存的结果，否则检查之后写入缓存。
+    # 词法或语法错误不是类型检查的结果，不写入缓存，异常原样抛出
+    def check(self, source: str) -> CachedResult:
+        path = self.path(source)
+        result = self.load(path)
+        if result is not None:
+            return result
+
+        expr = parse(tokenize_compact(source))
+        try:
+            with InferContext():
+                bindings, scheme = infer_top_level(expr, self.env)
+            result = CachedResult(False, scheme, None, None, bindings, expr)
+        except TyckException as e:
+            e.source = source
+            result = CachedResult(False, None, e.text, e.span, [], expr)
+        self.store(path, encode_result(result))
+        return result
+
+    def load(self, path: Path) -> CachedResult | None:
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < HEADER.size:
+                    return None
+                data = f.read()
+            result = decode_result(memoryview(data))
+        except (OSError, ValueError, IndexError):
+            return None
+        # 更新最近使用的时间，供淘汰时参考
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def store(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self.unscanned += len(data)
+        if (self.total is None or self.total + self.unscanned > self.max_bytes
+                or self.unscanned >= self.max_bytes // 8):
+            self.evict()
+
+    # 统计目录的总大小。总大小超过上限时，从最久没有使用的缓存项开始删除，直到总大小不超过上限的四分之三，
+    # 这样之后的若干次写入不会再次触发删除。其他进程可能同时删除了同一个文件，这不是错误
+    def evict(self):
+        entries: list[tuple[float, int, Path]] = []
+        total = 0
+        for path in self.root.glob('*/*.bin'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        self.total = total
+        self.unscanned = 0
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        target = self.max_bytes * 3 // 4
+        for (_, size, path) in entries:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+        self.total = total
+
+
+# 类型环境的指纹：缓存格式的版本，以及按名字排序之后的每个绑定的名字和类型方案
+def env_fingerprint(env: TypeEnv) -> bytes:
+    body = Writer()
+    types = TypeWriter(body.strings)
+    body.uint(FORMAT_VERSION)
+    for name in sorted(env.vars):
+        body.string(name)
+        types.scheme(env.vars.get(name), body)
+    return hashlib.blake2b(section(body, types), digest_size=16).digest()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# 约束生成和求解分开进行的类型推导，结果与 pl9je 的算法 J 相同
+#
+# 第一步（generate）只遍历一次表达式，生成一串扁平的约束，存放在几个并行的数组中；
+# 第二步（solve）在 pl9je 的并查集上求解这些约束，不再接触表达式。
+# 约束中的类型用“槽位”（slot）表示：每个槽位在求解时保存一个类型（或者 let 绑定的类型方案），
+# 约束要么定义一个槽位（新的类型变量、常量、函数类型、实例化、泛化），要么归一化两个槽位中的类型。
+#
+# 为了支持 let 多态，约束中除了等式之外还有进入和离开层级（ENTER、LEAVE）、泛化（GEN）以及实例化（INST）。
+# 生成约束的顺序就是算法 J 执行这些操作的顺序，但求解器不必按这个顺序归一化：见 solve 中的工作表。
+# 因此推导的结果与算法 J 只在类型变量的编号上不同（α 等价），出错时报告的可能是另一处同样矛盾的约束。
+# 约束集不引用类型环境，环境中的变量在求解时才查找（INST_ENV），同一个约束集可以在不同的环境中求解、缓存或者序列化。
+#
+# 每条约束记录产生它的表达式（origin）。表达式按遍历的顺序编号，parents 是每个表达式的父表达式，
+# 求解出错时沿着 parents 为每一层补充上下文，和算法 J 中错误从出错的位置向外传播时一样
+
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Generator
+
+from ghaik import Greek
+from syntax import *
+from parse import tokenize_compact, parse
+from hamt import PersistentMap
+from diagnostic import Frame, FrameKind, TyckException
+from trampoline import trampoline
+from pl9je import (InferContext, TypeEnv, TypeScheme, Type, TypeVar, TypeOp, current_context, default_env,
+                   entry_context, fn_type, generalize, let_rec_groups, unify)
+
+
+class ConstraintKind(IntEnum):
+    # 槽位 a 是希腊字母为 GREEK[b] 的新类型变量
+    NEW = 0
+    # 槽位 a 是没有参数的类型算子 strings[b]，例如 int
+    CONST = 1
+    # 槽位 a 是函数类型 b → c
+    FN = 2
+    # 槽位 a 是槽位 b 中的类型方案的实例（槽位 b 中是类型时，是这个类型所在等价类的代表）
+    INST = 3
+    # 槽位 a 是类型环境中的变量 strings[b] 的类型方案的实例
+    INST_ENV = 4
+    # 归一化槽位 a 和槽位 b 中的类型
+    EQ = 5
+    # 函数调用的返回类型 a 没有被归一化成其他类型时，把它显示为 η
+    ETA = 6
+    ENTER = 7
+    LEAVE = 8
+    # 槽位 a 是泛化槽位 b 中的类型得到的类型方案
+    GEN = 9
+    # 以 strings[a] 为错误信息报错
+    ERROR = 10
+
+
+GREEK = list(Greek)
+
+
+@dataclass
+class ConstraintSet:
+    kinds: array
+    a: array
+    b: array
+    c: array
+    origin: array
+    strings: list[str]
+    nodes: list[Expr]
+    parents: array
+    slots: int
+    result: int
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+
+# 表达式中的作用域：变量名到槽位的映射（槽位中是 lambda 参数的类型，或者 let 绑定的类型方案），
+# 以及最近的函数的返回类型所在的槽位
+@dataclass
+class Scope:
+    vars: PersistentMap
+    return_slot: int
+
+    def __init__(self, parent: Scope | None = None):
+        if parent is not None:
+            self.vars = parent.vars
+            self.return_slot = parent.return_slot
+        else:
+            self.vars = PersistentMap()
+            self.return_slot = -1
+
+    def bind(self, var_name: str, slot: int):
+        self.vars = self.vars.set(var_name, slot)
+
+
+GenGenerator = Generator[tuple[Scope, Expr, int], int, int]
+
+
+class ConstraintBuilder:
+    kinds: array
+    a: array
+    b: array
+    c: array
+    origin: array
+    strings: list[str]
+    string_index: dict[str, int]
+    const_slots: dict[str, int]
+    nodes: list[Expr]
+    parents: array
+    slots: int
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.origin = array('i')
+        self.strings = []
+        self.string_index = {}
+        self.const_slots = {}
+        self.nodes = []
+        self.parents = array('i')
+        self.slots = 0
+
+    def build(self, expr: Expr) -> ConstraintSet:
+        result = trampoline(self.step, Scope(), expr, -1)
+        return ConstraintSet(self.kinds, self.a, self.b, self.c, self.origin, self.strings,
+                             self.nodes, self.parents, self.slots, result)
+
+    def emit(self, kind: ConstraintKind, node: int, a: int = 0, b: int = 0, c: int = 0):
+        self.kinds.append(kind)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        self.origin.append(node)
+
+    def slot(self) -> int:
+        self.slots += 1
+        return self.slots - 1
+
+    def string(self, s: str) -> int:
+        idx = self.string_index.get(s)
+        if idx is None:
+            idx = self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return idx
+
+    def new(self, greek: Greek, node: int) -> int:
+        slot = self.slot()
+        self.emit(ConstraintKind.NEW, node, slot, greek.ordinal)
+        return slot
+
+    # 常量类型经过散列合并，每种只需要一个槽位
+    def const(self, op: str, node: int) -> int:
+        slot = self.const_slots.get(op)
+        if slot is None:
+            slot = self.const_slots[op] = self.slot()
+            self.emit(ConstraintKind.CONST, node, slot, self.string(op))
+        return slot
+
+    def node(self, expr: Expr, parent: int) -> int:
+        self.nodes.append(expr)
+        self.parents.append(parent)
+        return len(self.nodes) - 1
+
+    # 生成的一步：字面量和变量直接得到结果所在的槽位，其余的表达式交给 step_node 创建的生成器，见 trampoline.py
+    def step(self, scope: Scope, expr: Expr, parent: int) -> int | GenGenerator:
+        node = self.node(expr, parent)
+        if isinstance(expr, ExprLitInt):
+            return self.const('int', node)
+        elif isinstance(expr, ExprLitBool):
+            return self.const('bool', node)
+        elif isinstance(expr, ExprLitStr):
+            return self.const('str', node)
+        elif isinstance(expr, ExprVar):
+            slot = self.slot()
+            src = scope.vars.get(expr.x)
+            if src is not None:
+                self.emit(ConstraintKind.INST, node, slot, src)
+            else:
+                self.emit(ConstraintKind.INST_ENV, node, slot, self.string(expr.x))
+            return slot
+        return self.step_node(scope, expr, node)
+
+    def step_node(self, scope: Scope, expr: Expr, node: int) -> GenGenerator:
+        if isinstance(expr, ExprAbs):
+            beta = self.new(Greek.Beta, node)
+            scope1 = Scope(scope)
+            scope1.bind(expr.x, beta)
+            scope1.return_slot = self.new(Greek.Eta, node)
+            t1 = yield scope1, expr.body, node
+            self.emit(ConstraintKind.EQ, node, scope1.return_slot, t1)
+            ret = self.slot()
+            self.emit(ConstraintKind.FN, node, ret, beta, t1)
+            return ret
+        elif isinstance(expr, ExprApp):
+            pi = self.new(Greek.Pi, node)
+            t1 = yield scope, expr.e1, node
+            t2 = yield scope, expr.e2, node
+            fn = self.slot()
+            self.emit(ConstraintKind.FN, node, fn, t2, pi)
+            self.emit(ConstraintKind.EQ, node, fn, t1)
+            self.emit(ConstraintKind.ETA, node, pi)
+            return pi
+        elif isinstance(expr, ExprLet):
+            scope1 = Scope(scope)
+            self.emit(ConstraintKind.ENTER, node)
+            t1 = yield scope1, expr.e1, node
+            self.emit(ConstraintKind.LEAVE, node)
+            scheme = self.slot()
+            self.emit(ConstraintKind.GEN, node, scheme, t1)
+            scope1.bind(expr.x, scheme)
+            return (yield scope1, expr.e2, node)
+        elif isinstance(expr, ExprStmt):
+            for (idx, stmt) in enumerate(expr.stmts):
+                t = yield scope, stmt, node
+                if idx == len(expr.stmts) - 1:
+                    return t
+            assert False
+        elif isinstance(expr, ExprReturn):
+            if scope.return_slot == -1:
+                self.emit(ConstraintKind.ERROR, node, self.string('错误：return 只能在函数体内使用'))
+                return self.new(Greek.Eta, node)
+            if expr.e is not None:
+                t_ret = yield scope, expr.e, node
+            else:
+                t_ret = self.const('unit', node)
+            self.emit(ConstraintKind.EQ, node, scope.return_slot, t_ret)
+            return self.new(Greek.Eta, node)
+        elif isinstance(expr, ExprLetRec):
+            scope1 = Scope(scope)
+            for group in let_rec_groups(expr.decls):
+                gammas = []
+                self.emit(ConstraintKind.ENTER, node)
+                for idx in group:
+                    gamma = self.new(Greek.Gamma, node)
+                    gammas.append(gamma)
+                    scope1.bind(expr.decls[idx][0], gamma)
+                for (idx, gamma) in zip(group, gammas):
+                    actual = yield scope1, expr.decls[idx][1], node
+                    self.emit(ConstraintKind.EQ, node, gamma, actual)
+                self.emit(ConstraintKind.LEAVE, node)
+                for (idx, gamma) in zip(group, gammas):
+                    scheme = self.slot()
+                    self.emit(ConstraintKind.GEN, node, scheme, gamma)
+                    scope1.bind(expr.decls[idx][0], scheme)
+            return (yield scope1, expr.body, node)
+        elif isinstance(expr, ExprIf):
+            t1 = yield scope, expr.e1, node
+            t2 = yield scope, expr.e2, node
+            t3 = yield scope, expr.e3, node
+            self.emit(ConstraintKind.EQ, node, t1, self.const('bool', node))
+            self.emit(ConstraintKind.EQ, node, t2, t3)
+            return t2
+        else:
+            raise Exception(f'表达式 {expr} 的类型未知')
+
+
+def generate(expr: Expr) -> ConstraintSet:
+    return ConstraintBuilder().build(expr)
+
+
+# 在当前的推导上下文中求解约束，返回 cs.result 中的类型。
+#
+# 定义槽位的约束按顺序处理，而归一化（EQ）和依赖归一化结果的 ETA 先放进当前层级的工作表，
+# 直到离开这一层级（LEAVE，紧接着就是泛化这一层的 GEN）时才一起求解，顶层的工作表在最后求解。
+# 合一的结果与求解的顺序无关，泛化只要求这一层的等式都已经求解，所以推迟不会改变推导的结果。
+# 这样一层中的等式都在一个循环中连续求解，不再和创建类型变量、实例化交错进行，
+# 求解的顺序也可以独立于遍历表达式的顺序调整。
+#
+# 出错时为产生出错的约束的表达式及其外层的每个表达式补充上下文，并把层级恢复到求解之前
+def solve(cs: ConstraintSet, env: TypeEnv) -> Type:
+    store = current_context().store
+    level = store.current_level
+    kinds, a, b, c, strings = cs.kinds, cs.a, cs.b, cs.c, cs.strings
+    values: list[Any] = [None] * cs.slots
+    # 推迟求解的约束的编号；starts 是每个尚未离开的层级的工作表在 work 中的起点
+    work: list[int] = []
+    starts: list[int] = []
+
+    def solve_deferred(idx: int):
+        if kinds[idx] == ConstraintKind.EQ:
+            unify(values[a[idx]], values[b[idx]])
+        else:
+            pi = values[a[idx]]
+            if pi.find() is pi:
+                eta = TypeVar(Greek.Eta)
+                pi.greek = Greek.Eta
+                pi.timestamp = eta.timestamp
+
+    idx = 0
+    try:
+        for idx in range(len(kinds)):
+            kind = kinds[idx]
+            if kind == ConstraintKind.EQ or kind == ConstraintKind.ETA:
+                work.append(idx)
+            elif kind == ConstraintKind.INST:
+                src = values[b[idx]]
+                values[a[idx]] = src.instantiate() if isinstance(src, TypeScheme) else src.find()
+            elif kind == ConstraintKind.NEW:
+                values[a[idx]] = TypeVar(GREEK[b[idx]])
+            elif kind == ConstraintKind.FN:
+                values[a[idx]] = fn_type(values[b[idx]], values[c[idx]])
+            elif kind == ConstraintKind.CONST:
+                values[a[idx]] = TypeOp(strings[b[idx]], ())
+            elif kind == ConstraintKind.INST_ENV:
+                scheme = env.lookup(strings[b[idx]])
+                if scheme is None:
+                    raise TyckException('变量或函数 {} 尚未定义', strings[b[idx]])
+                values[a[idx]] = scheme.instantiate()
+            elif kind == ConstraintKind.ENTER:
+                store.enter_level()
+                starts.append(len(work))
+            elif kind == ConstraintKind.LEAVE:
+                start = starts.pop()
+                for idx in work[start:]:
+                    solve_deferred(idx)
+                del work[start:]
+                store.leave_level()
+            elif kind == ConstraintKind.GEN:
+                values[a[idx]] = generalize(values[b[idx]])
+            elif kind == ConstraintKind.ERROR:
+                raise TyckException(strings[a[idx]])
+            else:
+                raise Exception(f'未知的约束 {kind}')
+        for idx in work:
+            solve_deferred(idx)
+    except TyckException as e:
+        store.current_level = level
+        node = cs.origin[idx]
+        while node != -1:
+            e.add_frame(Frame(FrameKind.Expr, expr=cs.nodes[node]))
+            node = cs.parents[node]
+        raise e
+    return values[cs.result]
+
+
+def infer(expr: Expr, env: TypeEnv | None = None) -> TypeScheme:
+    with entry_context():
+        if env is None:
+            env = default_env()
+        cs = generate(expr)
+        store = current_context().store
+        store.enter_level()
+        try:
+            t = solve(cs, env)
+        finally:
+            store.leave_level()
+        return generalize(t)
+
+
+def try_inference(expr: Expr, env: TypeEnv | None = None):
+    try:
+        t_scheme = infer(expr, env)
+        print(f'c(Γ, {expr}) = {t_scheme}')
+    except TyckException as e:
+        print(f'c(Γ, {expr})\n错误: {e.text}')
+    print()
+
+
+if __name__ == '__main__':
+    try_inference(parse(tokenize_compact('let rec f = \\x. x, g = f in g')))
+    try_inference(parse(tokenize_compact(r'''
+    let rec g = f,
+        f = \x.
+            let ret = if (condint x) then
+                    (print "电灯熄灭 物换星移 移牛入海");
+                    (return 42)
+                else
+                    (print "独脚大盗 百万富翁 摸爬滚打");
+                    x
+                in
+                    (print "黑暗好像 一颗巨石 按在胸口");
+            ret
+        in g
+    ''')))
+    try_inference(parse(tokenize_compact('let id = \\x. x in (id id) (id id)')))
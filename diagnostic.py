@@ -0,0 +1,138 @@
+from __future__ import annotations
+from bisect import bisect_right
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any
+
+
+# 类型检查的诊断信息
+#
+# 类型错误从出错的位置向外传播时，每一层都会补充一条上下文（“当……时发生”）。
+# 上下文只记录对表达式和类型的引用，错误信息的文字在读取 text 时才生成，
+# 所以只关心检查是否通过的调用者不需要为错误信息付出任何代价，
+# 很深的表达式中的错误也不会在每一层都把外层表达式重新转换成字符串。
+#
+# 如果知道源代码（source），带有位置的表达式只显示其所在的行列号，渲染每一层的代价与表达式的大小无关。
+# 只有 tokenize_compact 解析出的表达式带有位置；tokenize 解析出的表达式位置都是 (-1, -1)，
+# 这时 span 为 None，每一层仍然显示整个表达式，渲染的代价与这个表达式的大小成正比。
+# 位置、span 和列号都按字符（Unicode 码点）计，不是字节；需要 UTF-8 字节偏移的调用者（例如编辑器）用 byte_offset 转换。
+# pl9je 的类型变量被归一化之后仍然显示自己的名字，所以渲染时先剪枝（见 shown），显示的是出错时已知的类型
+
+
+class FrameKind(Enum):
+    # 当归一化类型 t1 和 t2 时发生
+    Unify = 'unify'
+    # 当归一化类型算子的第 arg_index 个参数（t1 和 t2）时发生，subst 不为空时附带已分析的替换
+    UnifyArg = 'unify_arg'
+    # 当检查表达式 expr 时发生，知道源代码并且表达式带有位置时显示行列号
+    Expr = 'expr'
+
+
+@dataclass(slots=True)
+class Frame:
+    kind: FrameKind
+    expr: Any = None
+    t1: Any = None
+    t2: Any = None
+    arg_index: int = 0
+    subst: Any = None
+
+    def render(self, line_starts: list[int] | None = None) -> str:
+        if self.kind == FrameKind.Unify:
+            return f'\n  - 当归一化类型 {shown(self.t1)} 和 {shown(self.t2)} 时发生'
+        elif self.kind == FrameKind.UnifyArg:
+            ret = f'\n  - 当归一化类型算子的第 {self.arg_index + 1} 个参数（{shown(self.t1)} 和 {shown(self.t2)}）时发生'
+            if self.subst is not None:
+                ret += f'\n    已分析的替换：{self.subst}'
+            return ret
+        elif line_starts is not None and self.expr.start >= 0:
+            line, col = locate(line_starts, self.expr.start)
+            return f'\n  - 当检查第 {line} 行第 {col} 列的表达式时发生'
+        else:
+            return f'\n  - 当检查表达式 {self.expr} 时发生'
+
+
+# 错误信息中显示的值：带有 prune 的类型（pl9je 的类型）剪枝之后显示，其余的原样显示
+def shown(value: Any) -> Any:
+    prune = getattr(value, 'prune', None)
+    return prune() if prune is not None else value
+
+
+# 每一行在源代码中的起始偏移
+def line_starts(source: str) -> list[int]:
+    ret = [0]
+    offset = source.find('\n')
+    while offset != -1:
+        ret.append(offset + 1)
+        offset = source.find('\n', offset + 1)
+    return ret
+
+
+# 按字符计的偏移量对应的 UTF-8 字节偏移。代价与 offset 之前的源代码长度成正比，只在需要时转换
+def byte_offset(source: str, offset: int) -> int:
+    return len(source[:offset].encode('utf-8'))
+
+
+# 偏移量对应的行号和列号，都从 1 开始，列号按字符计
+def locate(line_starts: list[int], offset: int) -> tuple[int, int]:
+    line = bisect_right(line_starts, offset)
+    return line, offset - line_starts[line - 1] + 1
+
+
+# message 是 str.format 的格式串，message_args 是其参数，和 frames 一样在需要时才转换成字符串。
+# source 由知道源代码的调用者设置
+class TyckException(Exception):
+    message: str
+    message_args: tuple[Any, ...]
+    frames: list[Frame]
+    source: str | None
+
+    def __init__(self, message: str, *message_args: Any):
+        super().__init__()
+        self.message = message
+        self.message_args = message_args
+        self.frames = []
+        self.source = None
+
+    def add_frame(self, frame: Frame):
+        self.frames.append(frame)
+
+    # 最内层的带有位置的表达式的范围，用于在编辑器中定位错误
+    @property
+    def span(self) -> tuple[int, int] | None:
+        for frame in self.frames:
+            if frame.kind == FrameKind.Expr and frame.expr.start >= 0:
+                return frame.expr.start, frame.expr.end
+        return None
+
+    @property
+    def text(self) -> str:
+        starts = line_starts(self.source) if self.source is not None else None
+        parts = [self.message.format(*(shown(arg) for arg in self.message_args))]
+        for frame in self.frames:
+            parts.append(frame.render(starts))
+        return ''.join(parts)
+
+    def __str__(self) -> str:
+        return self.text
+
+
+# 检查器没有实现的语法，例如算法 W（pl9）只支持 λ 演算和 let 的部分。
+# 这不说明程序有类型错误，批量检查把它报告为 unsupported，而不是类型错误
+class UnsupportedSyntax(Exception):
+    what: str
+    expr: Any
+
+    def __init__(self, what: str, expr: Any):
+        super().__init__()
+        self.what = what
+        self.expr = expr
+
+    @property
+    def span(self) -> tuple[int, int] | None:
+        if self.expr.start >= 0:
+            return self.expr.start, self.expr.end
+        return None
+
+    def __str__(self) -> str:
+        return f'不支持的语法：{self.what}'
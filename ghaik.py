@@ -1,6 +1,7 @@
 from enum import Enum
 
 
+# ordinal 是字母在枚举中的序号，可以作为列表的下标，比以枚举成员为键查字典快得多
 class Greek(Enum):
     Alpha = 'α'
     Beta = 'β'
@@ -12,5 +13,8 @@ class Greek(Enum):
     Tau = 'τ'
     Eta = 'η'
 
+    def __init__(self, _value: str):
+        self.ordinal = len(type(self).__members__)
+
     def __str__(self) -> str:
          return self.value
@@ -0,0 +1,155 @@
+from __future__ import annotations
+from typing import Any, Iterator
+
+
+# 持久化的哈希数组映射字典树（HAMT）
+#
+# 每一层用哈希值中的 5 位选择子节点，节点中只存放实际存在的子项，用位图记录哪些位置有子项。
+# set 只复制从根到被修改位置的路径，旧的映射保持不变，所以扩展类型环境是 O(log n) 的，
+# 并且多个环境可以共享绝大部分结构
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_MASK = (1 << 64) - 1
+
+
+class Leaf:
+    __slots__ = ('hash', 'key', 'value')
+
+    def __init__(self, hash: int, key: Any, value: Any):
+        self.hash = hash
+        self.key = key
+        self.value = value
+
+
+# 哈希值完全相同的键放在同一个冲突节点中
+class CollisionNode:
+    __slots__ = ('hash', 'leaves')
+
+    def __init__(self, hash: int, leaves: list[Leaf]):
+        self.hash = hash
+        self.leaves = leaves
+
+
+class BitmapNode:
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap: int, entries: list[Leaf | BitmapNode | CollisionNode]):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+EMPTY_NODE = BitmapNode(0, [])
+MISSING = object()
+
+
+class PersistentMap:
+    __slots__ = ('root', 'size')
+
+    def __init__(self, root: BitmapNode = EMPTY_NODE, size: int = 0):
+        self.root = root
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, MISSING) is not MISSING
+
+    def __iter__(self) -> Iterator[Any]:
+        for (key, _) in self.items():
+            yield key
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        h = hash(key) & HASH_MASK
+        node: Leaf | BitmapNode | CollisionNode = self.root
+        shift = 0
+        while True:
+            if isinstance(node, BitmapNode):
+                bit = 1 << ((h >> shift) & MASK)
+                bitmap = node.bitmap
+                if not bitmap & bit:
+                    return default
+                node = node.entries[(bitmap & (bit - 1)).bit_count()]
+                shift += BITS
+            elif isinstance(node, Leaf):
+                if node.hash == h and node.key == key:
+                    return node.value
+                return default
+            else:
+                if node.hash == h:
+                    for leaf in node.leaves:
+                        if leaf.key == key:
+                            return leaf.value
+                return default
+
+    # 查找 key 时经过的节点数（不论是否找到），用于性能分析（instrument.py）
+    def depth(self, key: Any) -> int:
+        h = hash(key) & HASH_MASK
+        node: Leaf | BitmapNode | CollisionNode = self.root
+        shift = 0
+        ret = 1
+        while isinstance(node, BitmapNode):
+            bit = 1 << ((h >> shift) & MASK)
+            if not node.bitmap & bit:
+                return ret
+            node = node.entries[(node.bitmap & (bit - 1)).bit_count()]
+            shift += BITS
+            ret += 1
+        return ret
+
+    def set(self, key: Any, value: Any) -> PersistentMap:
+        h = hash(key) & HASH_MASK
+        root, added = node_set(self.root, 0, Leaf(h, key, value))
+        return PersistentMap(root, self.size + 1 if added else self.size)
+
+    def items(self) -> Iterator[tuple[Any, Any]]:
+        stack: list[Leaf | BitmapNode | CollisionNode] = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if isinstance(node, Leaf):
+                yield node.key, node.value
+            elif isinstance(node, BitmapNode):
+                stack.extend(reversed(node.entries))
+            else:
+                for leaf in node.leaves:
+                    yield leaf.key, leaf.value
+
+    def values(self) -> Iterator[Any]:
+        for (_, value) in self.items():
+            yield value
+
+
+# 返回插入后的新节点，以及是否新增了一个键（而不是覆盖已有的键）
+def node_set(node: BitmapNode, shift: int, leaf: Leaf) -> tuple[BitmapNode, bool]:
+    bit = 1 << ((leaf.hash >> shift) & MASK)
+    index = (node.bitmap & (bit - 1)).bit_count()
+    if not node.bitmap & bit:
+        entries = node.entries.copy()
+        entries.insert(index, leaf)
+        return BitmapNode(node.bitmap | bit, entries), True
+
+    entry = node.entries[index]
+    added = True
+    if isinstance(entry, BitmapNode):
+        entry, added = node_set(entry, shift + BITS, leaf)
+    elif isinstance(entry, Leaf):
+        if entry.hash == leaf.hash and entry.key == leaf.key:
+            entry = leaf
+            added = False
+        elif entry.hash == leaf.hash:
+            entry = CollisionNode(leaf.hash, [entry, leaf])
+        else:
+            entry, _ = node_set(BitmapNode(0, []), shift + BITS, entry)
+            entry, _ = node_set(entry, shift + BITS, leaf)
+    else:
+        if entry.hash == leaf.hash:
+            leaves = [item for item in entry.leaves if item.key != leaf.key]
+            added = len(leaves) == len(entry.leaves)
+            entry = CollisionNode(leaf.hash, leaves + [leaf])
+        else:
+            entry, _ = node_set(BitmapNode(1 << ((entry.hash >> (shift + BITS)) & MASK), [entry]), shift + BITS, leaf)
+
+    entries = node.entries.copy()
+    entries[index] = entry
+    return BitmapNode(node.bitmap, entries), added
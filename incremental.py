@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# 增量类型检查：编辑器每次修改之后重新检查整个文件，但只重新推导发生了变化的顶层绑定
+#
+# 文件的顶层是一串 let 和 let rec，最后是一个表达式。每个顶层绑定推导出的类型方案缓存在 cache 中，
+# 键由两部分组成：绑定的表达式的结构（structure_key，与位置无关），以及其中每个自由变量在环境中的类型方案的规范形式。
+# 所以一个绑定只有在它本身被修改，或者它用到的某个绑定的类型发生了变化时才需要重新推导；
+# 修改了一个绑定的实现而没有改变它的类型时，依赖它的绑定仍然命中缓存。
+#
+# 缓存的类型方案被复制到检查器自己的推导上下文中，不引用某一次检查的并查集，那次检查的状态可以被回收。
+# 每次检查之后只保留这次检查用到的缓存项，所以缓存的大小与文件的大小成正比。
+# 被淘汰的缓存项的类型变量仍然留在检查器的上下文中，当其中的类型变量比缓存项用到的多出一倍时，
+# 把缓存的类型方案复制到一个新的上下文中（compact），所以上下文的大小同样与缓存的大小成正比。
+#
+# 命中缓存的绑定不会创建新的类型变量，所以类型变量的编号可能与完整地检查一遍不同，但类型方案是相同的
+
+from __future__ import annotations
+from typing import Any
+
+from syntax import Expr, ExprLet, ExprLetRec, structure_key, free_vars
+from diagnostic import Frame, FrameKind, TyckException
+from trampoline import drive
+from pl9je import InferContext, TypeEnv, TypeScheme, Type, TypeVar, TypeOp, default_env, infer, j_bindings, j_step
+
+# 上下文中的类型变量少于这么多时不整理
+COMPACT_MIN_VARS = 1024
+
+
+# 类型方案的规范形式：把类型展开成元组，被泛化的类型变量按第一次出现的顺序编号，
+# 因此只是类型变量的名字不同的类型方案的规范形式相同。不含类型变量的类型算子经过散列合并，直接作为自身的规范形式
+def scheme_key(scheme: TypeScheme) -> Any:
+    ty = scheme.ty.find()
+    if isinstance(ty, TypeOp) and ty.ground:
+        return ty
+    index: dict[TypeVar, int] = {}
+    free = set(scheme.free)
+    items: list[Any] = []
+    stack: list[Type] = [ty]
+    while len(stack) > 0:
+        t = stack.pop().find()
+        if isinstance(t, TypeVar):
+            if t not in free:
+                # 没有被泛化的类型变量（来自调用者提供的环境），只能按身份比较
+                items.append(t)
+            else:
+                items.append(index.setdefault(t, len(index)))
+        else:
+            assert isinstance(t, TypeOp)
+            if t.ground:
+                items.append(t)
+            else:
+                items.append(t.op)
+                items.append(len(t.args))
+                stack.extend(reversed(t.args))
+    return tuple(items)
+
+
+# 顶层绑定的摘要：(绑定的名字, 表达式的结构, 自由变量)
+Summary = tuple[list[str], tuple[Any, ...], set[str]]
+
+
+def summarize(expr: Expr) -> Summary:
+    if isinstance(expr, ExprLet):
+        return [expr.x], ('let', structure_key(expr.e1)), free_vars(expr.e1)
+    elif isinstance(expr, ExprLetRec):
+        names = [name for (name, _) in expr.decls]
+        fv: set[str] = set()
+        for (_, decl) in expr.decls:
+            fv |= free_vars(decl)
+        fv.difference_update(names)
+        return names, ('let rec', tuple(names), tuple(structure_key(decl) for (_, decl) in expr.decls)), fv
+    else:
+        return [], ('body', structure_key(expr)), free_vars(expr)
+
+
+# 上一次检查中顶层的一个绑定：(摘要, 缓存的键, 类型方案, 加入绑定之后的环境)
+PrefixEntry = tuple[Summary, Any, list[TypeScheme], TypeEnv]
+
+
+# 给出源代码时，摘要以绑定的源代码文本为键缓存在 summaries 中，没有修改过的绑定不需要重新遍历。
+# 同时记录上一次检查时每个顶层绑定之后的环境（prefix）：文件开头没有修改过的那些绑定直接沿用上一次的环境，
+# 这样修改一个绑定之后，它前面的部分只需要逐个比较摘要，后面的部分只需要查找缓存
+class IncrementalChecker:
+    env: TypeEnv
+    context: InferContext
+    cache: dict[Any, list[TypeScheme]]
+    summaries: dict[str, Summary]
+    prefix: list[PrefixEntry]
+    hits: int
+    misses: int
+
+    def __init__(self, env: TypeEnv | None = None):
+        self.env = env if env is not None else default_env()
+        self.context = InferContext()
+        self.cache = {}
+        self.summaries = {}
+        self.prefix = []
+        self.hits = 0
+        self.misses = 0
+
+    # 检查整个程序，返回其类型方案；出错时抛出 TyckException，错误信息中的上下文和完整检查时相同。
+    # source 是 expr 的源代码，可以省略
+    def check(self, expr: Expr, source: str | None = None) -> TypeScheme:
+        used: dict[Any, list[TypeScheme]] = {}
+        used_summaries: dict[str, Summary] = {}
+        prefix: list[PrefixEntry] = []
+        spine: list[ExprLet | ExprLetRec] = []
+        env = self.env
+        # 到目前为止的绑定是否都和上一次检查时相同
+        same_prefix = True
+        try:
+            with InferContext():
+                while isinstance(expr, ExprLet) or isinstance(expr, ExprLetRec):
+                    spine.append(expr)
+                    body = expr.e2 if isinstance(expr, ExprLet) else expr.body
+                    summary = self.summarize(expr, body.start, source, used_summaries)
+                    idx = len(prefix)
+                    same_prefix = same_prefix and idx < len(self.prefix) and self.prefix[idx][0] is summary
+                    if same_prefix:
+                        _, key, schemes, env = self.prefix[idx]
+                        used[key] = schemes
+                        self.hits += 1
+                        prefix.append(self.prefix[idx])
+                        expr = body
+                        continue
+
+                    names, key, fv = summary
+                    key += self.env_key(env, fv)
+                    schemes = self.lookup(used, key)
+                    if schemes is None:
+                        env1 = drive(j_step, j_bindings(env, expr))
+                        schemes = [self.detach(env1.lookup(name)) for name in names]
+                        used[key] = schemes
+                    env = TypeEnv(env)
+                    for (name, scheme) in zip(names, schemes):
+                        env.bind(name, scheme)
+                    prefix.append((summary, key, schemes, env))
+                    expr = body
+
+                _, key, fv = self.summarize(expr, expr.end, source, used_summaries)
+                key += self.env_key(env, fv)
+                schemes = self.lookup(used, key)
+                if schemes is None:
+                    schemes = [self.detach(infer(expr, env))]
+                    used[key] = schemes
+        except TyckException as e:
+            # 出错之后的绑定没有被检查，保留它们原先的缓存项，修正错误之后仍然可以使用
+            self.cache.update(used)
+            self.summaries.update(used_summaries)
+            self.prefix = prefix
+            self.compact()
+            # 完整检查时，外层的每个 let 都会补充一条上下文
+            for outer in reversed(spine):
+                e.add_frame(Frame(FrameKind.Expr, expr=outer))
+            raise e
+        self.cache = used
+        self.summaries = used_summaries
+        self.prefix = prefix
+        self.compact()
+        return schemes[0]
+
+    # 顶层绑定 expr 的源代码是 source[expr.start:end]
+    def summarize(self, expr: Expr, end: int, source: str | None, used: dict[str, Summary]) -> Summary:
+        if source is None or expr.start < 0 or end < 0:
+            return summarize(expr)
+        text = source[expr.start:end]
+        summary = self.summaries.get(text)
+        if summary is None:
+            summary = summarize(expr)
+        used[text] = summary
+        return summary
+
+    def lookup(self, used: dict[Any, list[TypeScheme]], key: Any) -> list[TypeScheme] | None:
+        schemes = self.cache.get(key)
+        if schemes is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        used[key] = schemes
+        return schemes
+
+    def env_key(self, env: TypeEnv, names: set[str]) -> tuple[Any, ...]:
+        ret: list[Any] = []
+        for name in sorted(names):
+            scheme = env.lookup(name)
+            ret.append(name)
+            ret.append(scheme_key(scheme) if scheme is not None else None)
+        return tuple(ret)
+
+    # 把类型方案复制到检查器自己的上下文中
+    def detach(self, scheme: TypeScheme) -> TypeScheme:
+        if len(scheme.free) == 0:
+            return TypeScheme([], scheme.ty.prune())
+        with self.context:
+            free = {item: item.fresh() for item in scheme.free}
+            return TypeScheme(list(free.values()), scheme.ty.instantiate(free))
+
+    # 上下文中的类型变量比缓存的类型方案用到的多出一倍时，把缓存的类型方案（以及 prefix 中的环境）复制到新的上下文中，
+    # 旧的上下文和其中被淘汰的类型变量随之被回收。整理的代价与缓存的大小成正比，
+    # 而两次整理之间至少又创建了同样多的类型变量，所以均摊下来不影响每次检查的耗时
+    def compact(self):
+        # 结构相同的两个绑定共用一个缓存项，prefix 中可能是被覆盖的那一份，所以两处都要收集
+        schemes: dict[int, TypeScheme] = {}
+        for cached in list(self.cache.values()) + [entry[2] for entry in self.prefix]:
+            for scheme in cached:
+                schemes[id(scheme)] = scheme
+        live = sum(len(scheme.free) for scheme in schemes.values())
+        if len(self.context.store.vars) <= max(2 * live, COMPACT_MIN_VARS):
+            return
+
+        self.context = InferContext()
+        copied = {key: self.detach(scheme) for (key, scheme) in schemes.items()}
+        self.cache = {key: [copied[id(scheme)] for scheme in cached] for (key, cached) in self.cache.items()}
+        prefix: list[PrefixEntry] = []
+        env = self.env
+        for (summary, key, cached, _) in self.prefix:
+            cached = [copied[id(scheme)] for scheme in cached]
+            env = TypeEnv(env)
+            for (name, scheme) in zip(summary[0], cached):
+                env.bind(name, scheme)
+            prefix.append((summary, key, cached, env))
+        self.prefix = prefix
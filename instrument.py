@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# 类型推导的性能分析：热点函数的调用次数和耗时、各阶段的耗时，以及一些计数器
+#
+# 平时不做任何插桩。在 with Profile() 期间，pl9je 中的热点函数被替换成带计数和计时的包装，
+# 退出时换回原来的函数，所以不做分析时没有额外的开销。唯一的例外是出现检查访问的节点数，
+# 它由 TypeVarStore 自己累计（occurs_visits），每次 bind 只多一次加法。
+# 被替换的函数在所有直接导入了它的模块中一并替换（例如 constraints 导入的 unify）。
+# 替换对所有线程都生效，所以同一时刻只能有一个 Profile 处于活动状态。
+#
+# 计时的函数和阶段形成调用栈，每一帧的自身耗时（不含子帧）按调用栈累计，
+# 可以输出为 flamegraph.pl、speedscope 等工具接受的折叠栈格式：每行是“帧1;帧2;帧3 微秒数”。
+# 递归的函数（例如 unify）在栈中出现多次，总耗时只在最外层的调用结束时计入
+
+from __future__ import annotations
+import argparse
+import functools
+import importlib
+import json
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import GeneratorType, ModuleType
+from typing import IO, Any, Callable, Iterator
+
+import pl9je
+from batch import read_programs
+from diagnostic import TyckException
+from parse import tokenize_compact, parse
+
+
+@dataclass(slots=True)
+class Histogram:
+    count: int = 0
+    total: int = 0
+    max: int = 0
+
+    def observe(self, value: int):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: Histogram):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def to_json(self) -> dict[str, Any]:
+        mean = self.total / self.count if self.count > 0 else 0
+        return {'count': self.count, 'total': self.total, 'max': self.max, 'mean': round(mean, 3)}
+
+
+@dataclass(slots=True)
+class FrameStats:
+    calls: int = 0
+    # 秒
+    total: float = 0.0
+    self_time: float = 0.0
+
+    def merge(self, other: FrameStats):
+        self.calls += other.calls
+        self.total += other.total
+        self.self_time += other.self_time
+
+    def to_json(self) -> dict[str, Any]:
+        return {'calls': self.calls, 'total_ms': round(self.total * 1000, 3), 'self_ms': round(self.self_time * 1000, 3)}
+
+
+# 正在进行的一帧：[名字, 开始时间, 子帧的耗时]
+OpenFrame = list[Any]
+
+active: Profile | None = None
+
+
+class Profile:
+    counters: dict[str, int]
+    histograms: dict[str, Histogram]
+    frames: dict[str, FrameStats]
+    phases: dict[str, FrameStats]
+    folded: dict[tuple[str, ...], float]
+    stack: list[OpenFrame]
+    depth: dict[str, int]
+    patches: list[tuple[Any, str, Any]]
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.frames = {}
+        self.phases = {}
+        self.folded = {}
+        self.stack = []
+        self.depth = {}
+        self.patches = []
+
+    def __enter__(self) -> Profile:
+        global active
+        if active is not None:
+            raise Exception('错误：已经有一个 Profile 处于活动状态')
+        active = self
+        for (owner, name, make_wrapper) in hooks(self):
+            self.patch(owner, name, make_wrapper)
+        return self
+
+    def __exit__(self, *exc_info):
+        global active
+        for (owner, name, original) in reversed(self.patches):
+            setattr(owner, name, original)
+        self.patches = []
+        active = None
+
+    # 替换 owner 的属性 name；owner 是模块时，其他模块中直接导入的同一个函数也一并替换
+    def patch(self, owner: Any, name: str, make_wrapper: Callable[[Any], Any]):
+        original = getattr(owner, name)
+        wrapper = make_wrapper(original)
+        owners = [owner]
+        if isinstance(owner, ModuleType):
+            for module in list(sys.modules.values()):
+                if module is not owner and getattr(module, name, None) is original:
+                    owners.append(module)
+        for item in owners:
+            self.patches.append((item, name, original))
+            setattr(item, name, wrapper)
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: int):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def enter(self, name: str):
+        self.depth[name] = self.depth.get(name, 0) + 1
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    # call 为假时只是暂时离开这一帧（见 hooks 中的 j_step），之后还会再次进入，不算作一次调用
+    def exit(self, table: dict[str, FrameStats] | None = None, call: bool = True):
+        now = time.perf_counter()
+        key = tuple(frame[0] for frame in self.stack)
+        name, start, children = self.stack.pop()
+        elapsed = now - start
+        self_time = elapsed - children
+        self.folded[key] = self.folded.get(key, 0.0) + self_time
+        if len(self.stack) > 0:
+            self.stack[-1][2] += elapsed
+
+        if table is None:
+            table = self.frames
+        stats = table.get(name)
+        if stats is None:
+            stats = table[name] = FrameStats()
+        if call:
+            stats.calls += 1
+        stats.self_time += self_time
+        self.depth[name] -= 1
+        if self.depth[name] == 0:
+            stats.total += elapsed
+
+    # 为一个阶段（例如 tokenize、parse、infer）计时，阶段和函数一样出现在调用栈中
+    def phase(self, name: str) -> Phase:
+        return Phase(self, name)
+
+    def merge(self, other: Profile):
+        for (name, value) in other.counters.items():
+            self.count(name, value)
+        for (name, histogram) in other.histograms.items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+        for (src, dst) in [(other.frames, self.frames), (other.phases, self.phases)]:
+            for (name, stats) in src.items():
+                dst.setdefault(name, FrameStats()).merge(stats)
+        for (key, value) in other.folded.items():
+            self.folded[key] = self.folded.get(key, 0.0) + value
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'phases': {name: stats.to_json() for (name, stats) in self.phases.items()},
+            'functions': {name: stats.to_json() for (name, stats) in self.frames.items()},
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.to_json() for (name, histogram) in self.histograms.items()},
+        }
+
+    # 折叠栈格式，数值是微秒
+    def folded_lines(self) -> Iterator[str]:
+        for (key, value) in sorted(self.folded.items()):
+            us = round(value * 1_000_000)
+            if us > 0:
+                yield ';'.join(key) + ' ' + str(us)
+
+    def write_folded(self, out: IO[str]):
+        for line in self.folded_lines():
+            out.write(line + '\n')
+
+
+class Phase:
+    profile: Profile
+    name: str
+
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profile.exit(self.profile.phases)
+
+
+def timed(profile: Profile, name: str) -> Callable[[Any], Any]:
+    def make_wrapper(fn: Any) -> Any:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile.enter(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.exit()
+        return wrapper
+    return make_wrapper
+
+
+# 被替换的函数：(所在的模块或类, 属性名, 根据原来的函数构造包装的函数)
+def hooks(profile: Profile) -> list[tuple[Any, str, Callable[[Any], Any]]]:
+    # 并查集的 find 和 add 调用得太频繁，只计数，不计时
+    def find(fn: Any) -> Any:
+        @functools.wraps(fn)
+        def wrapper(store: pl9je.TypeVarStore, id: int) -> int:
+            parent = store.parent
+            node = id
+            length = 0
+            while parent[node] != node:
+                node = parent[node]
+                length += 1
+            profile.observe('find_chain', length)
+            return fn(store, id)
+        return wrapper
+
+    def add(fn: Any) -> Any:
+        @functools.wraps(fn)
+        def wrapper(store: pl9je.TypeVarStore, type_var: pl9je.TypeVar) -> int:
+            profile.count('fresh_vars')
+            return fn(store, type_var)
+        return wrapper
+
+    def occurs(name: str) -> Callable[[Any], Any]:
+        def make_wrapper(fn: Any) -> Any:
+            @functools.wraps(fn)
+            def wrapper(store: pl9je.TypeVarStore, *args):
+                before = store.occurs_visits
+                profile.enter(name)
+                try:
+                    return fn(store, *args)
+                finally:
+                    profile.exit()
+                    profile.count('occurs_visits', store.occurs_visits - before)
+            return wrapper
+        return make_wrapper
+
+    def instantiate(fn: Any) -> Any:
+        @functools.wraps(fn)
+        def wrapper(scheme: pl9je.TypeScheme) -> pl9je.Type:
+            profile.count('instantiate_ground' if len(scheme.free) == 0 else 'instantiate_poly')
+            profile.enter('instantiate')
+            try:
+                return fn(scheme)
+            finally:
+                profile.exit()
+        return wrapper
+
+    # j 的每一步由 trampoline 驱动，包装 j 本身只能得到一次调用，其中的耗时只是 trampoline 自身的开销。
+    # 每个节点按表达式的种类计时（例如 j:ExprApp），调用次数就是这种节点的个数。
+    # 节点的生成器产生子问题时暂时离开它的帧，子节点的帧不嵌套在父节点中，
+    # 所以栈的深度与表达式的嵌套深度无关，每种节点的耗时只包含这个节点自己的工作（及其中调用的 unify 等）
+    def j_step(fn: Any) -> Any:
+        def profiled(name: str, gen: pl9je.JGenerator) -> pl9je.JGenerator:
+            value: Any = None
+            error: BaseException | None = None
+            try:
+                while True:
+                    if error is None:
+                        sub_args = gen.send(value)
+                    else:
+                        e, error = error, None
+                        sub_args = gen.throw(e)
+                    profile.exit(call=False)
+                    try:
+                        value = yield sub_args
+                    except BaseException as e:
+                        error = e
+                    profile.enter(name)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                profile.exit()
+
+        @functools.wraps(fn)
+        def wrapper(env: pl9je.TypeEnv, expr: pl9je.Expr) -> pl9je.Type | pl9je.JGenerator:
+            name = 'j:' + type(expr).__name__
+            profile.enter(name)
+            try:
+                ret = fn(env, expr)
+            except BaseException:
+                profile.exit()
+                raise
+            if type(ret) is not GeneratorType:
+                profile.exit()
+                return ret
+            return profiled(name, ret)
+        return wrapper
+
+    def lookup(fn: Any) -> Any:
+        @functools.wraps(fn)
+        def wrapper(env: pl9je.TypeEnv, var_name: str) -> pl9je.TypeScheme | None:
+            profile.observe('env_lookup_depth', env.vars.depth(var_name))
+            return fn(env, var_name)
+        return wrapper
+
+    ret = [
+        (pl9je, 'j', timed(profile, 'j')),
+        (pl9je, 'j_step', j_step),
+        (pl9je, 'unify', timed(profile, 'unify')),
+        (pl9je, 'generalize', timed(profile, 'generalize')),
+        (pl9je.TypeOp, 'prune', timed(profile, 'prune')),
+        (pl9je.TypeScheme, 'instantiate', instantiate),
+        (pl9je.TypeVarStore, 'bind', occurs('bind')),
+        (pl9je.TypeVarStore, 'check_cycles', occurs('check_cycles')),
+        (pl9je.TypeVarStore, 'find', find),
+        (pl9je.TypeVarStore, 'add', add),
+        (pl9je.TypeEnv, 'lookup', lookup),
+    ]
+    # 先生成约束再求解的推导（constraints.py）只在已经导入时分析
+    constraints = sys.modules.get('constraints')
+    if constraints is not None:
+        ret.append((constraints, 'generate', timed(profile, 'generate')))
+        ret.append((constraints, 'solve', timed(profile, 'solve')))
+    return ret
+
+
+CHECKERS = {
+    'j': 'pl9je',
+    'c': 'constraints',
+}
+
+
+# 在新的推导上下文中分析一个程序，返回 (是否通过检查, 分析结果)
+def profile_source(source: str, checker: ModuleType = pl9je, env: pl9je.TypeEnv | None = None) -> tuple[bool, Profile]:
+    ok = True
+    with Profile() as profile:
+        with pl9je.InferContext():
+            with profile.phase('tokenize'):
+                tokens = tokenize_compact(source)
+            with profile.phase('parse'):
+                expr = parse(tokens)
+            with profile.phase('infer'):
+                try:
+                    checker.infer(expr, env)
+                except TyckException:
+                    ok = False
+    return ok, profile
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='类型推导的性能分析')
+    parser.add_argument('input', type=Path, help='包含程序的目录，或者每行一个程序的 JSONL 文件')
+    parser.add_argument('-o', '--output', type=Path, help='每个程序的分析结果（JSONL），默认输出到标准输出')
+    parser.add_argument('--folded', type=Path, help='把所有程序汇总的折叠栈写入这个文件，可以交给 flamegraph.pl')
+    parser.add_argument('-a', '--algorithm', choices=sorted(CHECKERS), default='j', help='使用算法 J（pl9je），或者先生成约束再求解（constraints）')
+    parser.add_argument('--glob', default='*', help='输入为目录时，只分析文件名匹配的文件')
+    args = parser.parse_args(argv)
+
+    checker = importlib.import_module(CHECKERS[args.algorithm])
+    env = checker.default_env()
+    total = Profile()
+    out = open(args.output, 'w', encoding='utf-8') if args.output is not None else sys.stdout
+    try:
+        for (id, source) in read_programs(args.input, args.glob):
+            try:
+                ok, profile = profile_source(source, checker, env)
+            except Exception as e:
+                out.write(json.dumps({'id': id, 'ok': False, 'error': str(e)}, ensure_ascii=False) + '\n')
+                continue
+            total.merge(profile)
+            out.write(json.dumps({'id': id, 'ok': ok, **profile.to_json()}, ensure_ascii=False) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.folded is not None:
+        with open(args.folded, 'w', encoding='utf-8') as f:
+            total.write_folded(f)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,13 @@
+import codecs
+import mmap
+import re
+from array import array
+from collections import deque
 from dataclasses import dataclass
 from enum import Enum
+from itertools import accumulate, chain
+from operator import attrgetter
+from typing import IO, Any, Iterable, Iterator
 
 from syntax import *
 
@@ -29,7 +37,7 @@ class TokenKind(Enum):
     EOI       = 'EOI'
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     kind: TokenKind
     data: int | bool | str | None
@@ -39,198 +47,563 @@ class Token:
         self.data = data
 
 
-def tokenize(input: str) -> list[Token]:
-    ret = []
+KEYWORDS: dict[str, Token] = {
+    'let': Token(TokenKind.Let),
+    'rec': Token(TokenKind.Rec),
+    'in': Token(TokenKind.In),
+    'if': Token(TokenKind.If),
+    'then': Token(TokenKind.Then),
+    'else': Token(TokenKind.Else),
+    'return': Token(TokenKind.Return),
+    'true': Token(TokenKind.Boolean, True),
+    'false': Token(TokenKind.Boolean, False),
+}
 
-    index = 0
-    while index < len(input):
-        index = skip_whitespace(index, input)
-        if index == len(input):
-            break
-        ch = input[index]
-        if ch.isdigit():
-            start = index
-            while index < len(input) and input[index].isdigit():
-                index += 1
-            ret.append(Token(TokenKind.Int, int(input[start:index])))
-        elif ch == '"':
-            index += 1
-            start = index
-            while index < len(input) and input[index] != '"':
-                index += 1
-            ret.append(Token(TokenKind.String, input[start:index]))
-            index += 1
-        elif ch.isalpha():
-            index, token = tokenize_ident_or_keyword(index, input)
-            ret.append(token)
-        elif ch == '\\':
-            ret.append(Token(TokenKind.Backslash))
-            index += 1
-        elif ch == '.':
-            ret.append(Token(TokenKind.Dot))
-            index += 1
-        elif ch == ',':
-            ret.append(Token(TokenKind.Comma))
-            index += 1
-        elif ch == ';':
-            ret.append(Token(TokenKind.Semicolon))
-            index += 1
-        elif ch == '(':
-            ret.append(Token(TokenKind.LParen))
-            index += 1
-        elif ch == ')':
-            ret.append(Token(TokenKind.RParen))
-            index += 1
-        elif ch == '=':
-            ret.append(Token(TokenKind.Eq))
-            index += 1
-        else:
-            raise Exception(f'未知字符：{ch}')
+
+PUNCTUATIONS: dict[str, Token] = {
+    '\\': Token(TokenKind.Backslash),
+    '.': Token(TokenKind.Dot),
+    ',': Token(TokenKind.Comma),
+    ';': Token(TokenKind.Semicolon),
+    '(': Token(TokenKind.LParen),
+    ')': Token(TokenKind.RParen),
+    '=': Token(TokenKind.Eq),
+}
+
+
+# 每次匹配跳过前导空白，取出一个 Token 的原文：整数、标识符或关键字、字符串、标点，
+# 或是其他任意一个非空白字符（未知字符，留给 make_token 报错）。未闭合的字符串会一直匹配到输入末尾
+TOKEN_REGEX = re.compile(r'\s*(\d+|[^\W\d_][^\W_]*|"[^"]*"?|[\\.,;()=]|\S)')
+
+
+def line_col(input: str, offset: int) -> tuple[int, int]:
+    line = input.count('\n', 0, offset) + 1
+    col = offset - input.rfind('\n', 0, offset)
+    return line, col
+
+
+# 原文到 Token 的表：第一次遇到的原文才调用 make_token，之后同样的原文都得到同一个对象
+class InternTable(dict[str, Token]):
+    input: str
+
+    def __init__(self, input: str):
+        super().__init__(KEYWORDS)
+        self.update(PUNCTUATIONS)
+        self.input = input
+
+    def __missing__(self, text: str) -> Token:
+        token = make_token(text)
+        if token is None:
+            raise lex_error(self.input, text)
+        self[text] = token
+        return token
+
+
+# 最快的词法分析：Token 不带位置，parse(tokenize(...)) 得到的表达式的位置都是 -1。
+# 类型错误因此没有 span，错误信息的每一层显示整个表达式，代价与表达式的大小成正比（见 diagnostic.py）。
+# 需要位置信息（错误信息中的行列号、incremental 中按源代码比较绑定）时使用 tokenize_compact，
+# 其位置按字符（Unicode 码点）计，不是字节偏移。
+# 相同原文的 Token 是同一个对象，因此大部分 Token 只需要一次字典查找，并且查找是在 map 中完成的
+def tokenize(input: str) -> list[Token]:
+    ret = list(map(InternTable(input).__getitem__, TOKEN_REGEX.findall(input)))
     ret.append(Token(TokenKind.EOI))
     return ret
 
 
-def skip_whitespace(index: int, input: str) -> int:
-    while index < len(input) and input[index].isspace():
-        index += 1
-    return index
-
-
-def tokenize_ident_or_keyword(index: int, input: str) -> tuple[int, Token]:
-    start = index
-    while index < len(input) and input[index].isalnum():
-        index += 1
-    ident = input[start:index]
-    if ident == 'true' or ident == 'false':
-        return index, Token(TokenKind.Boolean, ident == 'true')
-    elif ident == 'let':
-        return index, Token(TokenKind.Let)
-    elif ident == 'rec':
-        return index, Token(TokenKind.Rec)
-    elif ident == 'in':
-        return index, Token(TokenKind.In)
-    elif ident == 'if':
-        return index, Token(TokenKind.If)
-    elif ident == 'then':
-        return index, Token(TokenKind.Then)
-    elif ident == 'else':
-        return index, Token(TokenKind.Else)
-    elif ident == 'return':
-        return index, Token(TokenKind.Return)
-    else:
-        return index, Token(TokenKind.Ident, ident)
-
-
-def parse(tokens: list[Token]) -> Expr:
-    return parse_expr(tokens, 0)[0]
-
-
-def parse_expr(tokens: list[Token], index: int) -> tuple[Expr, int]:
-    e1, index = parse_simple_expr(tokens, index)
-    if tokens[index].kind == TokenKind.Semicolon:
-        e2, index = parse_expr(tokens, index + 1)
-        if isinstance(e2, ExprStmt):
-            return ExprStmt([e1] + e2.stmts), index
+# 从文件对象（文本或二进制文件、mmap 等任何提供 read 方法的对象）中逐块读取输入并产生 Token，
+# 不需要把整个输入或者全部 Token 同时放在内存中。调用方停止读取时，剩余的输入也就不会再被分析。
+# 只有标识符会被合并，并且合并表的大小有上限，所以输入中有大量不同的名字或字面量时占用的内存也是有限的。
+#
+# 如果提供了 spans，每产生一个 Token 之前，先把它在输入中的范围 (start, end) 追加到 spans 末尾，
+# 解析器可以从 spans 的开头依次取出（见 parse）
+def tokenize_stream(input: str | IO[str] | IO[bytes] | mmap.mmap,
+                    chunk_size: int = 65536,
+                    spans: deque[tuple[int, int]] | None = None) -> Iterator[Token]:
+    interned: dict[str, Token] = {**KEYWORDS, **PUNCTUATIONS}
+    get = interned.get
+
+    # 出错时用来计算行列号：base_line 和 base_col 是当前缓冲区开头在输入中的位置，base_offset 是它的偏移
+    base_line, base_col, base_offset = 1, 1, 0
+    # 可能被截断的最后一个 Token，以及之后读到的、仍然没有让它结束的输入块
+    pending: list[str] = []
+    rest: re.Pattern[str] | None = None
+    bounds: list[int] = []
+    for (chunk, last) in read_chunks(input, chunk_size):
+        # 只在新读到的输入块中寻找被截断的 Token 的结尾，找到之前不重新分析已经读到的部分
+        if rest is not None and not last and rest.match(chunk).end() == len(chunk):
+            pending.append(chunk)
+            continue
+        pending.append(chunk)
+        buffer = ''.join(pending)
+        if spans is None:
+            texts = TOKEN_REGEX.findall(buffer)
         else:
-            return ExprStmt([e1, e2]), index
-    else:
-        try:
-            e2, index = parse_expr(tokens, index)
-            return ExprApp(e1, e2), index
-        except Exception:
-            return e1, index
-
-
-def parse_simple_expr(tokens: list[Token], index: int) -> tuple[Expr, int]:
-    cur = tokens[index]
-    if cur.kind == TokenKind.EOI:
-        raise Exception('解析到末尾')
-
-    if cur.kind == TokenKind.Int:
-        assert isinstance(cur.data, int)
-        return ExprLitInt(cur.data), index + 1
-    elif cur.kind == TokenKind.Boolean:
-        assert isinstance(cur.data, bool)
-        return ExprLitBool(cur.data), index + 1
-    elif cur.kind == TokenKind.String:
-        assert isinstance(cur.data, str)
-        return ExprLitStr(cur.data), index + 1
-    elif cur.kind == TokenKind.Ident:
-        assert isinstance(cur.data, str)
-        return ExprVar(cur.data), index + 1
-    elif cur.kind == TokenKind.Backslash:
-        assert tokens[index + 1].kind == TokenKind.Ident
-        var_name = tokens[index + 1].data
-        assert isinstance(var_name, str)
-
-        assert tokens[index + 2].kind == TokenKind.Dot
-
-        e1, index = parse_expr(tokens, index + 3)
-        return ExprAbs(var_name, e1), index
-    elif cur.kind == TokenKind.LParen:
-        e1, index = parse_expr(tokens, index + 1)
-        assert tokens[index].kind == TokenKind.RParen
-        return e1, index + 1
-    elif cur.kind == TokenKind.Let:
-        if tokens[index + 1].kind == TokenKind.Rec:
-            return parse_let_rec(tokens, index + 2)
+            matches = TOKEN_REGEX_WITH_SPACE.findall(buffer)
+            texts = [text for (_, text) in matches]
+            # 第 i 个 Token 的范围是 bounds[2i + 1] 到 bounds[2i + 2]
+            bounds = list(accumulate(map(len, chain.from_iterable(matches)), initial=base_offset))
+        # 如果最后一个 Token 紧贴着缓冲区末尾（或者是一个还没有闭合的字符串），
+        # 它可能被截断了，留到下一块输入到来时再分析
+        carry = ''
+        if not last and len(texts) > 0 and (not buffer[-1].isspace() or unterminated_string(texts[-1])):
+            carry = texts.pop()
+
+        for (idx, text) in enumerate(texts):
+            token = get(text)
+            if token is None:
+                token = make_token(text)
+                if token is None:
+                    raise lex_error(buffer, text, base_line, base_col)
+                if token.kind == TokenKind.Ident:
+                    if len(interned) >= STREAM_INTERN_LIMIT:
+                        interned = {**KEYWORDS, **PUNCTUATIONS}
+                        get = interned.get
+                    interned[text] = token
+            if spans is not None:
+                spans.append((bounds[2 * idx + 1], bounds[2 * idx + 2]))
+            yield token
+
+        consumed = len(buffer) - len(carry)
+        base_offset += consumed
+        newlines = buffer.count('\n', 0, consumed)
+        if newlines == 0:
+            base_col += consumed
         else:
-            return parse_let(tokens, index + 1)
-    elif cur.kind == TokenKind.If:
-        return parse_if(tokens, index + 1)
-    elif cur.kind == TokenKind.Return:
-        e1, index = parse_expr(tokens, index + 1)
-        if isinstance(e1, ExprVar) and e1.x == 'nothing':
-            return ExprReturn(None), index
+            base_line += newlines
+            base_col = consumed - buffer.rfind('\n', 0, consumed)
+        pending = [carry] if len(carry) > 0 else []
+        rest = token_rest(carry) if len(carry) > 0 else None
+
+    if spans is not None:
+        spans.append((base_offset, base_offset))
+    yield Token(TokenKind.EOI)
+
+
+# tokenize_stream 合并的标识符最多有多少个，超出时清空重新开始
+STREAM_INTERN_LIMIT = 4096
+
+# 被截断的 Token 在下一块输入中可能的延续部分：字符串直到引号之前，整数和标识符直到第一个不能出现在其中的字符之前
+STRING_REST = re.compile(r'[^"]*')
+INT_REST = re.compile(r'\d*')
+IDENT_REST = re.compile(r'[^\W_]*')
+NO_REST = re.compile(r'')
+
+
+def token_rest(text: str) -> re.Pattern[str]:
+    ch = text[0]
+    if ch == '"':
+        return STRING_REST if unterminated_string(text) else NO_REST
+    elif ch.isdecimal():
+        return INT_REST
+    elif ch.isalnum():
+        return IDENT_REST
+    return NO_REST
+
+
+def read_chunks(input: str | IO[str] | IO[bytes] | mmap.mmap, chunk_size: int) -> Iterator[tuple[str, bool]]:
+    if isinstance(input, str):
+        yield input, True
+        return
+
+    decoder = None
+    chunk = input.read(chunk_size)
+    while True:
+        next_chunk = input.read(chunk_size)
+        last = len(next_chunk) == 0
+        if isinstance(chunk, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            yield decoder.decode(chunk, final=last), last
         else:
-            return ExprReturn(e1), index
-    else:
-        raise Exception(f'未知 Token: {cur}')
+            yield chunk, last
+        if last:
+            return
+        chunk = next_chunk
 
 
-# let rec var1 = e1, var2 = e2, ..., varn = en in e
-def parse_let_rec(tokens: list[Token], index: int) -> tuple[Expr, int]:
-    bindings: list[tuple[str, Expr]] = []
-    while tokens[index].kind == TokenKind.Ident:
-        var_name = tokens[index].data
-        assert isinstance(var_name, str)
+def unterminated_string(text: str) -> bool:
+    return text[0] == '"' and (len(text) == 1 or text[-1] != '"')
 
-        assert tokens[index + 1].kind == TokenKind.Eq
-        e1, index = parse_expr(tokens, index + 2)
-        bindings.append((var_name, e1))
 
-        if tokens[index].kind == TokenKind.Comma:
-            index += 1
-        else:
+def make_token(text: str) -> Token | None:
+    ch = text[0]
+    if ch.isdecimal():
+        return Token(TokenKind.Int, int(text))
+    elif ch == '"':
+        if not unterminated_string(text):
+            return Token(TokenKind.String, text[1:-1])
+    elif ch.isalnum():
+        return Token(TokenKind.Ident, text)
+    return None
+
+
+# 出错的情况很少，这时再重新扫描一遍输入来确定出错的 Token 的位置
+def lex_error(input: str, text: str, base_line: int = 1, base_col: int = 1) -> Exception:
+    for m in TOKEN_REGEX.finditer(input):
+        if m.group(1) == text:
+            offset = m.start(1)
             break
+    line, col = line_col(input, offset)
+    if line == 1:
+        col += base_col - 1
+    line += base_line - 1
+
+    if text[0] == '"':
+        return Exception(f'第 {line} 行第 {col} 列：字符串没有结束')
+    return Exception(f'第 {line} 行第 {col} 列：未知字符：{text[0]}')
+
+
+# 带有位置信息的紧凑 Token 存储：相同的 Token 在 table 中只出现一次，
+# 每个 Token 只占用 ids（在 table 中的下标）、offsets 和 ends（在输入中的起止偏移）中的各一项
+class TokenStore:
+    table: list[Token]
+    ids: array
+    offsets: array
+    ends: array
+
+    def __init__(self, table: list[Token], ids: array, offsets: array, ends: array):
+        self.table = table
+        self.ids = ids
+        self.offsets = offsets
+        self.ends = ends
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index: int) -> Token:
+        return self.table[self.ids[index]]
+
+    def __iter__(self) -> Iterator[Token]:
+        return map(self.table.__getitem__, self.ids)
+
+    def spans(self) -> Iterator[tuple[int, int]]:
+        return zip(self.offsets, self.ends)
+
+
+# 和 TOKEN_REGEX 相同，只是把前导空白也作为一个分组，用来计算每个 Token 的偏移
+TOKEN_REGEX_WITH_SPACE = re.compile(r'(\s*)(\d+|[^\W\d_][^\W_]*|"[^"]*"?|[\\.,;()=]|\S)')
+
+
+# 相同原文的 Token 在 table 中只有一个，所以大部分 Token 只需要一次字典查找
+def tokenize_compact(input: str) -> TokenStore:
+    table: list[Token] = []
+    ids_of: dict[str, int] = {}
+    ids, offsets, ends = array('I'), array('I'), array('I')
+    # 逐个匹配，直接追加到数组中：先用 findall 得到全部 Token 的列表时，峰值内存是数组本身的十几倍
+    add_id, add_offset, add_end = ids.append, offsets.append, ends.append
+    get = ids_of.get
+    for match in TOKEN_REGEX.finditer(input):
+        text = match.group(1)
+        id = get(text)
+        if id is None:
+            token = KEYWORDS.get(text) or PUNCTUATIONS.get(text) or make_token(text)
+            if token is None:
+                raise lex_error(input, text)
+            table.append(token)
+            id = ids_of[text] = len(table) - 1
+        add_id(id)
+        start, end = match.span(1)
+        add_offset(start)
+        add_end(end)
+    table.append(Token(TokenKind.EOI))
+    add_id(len(table) - 1)
+    add_offset(len(input))
+    add_end(len(input))
+    return TokenStore(table, ids, offsets, ends)
+
+
+# 解析器使用的 Token 游标：只向后看一个 Token，Token 可以来自列表、TokenStore，
+# 也可以来自 tokenize_stream 这样的生成器。
+#
+# spans 依次给出每个 Token 的起止偏移，可以是和 Token 一一对应的可迭代对象，
+# 也可以是 tokenize_stream 正在填充的 deque。没有位置信息时所有偏移都是 -1。
+# start 和 end 是当前 Token 的范围，last_end 是上一个已经读取的 Token 的结束偏移
+class TokenStream:
+    cur: Token
+    start: int
+    end: int
+    last_end: int
+
+    def __init__(self, tokens: Iterable[Token], spans: Iterable[tuple[int, int]] | None = None):
+        self.next_token = iter(tokens).__next__
+        self.cur = self.next_token()
+        self.start, self.end, self.last_end = -1, -1, -1
+        if spans is None:
+            # 没有位置信息时不需要维护偏移
+            self.advance = self.advance_without_spans
+            return
+        if isinstance(spans, deque):
+            self.next_span = spans.popleft
+        else:
+            self.next_span = iter(spans).__next__
+        self.start, self.end = self.next_span()
+
+    def advance(self) -> Token:
+        ret = self.cur
+        if ret.kind != TokenKind.EOI:
+            self.last_end = self.end
+            self.cur = self.next_token()
+            self.start, self.end = self.next_span()
+        return ret
+
+    def advance_without_spans(self) -> Token:
+        ret = self.cur
+        if ret.kind != TokenKind.EOI:
+            self.cur = self.next_token()
+        return ret
+
+
+# 解析器通过构造器创建表达式：构造器的方法和 syntax.py 中各种表达式的构造函数接受相同的参数（位置在最后），
+# 另外还要能读取和修改表达式的位置。ExprBuilder 创建 syntax.py 中的表达式，
+# 其他构造器可以把表达式存放在别的结构中，例如 arena.py 中的 ArenaBuilder
+class ExprBuilder:
+    lit_int = ExprLitInt
+    lit_bool = ExprLitBool
+    lit_str = ExprLitStr
+    var = ExprVar
+    abs = ExprAbs
+    app = ExprApp
+    let = ExprLet
+    stmt = ExprStmt
+    ret = ExprReturn
+    if_ = ExprIf
+    let_rec = ExprLetRec
+
+    start = staticmethod(attrgetter('start'))
+    end = staticmethod(attrgetter('end'))
+
+    @staticmethod
+    def set_span(expr: Expr, start: int, end: int):
+        expr.start = start
+        expr.end = end
+
+    # return nothing 表示不带返回值的 return
+    @staticmethod
+    def is_nothing(expr: Expr) -> bool:
+        return isinstance(expr, ExprVar) and expr.x == 'nothing'
+
+
+EXPR_BUILDER = ExprBuilder()
+
+
+# 从 TokenStore 解析时自动使用其中的位置信息
+def parse(tokens: Iterable[Token], spans: Iterable[tuple[int, int]] | None = None, builder: Any = EXPR_BUILDER) -> Any:
+    if spans is None and isinstance(tokens, TokenStore):
+        spans = tokens.spans()
+    return parse_expr(TokenStream(tokens, spans), builder)
+
+
+# 可以作为简单表达式开头的 Token，用来判断函数应用是否还能继续向右延伸
+SIMPLE_EXPR_START = frozenset([
+    TokenKind.Int,
+    TokenKind.Boolean,
+    TokenKind.String,
+    TokenKind.Ident,
+    TokenKind.Backslash,
+    TokenKind.LParen,
+    TokenKind.Let,
+    TokenKind.If,
+    TokenKind.Return,
+])
+
+
+# 解析栈上的帧：表示尚未构造完成的外层结构，start 是这个结构的第一个 Token 的起始偏移。
+# 其中的表达式是构造器创建的
+@dataclass
+class ParenFrame:
+    start: int
 
-    assert tokens[index].kind == TokenKind.In
-    e, index = parse_expr(tokens, index + 1)
 
-    return ExprLetRec(bindings, e), index
+@dataclass
+class AbsFrame:
+    start: int
+    x: str
 
 
-# let var = e1 in e2
-def parse_let(tokens: list[Token], index: int) -> tuple[Expr, int]:
-    assert tokens[index].kind == TokenKind.Ident
-    var_name = tokens[index].data
-    assert isinstance(var_name, str)
+@dataclass
+class LetFrame:
+    start: int
+    x: str
+    e1: Any
 
-    assert tokens[index + 1].kind == TokenKind.Eq
-    e1, index = parse_expr(tokens, index + 2)
 
-    assert tokens[index].kind == TokenKind.In
-    e2, index = parse_expr(tokens, index + 1)
+@dataclass
+class LetRecFrame:
+    start: int
+    bindings: list[tuple[str, Any]]
+    name: str | None
 
-    return ExprLet(var_name, e1, e2), index
 
+@dataclass
+class IfFrame:
+    start: int
+    e1: Any
+    e2: Any
 
-# if e1 then e2 else e3
-def parse_if(tokens: list[Token], index: int) -> tuple[Expr, int]:
-    e1, index = parse_expr(tokens, index)
-    assert tokens[index].kind == TokenKind.Then
-    e2, index = parse_expr(tokens, index + 1)
-    assert tokens[index].kind == TokenKind.Else
-    e3, index = parse_expr(tokens, index + 1)
 
-    return ExprIf(e1, e2, e3), index
+@dataclass
+class ReturnFrame:
+    start: int
+
+
+def expect(ts: TokenStream, kind: TokenKind):
+    if ts.cur.kind != kind:
+        raise Exception(f'期望 {kind.value}，但遇到了 {ts.cur}')
+    ts.advance()
+
+
+def expect_ident(ts: TokenStream) -> str:
+    cur = ts.cur
+    if cur.kind != TokenKind.Ident:
+        raise Exception(f'期望标识符，但遇到了 {cur}')
+    assert isinstance(cur.data, str)
+    ts.advance()
+    return cur.data
+
+
+# expr := app (';' app)*
+# app  := simple simple*
+#
+# 用显式的栈代替递归下降：函数应用和语句序列都按循环处理，let / λ / if 等嵌套结构压栈，
+# 因此解析时的 Python 调用栈深度与输入无关，也不依赖异常回溯。
+#
+# stmts 和 head 是正在解析的表达式中已经完成的语句和当前函数应用的左侧部分，
+# 进入嵌套结构时和对应的帧一起压栈保存
+def parse_expr(ts: TokenStream, builder: Any = EXPR_BUILDER) -> Any:
+    stack: list[tuple[object, list[Any] | None, Any]] = []
+    stmts: list[Any] | None = None
+    head: Any = None
+    advance = ts.advance
+    make_var, make_app = builder.var, builder.app
+    start_of, end_of = builder.start, builder.end
+    while True:
+        cur = ts.cur
+        kind = cur.kind
+        if kind == TokenKind.Ident:
+            assert isinstance(cur.data, str)
+            value = make_var(cur.data, ts.start, ts.end)
+            advance()
+        elif kind in SIMPLE_EXPR_START:
+            start = ts.start
+            if kind == TokenKind.Int:
+                assert isinstance(cur.data, int)
+                value = builder.lit_int(cur.data, start, ts.end)
+                advance()
+            elif kind == TokenKind.Boolean:
+                assert isinstance(cur.data, bool)
+                value = builder.lit_bool(cur.data, start, ts.end)
+                advance()
+            elif kind == TokenKind.String:
+                assert isinstance(cur.data, str)
+                value = builder.lit_str(cur.data, start, ts.end)
+                advance()
+            else:
+                # 进入一个嵌套结构，开始解析其中的表达式
+                if kind == TokenKind.LParen:
+                    frame = ParenFrame(start)
+                    advance()
+                elif kind == TokenKind.Backslash:
+                    advance()
+                    var_name = expect_ident(ts)
+                    expect(ts, TokenKind.Dot)
+                    frame = AbsFrame(start, var_name)
+                elif kind == TokenKind.Let:
+                    advance()
+                    if ts.cur.kind == TokenKind.Rec:
+                        # let rec var1 = e1, var2 = e2, ..., varn = en in e
+                        advance()
+                        var_name = expect_ident(ts)
+                        expect(ts, TokenKind.Eq)
+                        frame = LetRecFrame(start, [], var_name)
+                    else:
+                        # let var = e1 in e2
+                        var_name = expect_ident(ts)
+                        expect(ts, TokenKind.Eq)
+                        frame = LetFrame(start, var_name, None)
+                elif kind == TokenKind.If:
+                    # if e1 then e2 else e3
+                    frame = IfFrame(start, None, None)
+                    advance()
+                else:
+                    frame = ReturnFrame(start)
+                    advance()
+                stack.append((frame, stmts, head))
+                stmts = None
+                head = None
+                continue
+        else:
+            # 当前的函数应用到此结束
+            if head is None:
+                if kind == TokenKind.EOI:
+                    raise Exception('解析到末尾')
+                raise Exception(f'未知 Token: {cur}')
+            if kind == TokenKind.Semicolon:
+                if stmts is None:
+                    stmts = []
+                stmts.append(head)
+                head = None
+                advance()
+                continue
+
+            # 当前的表达式到此结束，交给外层结构
+            if stmts is None:
+                value = head
+            else:
+                stmts.append(head)
+                value = builder.stmt(stmts, start_of(stmts[0]), end_of(head))
+            if len(stack) == 0:
+                return value
+
+            frame, stmts, head = stack.pop()
+            if isinstance(frame, ParenFrame):
+                expect(ts, TokenKind.RParen)
+                # 括号中的表达式的范围包括括号本身
+                builder.set_span(value, frame.start, ts.last_end)
+            elif isinstance(frame, AbsFrame):
+                value = builder.abs(frame.x, value, frame.start, end_of(value))
+            elif isinstance(frame, LetFrame):
+                if frame.e1 is None:
+                    expect(ts, TokenKind.In)
+                    frame.e1 = value
+                    stack.append((frame, stmts, head))
+                    stmts = None
+                    head = None
+                    continue
+                value = builder.let(frame.x, frame.e1, value, frame.start, end_of(value))
+            elif isinstance(frame, LetRecFrame):
+                if frame.name is not None:
+                    frame.bindings.append((frame.name, value))
+                    if ts.cur.kind == TokenKind.Comma:
+                        advance()
+                        frame.name = expect_ident(ts)
+                        expect(ts, TokenKind.Eq)
+                    else:
+                        expect(ts, TokenKind.In)
+                        frame.name = None
+                    stack.append((frame, stmts, head))
+                    stmts = None
+                    head = None
+                    continue
+                value = builder.let_rec(frame.bindings, value, frame.start, end_of(value))
+            elif isinstance(frame, IfFrame):
+                if frame.e1 is None or frame.e2 is None:
+                    if frame.e1 is None:
+                        expect(ts, TokenKind.Then)
+                        frame.e1 = value
+                    else:
+                        expect(ts, TokenKind.Else)
+                        frame.e2 = value
+                    stack.append((frame, stmts, head))
+                    stmts = None
+                    head = None
+                    continue
+                value = builder.if_(frame.e1, frame.e2, value, frame.start, end_of(value))
+            else:
+                assert isinstance(frame, ReturnFrame)
+                if builder.is_nothing(value):
+                    value = builder.ret(None, frame.start, end_of(value))
+                else:
+                    value = builder.ret(value, frame.start, end_of(value))
+
+        # 解析出了一个完整的简单表达式，接到当前函数应用的右侧（左结合）
+        head = value if head is None else make_app(head, value, start_of(head), end_of(value))
@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
 from __future__ import annotations
+import threading
 from abc import abstractmethod
+from contextlib import nullcontext
 from dataclasses import dataclass
+from typing import ContextManager, Generator, Iterable
+from weakref import WeakValueDictionary
 
-from syntax import Expr, ExprLitInt, ExprLitBool, ExprVar, ExprAbs, ExprApp, ExprLet
+from syntax import Expr, ExprLitInt, ExprLitBool, ExprLitStr, ExprVar, ExprAbs, ExprApp, ExprLet, ExprStmt, ExprReturn, ExprIf, ExprLetRec
 from ghaik import Greek
+from hamt import PersistentMap
+from diagnostic import Frame, FrameKind, TyckException, UnsupportedSyntax
+from printer import Printer, print_scheme, print_type, to_string
+from trampoline import trampoline
 
 class Type:
+    __slots__ = ()
+
     @abstractmethod
     def contains_type_var(self, type_var: TypeVar) -> bool:
         pass
@@ -27,24 +37,75 @@ class Type:
     def need_quote(self) -> bool:
         return False
 
+    def pretty(self, p: Printer):
+        print_type(p, self)
+
+
+# 一次类型检查的上下文，负责分配新的类型变量。类型变量的 id 从 0 开始连续分配，用于比较和哈希；
+# 希腊字母和 timestamp 只用于显示，每个字母各自从 0 开始编号。
+#
+# 每个线程有自己的当前上下文（current_context），with InferContext() 在代码块中换用一个新的上下文，
+# 这样每个程序都可以从空白的状态开始检查，多个线程也可以同时检查不同的程序。
+# 线程默认的上下文从不被重置，所以 infer 等入口在没有进入任何上下文时使用一个新的上下文（见 entry_context），
+# 每次检查的类型变量都从 0 开始编号，结果不取决于之前检查过哪些程序
+class InferContext:
+    next_id: int
+    timestamps: list[int]
+    saved: list[InferContext]
+
+    def __init__(self):
+        self.next_id = 0
+        self.timestamps = [0] * len(Greek)
+        self.saved = []
+
+    def __enter__(self) -> InferContext:
+        self.saved.append(current_context())
+        local_context.value = self
+        return self
+
+    def __exit__(self, *exc_info):
+        local_context.value = self.saved.pop()
+
+    def fresh_id(self) -> int:
+        ret = self.next_id
+        self.next_id = ret + 1
+        return ret
+
+    def next_timestamp(self, greek: Greek) -> int:
+        ret = self.timestamps[greek.ordinal]
+        self.timestamps[greek.ordinal] = ret + 1
+        return ret
+
+
+local_context = threading.local()
 
-global_timestamp: dict[Greek, int] = {}
+
+def current_context() -> InferContext:
+    try:
+        return local_context.value
+    except AttributeError:
+        local_context.value = local_context.default = InferContext()
+        return local_context.value
+
+
+# 推导的入口使用的上下文：已经用 with 进入了某个上下文时沿用它，否则换用一个新的上下文
+def entry_context() -> ContextManager[object]:
+    if current_context() is local_context.default:
+        return InferContext()
+    return nullcontext()
 
 
 @dataclass
 class TypeVar(Type):
     greek: Greek
     timestamp: int | None
+    id: int
 
     def __init__(self, greek: Greek):
-        global global_timestamp
+        context = current_context()
         self.greek = greek
-        if self.greek in global_timestamp:
-            self.timestamp = global_timestamp[self.greek]
-            global_timestamp[self.greek] += 1
-        else:
-            self.timestamp = 0
-            global_timestamp[self.greek] = 1
+        self.timestamp = context.next_timestamp(greek)
+        self.id = context.fresh_id()
 
     def __str__(self) -> str:
         if self.timestamp is not None:
@@ -54,11 +115,11 @@ class TypeVar(Type):
 
     def __eq__(self, value: object) -> bool:
         if isinstance(value, TypeVar):
-            return self.greek == value.greek and self.timestamp == value.timestamp
+            return self.id == value.id
         return False
 
     def __hash__(self) -> int:
-        return hash(self.greek) + hash(self.timestamp) if self.timestamp is not None else 0
+        return self.id
 
     def fresh(self) -> TypeVar:
         return TypeVar(self.greek)
@@ -73,76 +134,131 @@ class TypeVar(Type):
         return free.get(self, self)
 
     def apply_subst(self, subst: Subst) -> Type:
-        return subst.mapping.get(self, self)
+        return subst.apply_type_var(self)
 
 
-@dataclass
+# 类型算子是不可变的。不含类型变量的类型算子（ground 为真）经过散列合并（hash consing）：
+# 运算符和参数都相同的只有一个实例，各处的签名共享同一份结构，这样的类型在实例化和应用替换时可以原样返回。
+# 含有类型变量的类型算子大多来自刚刚实例化出的新类型变量，几乎不会重复，所以不放进表中，只预先算好哈希值
 class TypeOp(Type):
+    __slots__ = ('op', 'args', 'hash', 'ground', 'free_vars', '__weakref__')
     op: str
-    args: list[Type]
+    args: tuple[Type, ...]
+    hash: int
+    ground: bool
+    free_vars: frozenset[TypeVar] | None
+
+    def __new__(cls, op: str, args: Iterable[Type]) -> TypeOp:
+        args = tuple(args)
+        ground = True
+        for arg in args:
+            if not (isinstance(arg, TypeOp) and arg.ground):
+                ground = False
+                break
+        key = (op, args)
+        if ground:
+            ret = type_op_table.get(key)
+            if ret is not None:
+                return ret
+        ret = super().__new__(cls)
+        ret.op = op
+        ret.args = args
+        ret.hash = hash(key)
+        ret.ground = ground
+        ret.free_vars = EMPTY_TYPE_VARS if ground else None
+        if ground:
+            type_op_table[key] = ret
+        return ret
 
-    def __str__(self) -> str:
-        if self.op == 'unit':
-            return '()'
+    def __hash__(self) -> int:
+        return self.hash
 
-        if len(self.args) == 0:
-            return self.op
+    def __repr__(self) -> str:
+        return f'TypeOp({self.op!r}, {self.args!r})'
 
-        ret = ''
-        if self.op == '*' or self.op == '->':
-            for (idx, arg) in enumerate(self.args):
-                if arg.need_quote():
-                    ret += '(' + str(arg) + ')'
-                else:
-                    ret += str(arg)
-                if idx != len(self.args) - 1:
-                    ret += ' × ' if self.op == '*' else '→'
-        else:
-            ret += self.op
-            for (idx, arg) in enumerate(self.args):
-                if arg.need_quote():
-                    ret += '(' + str(arg) + ')'
-                else:
-                    ret += str(arg)
-                if idx != len(self.args) - 1:
-                    ret += ' '
-        return ret
+    def __str__(self) -> str:
+        return to_string(self)
 
     def contains_type_var(self, type_var: TypeVar) -> bool:
-        for arg in self.args:
-            if arg.contains_type_var(type_var):
-                return True
-        return False
+        return type_var in self.free_type_vars()
+
+    # 类型算子是不可变的，其中的自由类型变量也不会改变，所以在第一次需要时计算并缓存下来，
+    # 之后对同一个类型（以及它作为其他类型的一部分时）做出现检查就不需要再遍历。
+    # 用显式的栈自底向上计算，类型很深时也不会递归过深
+    def free_type_vars(self) -> frozenset[TypeVar]:
+        stack: list[TypeOp] = [self]
+        while len(stack) > 0:
+            t = stack[-1]
+            if t.free_vars is not None:
+                stack.pop()
+                continue
+            pending = [arg for arg in t.args if isinstance(arg, TypeOp) and arg.free_vars is None]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            free: set[TypeVar] = set()
+            for arg in t.args:
+                if isinstance(arg, TypeVar):
+                    free.add(arg)
+                else:
+                    assert isinstance(arg, TypeOp) and arg.free_vars is not None
+                    free.update(arg.free_vars)
+            t.free_vars = frozenset(free)
+        assert self.free_vars is not None
+        return self.free_vars
 
     def collect_type_vars(self, dst: list[TypeVar]):
-        for arg in self.args:
-            arg.collect_type_vars(dst)
+        visited: set[TypeOp] = set()
+        stack: list[Type] = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            if isinstance(t, TypeVar):
+                dst.append(t)
+            else:
+                assert isinstance(t, TypeOp)
+                if not t.ground and t not in visited:
+                    visited.add(t)
+                    stack.extend(reversed(t.args))
 
     def instantiate(self, free: dict[TypeVar, TypeVar]) -> Type:
-        if len(self.args) == 0:
+        if self.ground:
             return self
         return TypeOp(self.op, [arg.instantiate(free) for arg in self.args])
 
+    # 参数都没有变化时返回自身，这样类型方案在应用替换之后仍然是同一个对象，可以继续使用编译好的实例化模板
     def apply_subst(self, subst: Subst) -> Type:
-        if len(self.args) == 0:
+        if self.ground or len(subst.mapping) == 0:
             return self
-        return TypeOp(self.op, [arg.apply_subst(subst) for arg in self.args])
+        ret = subst.cache.get(self)
+        if ret is None:
+            args = [arg.apply_subst(subst) for arg in self.args]
+            if all(arg is old for (arg, old) in zip(args, self.args)):
+                ret = self
+            else:
+                ret = TypeOp(self.op, args)
+            subst.cache[self] = ret
+        return ret
 
     def need_quote(self) -> bool:
         return len(self.args) > 0
 
 
+EMPTY_TYPE_VARS: frozenset[TypeVar] = frozenset()
+type_op_table: WeakValueDictionary[tuple[str, tuple[Type, ...]], TypeOp] = WeakValueDictionary()
+
+
 def product_type(*types: Type) -> TypeOp:
-    return TypeOp('*', list(types))
+    return TypeOp('*', types)
 
 
 def fn_type(arg_type: Type, ret_type: Type) -> TypeOp:
-    return TypeOp('->', [arg_type, ret_type])
+    return TypeOp('->', (arg_type, ret_type))
 
 
-UnitType = TypeOp('unit', [])
-IntType = TypeOp('int', [])
-BoolType = TypeOp('bool', [])
+UnitType = TypeOp('unit', ())
+IntType = TypeOp('int', ())
+BoolType = TypeOp('bool', ())
 
 
 @dataclass
@@ -154,59 +270,114 @@ class TypeScheme:
         self.free = free
         self.ty = ty
         self.free_accel = set(free)
+        self.template = None
 
     def __str__(self) -> str:
-        if len(self.free) == 0:
-            return str(self.ty)
+        return to_string(self)
 
-        ret = ''
-        for item in self.free:
-            ret += '∀' + str(item)
-        ret += '. ' + str(self.ty)
-        return ret
+    def pretty(self, p: Printer):
+        print_scheme(p, self.free, self.ty)
 
+    # 没有被泛化的类型变量时直接返回共享的类型；否则在第一次实例化时编译出模板，之后每次按照模板复制
     def instantiate(self) -> Type:
-        free = {}
-        for item in self.free:
-            free[item] = item.fresh()
-        return self.ty.instantiate(free)
-
-
+        if len(self.free) == 0:
+            return self.ty
+        template = self.template
+        if template is None:
+            template = self.template = compile_template(self.ty, self.free)
+        regs: list[Type] = [item.fresh() for item in self.free]
+        for (op, args) in template.ops:
+            regs.append(TypeOp(op, [regs[arg] if type(arg) is int else arg for arg in args]))
+        result = template.result
+        return regs[result] if type(result) is int else result
+
+
+# 类型方案的实例化模板。寄存器 0 到 k - 1 是 k 个被泛化的类型变量的新副本，
+# 之后依次是 ops 中每一项 (运算符, 参数) 构造出的类型算子；参数和 result 是寄存器的编号，或者直接共享的类型。
+# 不含被泛化的类型变量的子树原样共享，类型中共享的子树也只在模板中出现一次
+@dataclass(slots=True)
+class Template:
+    ops: list[tuple[str, tuple[int | Type, ...]]]
+    result: int | Type
+
+
+def compile_template(ty: Type, free: list[TypeVar]) -> Template:
+    regs: dict[Type, int | Type] = {item: idx for (idx, item) in enumerate(free)}
+    ops: list[tuple[str, tuple[int | Type, ...]]] = []
+    stack: list[Type] = [ty]
+    while len(stack) > 0:
+        t = stack[-1]
+        if t in regs:
+            stack.pop()
+            continue
+        if isinstance(t, TypeVar) or t.free_type_vars().isdisjoint(regs):
+            stack.pop()
+            regs[t] = t
+            continue
+        assert isinstance(t, TypeOp)
+        pending = [arg for arg in t.args if arg not in regs]
+        if len(pending) > 0:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        ops.append((t.op, tuple(regs[arg] for arg in t.args)))
+        regs[t] = len(free) + len(ops) - 1
+    return Template(ops, regs[ty])
+
+
+# 替换采用“三角形”的表示：mapping 中类型变量映射到的类型里可能还含有 mapping 中的其他类型变量，
+# 应用替换时才沿着这些绑定逐步展开，并把每个类型变量和类型算子应用替换的结果缓存在 cache 中。
+# mapping 是持久化的，替换一旦创建就不再改变，因此复合替换只需要加入新的绑定，也不会影响其他替换
 @dataclass
 class Subst:
-    mapping: dict[TypeVar, Type]
+    mapping: PersistentMap
+    cache: dict[Type, Type]
 
-    def __init__(self, mapping: dict[TypeVar, Type] = {}):
-        self.mapping = mapping
+    def __init__(self, mapping: PersistentMap | None = None):
+        self.mapping = mapping if mapping is not None else PersistentMap()
+        self.cache = {}
 
     def __str__(self) -> str:
-        ret = '{'
-        for (idx, tvar) in enumerate(self.mapping):
-            trep = self.mapping[tvar]
-            ret += f'{tvar}: {trep}'
-            if idx != len(self.mapping) - 1:
-                ret += ', '
-        ret += '}'
+        tvars = sorted(self.mapping, key=lambda tvar: (str(tvar.greek), tvar.timestamp))
+        return '{' + ', '.join(f'{tvar}: {tvar.apply_subst(self)}' for tvar in tvars) + '}'
+
+    def apply_type_var(self, tvar: TypeVar) -> Type:
+        if tvar in self.cache:
+            return self.cache[tvar]
+        trep = self.mapping.get(tvar)
+        if trep is None:
+            return tvar
+        # 先占位，防止（不应出现的）循环绑定导致无限展开
+        self.cache[tvar] = tvar
+        ret = trep.apply_subst(self)
+        self.cache[tvar] = ret
         return ret
 
 
+# 先应用 s1，再应用 s2。在算法 W 中，s2 是在已经应用了 s1 的类型上得到的，两者的定义域不相交，
+# 所以复合只需要求两个映射的并集。总是把较小的映射逐项加入较大的映射中（冲突时保留 s1 的绑定），
+# 代价只和较小的替换的大小有关
 def compose_subst(s1: Subst, s2: Subst) -> Subst:
-    for tvar in s1.mapping.keys():
-        trep = s1.mapping[tvar]
-        s1.mapping[tvar] = trep.apply_subst(s2)
-
-    for tvar in s2.mapping.keys():
-        if tvar not in s1.mapping:
-            s1.mapping[tvar] = s2.mapping[tvar]
-    return s1
-
-
-@dataclass
-class TyckException(Exception):
-    text: str
+    if len(s2.mapping) == 0:
+        return s1
+    if len(s1.mapping) == 0:
+        return s2
+    if len(s1.mapping) >= len(s2.mapping):
+        mapping = s1.mapping
+        for (tvar, trep) in s2.mapping.items():
+            if tvar not in mapping:
+                mapping = mapping.set(tvar, trep)
+    else:
+        mapping = s2.mapping
+        for (tvar, trep) in s1.mapping.items():
+            mapping = mapping.set(tvar, trep)
+    return Subst(mapping)
 
 
 def unify(t1: Type, t2: Type) -> Subst:
+    if t1 is t2:
+        return Subst()
+
     fresh_exception = False
     try:
         if isinstance(t1, TypeOp) and isinstance(t2, TypeOp):
@@ -217,25 +388,25 @@ def unify(t1: Type, t2: Type) -> Subst:
             return unify_type_var(t2, t1)
         else:
             fresh_exception = True
-            raise TyckException(f'错误：无法归一化类型 {t1} 和 {t2}')
+            raise TyckException('错误：无法归一化类型 {} 和 {}', t1, t2)
     except TyckException as e:
         if not fresh_exception:
-            e.text += f'\n  - 当归一化类型 {t1} 和 {t2} 时发生'
+            e.add_frame(Frame(FrameKind.Unify, t1=t1, t2=t2))
         raise e
 
 
 def unify_type_var(t1: TypeVar, t2: Type) -> Subst:
     if t2.contains_type_var(t1):
-        raise TyckException(f'错误：无法归一化类型变量 {t1} 和类型 {t2}：后者中存在对前者的引用，这是不允许的')
-    return Subst({ t1: t2 })
+        raise TyckException('错误：无法归一化类型变量 {} 和类型 {}：后者中存在对前者的引用，这是不允许的', t1, t2)
+    return Subst(PersistentMap().set(t1, t2))
 
 
 def unify_type_op(t1: TypeOp, t2: TypeOp) -> Subst:
     if t1.op != t2.op:
-        raise TyckException(f'错误：无法归一化类型算子 {t1} 和 {t2}（运算符不同）')
+        raise TyckException('错误：无法归一化类型算子 {} 和 {}（运算符不同）', t1, t2)
 
     if len(t1.args) != len(t2.args):
-        raise TyckException(f'错误：无法归一化类型算子 {t1} 和 {t2}（类型算子的参数数目不同）')
+        raise TyckException('错误：无法归一化类型算子 {} 和 {}（类型算子的参数数目不同）', t1, t2)
 
     s0 = Subst()
     for idx in range(0, len(t1.args)):
@@ -243,47 +414,67 @@ def unify_type_op(t1: TypeOp, t2: TypeOp) -> Subst:
             s1 = unify(t1.args[idx].apply_subst(s0), t2.args[idx].apply_subst(s0))
             s0 = compose_subst(s0, s1)
         except TyckException as e:
-            e.text += f'\n  - 当归一化类型算子的第 {idx + 1} 个参数（{t1.args[idx]} 和 {t2.args[idx]}）时发生'
-            e.text += f'\n    已分析的替换：{s0}'
+            e.add_frame(Frame(FrameKind.UnifyArg, t1=t1.args[idx], t2=t2.args[idx], arg_index=idx, subst=s0))
             raise e
     return s0
 
 
+# 类型环境是持久化的：内层作用域创建新的 TypeEnv，和外层共享 PersistentMap 的绝大部分结构。
+# 对环境应用替换时不重建整个环境，而是把替换记录在 subst 中，查找时才应用到被查找的绑定上。
+# free_type_vars 是绑定中（应用 subst 之前）出现的自由类型变量，用 PersistentMap 作为集合
 @dataclass
 class TypeEnv:
-    parent: TypeEnv | None
-    vars: dict[str, TypeScheme]
+    vars: PersistentMap
+    free_type_vars: PersistentMap
+    subst: Subst
 
     def __init__(self, parent: TypeEnv | None = None):
-        self.parent = parent
-        self.vars = {}
+        if parent is not None:
+            self.vars = parent.vars
+            self.free_type_vars = parent.free_type_vars
+            self.subst = parent.subst
+        else:
+            self.vars = PersistentMap()
+            self.free_type_vars = PersistentMap()
+            self.subst = Subst()
 
     def lookup(self, var_name: str) -> TypeScheme | None:
-        if var_name in self.vars:
-            return self.vars[var_name]
-
-        if self.parent is not None:
-            return self.parent.lookup(var_name)
+        scheme = self.vars.get(var_name)
+        if scheme is None or len(self.subst.mapping) == 0:
+            return scheme
+        ty = scheme.ty.apply_subst(self.subst)
+        if ty is scheme.ty:
+            return scheme
+        return TypeScheme(scheme.free, ty)
+
+    def bind(self, var_name: str, scheme: TypeScheme):
+        self.vars = self.vars.set(var_name, scheme)
+        type_vars: list[TypeVar] = []
+        scheme.ty.collect_type_vars(type_vars)
+        for type_var in type_vars:
+            if type_var not in scheme.free_accel:
+                self.free_type_vars = self.free_type_vars.set(type_var, None)
 
     def apply_subst(self, subst: Subst) -> TypeEnv:
-        ret = TypeEnv()
-        iter = self
-        while iter is not None:
-            for var_name in iter.vars:
-                var_scheme = iter.vars[var_name]
-                ret.vars[var_name] = TypeScheme(var_scheme.free, var_scheme.ty.apply_subst(subst))
-            iter = iter.parent
+        ret = TypeEnv(self)
+        ret.subst = compose_subst(self.subst, subst)
         return ret
 
     def collect_type_vars(self, dst: list[TypeVar]):
-        for var_scheme in self.vars.values():
-            var_scheme.ty.collect_type_vars(dst)
-        if self.parent is not None:
-            self.parent.collect_type_vars(dst)
+        for type_var in self.free_type_vars:
+            type_var.apply_subst(self.subst).collect_type_vars(dst)
 
 
 # 𝑊 :: 𝑇𝑦𝑝𝑒𝐸𝑛𝑣𝑖𝑟𝑜𝑛𝑚𝑒𝑛𝑡 × 𝐸𝑥𝑝𝑟𝑒𝑠𝑠𝑖𝑜𝑛 → 𝑆𝑢𝑏𝑠𝑡𝑖𝑡𝑢𝑡𝑖𝑜𝑛 × 𝑇𝑦𝑝𝑒
+WGenerator = Generator[tuple[TypeEnv, Expr], tuple[Subst, Type], tuple[Subst, Type]]
+
+
 def w(env: TypeEnv, expr: Expr) -> tuple[Subst, Type]:
+    return trampoline(w_step, env, expr)
+
+
+# w 的一步：字面量和变量直接得到结果，其余的表达式交给 w_node 创建的生成器
+def w_step(env: TypeEnv, expr: Expr) -> tuple[Subst, Type] | WGenerator:
     try:
         # Trivial cases (literals)
         if isinstance(expr, ExprLitInt):
@@ -296,16 +487,25 @@ def w(env: TypeEnv, expr: Expr) -> tuple[Subst, Type]:
             if scheme is not None:
                 return Subst(), scheme.instantiate()
             else:
-                raise TyckException(f'变量或函数 {expr.x} 尚未定义')
+                raise TyckException('变量或函数 {} 尚未定义', expr.x)
+    except TyckException as e:
+        e.add_frame(Frame(FrameKind.Expr, expr=expr))
+        raise e
+    return w_node(env, expr)
+
+
+# 推导子表达式时产生 (环境, 子表达式)，由 trampoline 推导之后把结果交还，见 trampoline.py
+def w_node(env: TypeEnv, expr: Expr) -> WGenerator:
+    try:
         # 𝑊(Γ, 𝜆𝑥 → 𝑒)
-        elif isinstance(expr, ExprAbs):
+        if isinstance(expr, ExprAbs):
             # fresh 𝛽
             beta = TypeVar(Greek.Beta)
             env1 = TypeEnv(env)
             # Γ' = Γ\𝑥 ∪ {𝑥 : 𝛽}
-            env1.vars[expr.x] = TypeScheme([], beta)
+            env1.bind(expr.x, TypeScheme([], beta))
             # 𝐥𝐞𝐭 (𝑆1, 𝜏1) = 𝑊(Γ', 𝑒)
-            s1, t1 = w(env1, expr.body)
+            s1, t1 = yield env1, expr.body
             # (𝑆1𝛽 → 𝜏1, 𝑆1)
             return s1, fn_type(beta.apply_subst(s1), t1)
         # 𝑊(Γ, 𝑒1𝑒2)
@@ -313,11 +513,11 @@ def w(env: TypeEnv, expr: Expr) -> tuple[Subst, Type]:
             # fresh 𝜋
             pi = TypeVar(Greek.Pi)
             # 𝐥𝐞𝐭 (𝑆1, 𝜏1) = 𝑊(Γ, 𝑒1)
-            s1, t1 = w(env, expr.e1)
+            s1, t1 = yield env, expr.e1
             # Γ' = 𝑆1Γ
             env1 = env.apply_subst(s1)
             # 𝐥𝐞𝐭 (𝑆2, 𝜏2) = 𝑊(Γ', 𝑒2)
-            s2, t2 = w(env, expr.e2)
+            s2, t2 = yield env1, expr.e2
             # 𝑆3 = 𝑢𝑛𝑖𝑓𝑦(𝑆2𝜏1, 𝜏2 → 𝜋)
             s3 = unify(t1.apply_subst(s2), fn_type(t2, pi))
             # (𝑆3 ∘ 𝑆2 ∘ 𝑆1, 𝑆3𝜋)
@@ -325,21 +525,21 @@ def w(env: TypeEnv, expr: Expr) -> tuple[Subst, Type]:
         # 𝑊(Γ, 𝐥𝐞𝐭 𝑥 = 𝑒1 𝐢𝐧 𝑒2)
         elif isinstance(expr, ExprLet):
             # 𝐥𝐞𝐭 (𝑆1, 𝜏1) = 𝑊(Γ, 𝑒1)
-            s1, t1 = w(env, expr.e1)
+            s1, t1 = yield env, expr.e1
             # Γ' = 𝑆1Γ
             env1 = env.apply_subst(s1)
             # scheme(𝑥) = 𝑔𝑒𝑛𝑒𝑟𝑎𝑙𝑖𝑧𝑒(Γ', 𝜏1)
             x_scheme = generalize(env1, t1)
             # Γ'' = 𝑆1Γ\x ∪ {𝑥 : scheme(𝑥)}
-            env2 = env1
-            env2.vars[expr.x] = x_scheme
+            env2 = TypeEnv(env1)
+            env2.bind(expr.x, x_scheme)
             # let(𝑆2, 𝜏2) = 𝑊(Γ'', 𝑒2)
-            s2, t2 = w(env2, expr.e2)
+            s2, t2 = yield env2, expr.e2
             return compose_subst(s1, s2), t2
         else:
-            raise Exception(f'表达式 {expr} 的类型未知')
+            raise UnsupportedSyntax(unsupported_syntax_name(expr), expr)
     except TyckException as e:
-        e.text += f'\n  - 当检查表达式 {expr} 时发生'
+        e.add_frame(Frame(FrameKind.Expr, expr=expr))
         raise e
 
 
@@ -351,59 +551,110 @@ def generalize(env: TypeEnv, t: Type) -> TypeScheme:
 
     type_vars_in_env_set: set[TypeVar] = set(type_vars_in_env)
     filtered_type_vars: list[TypeVar] = []
-    for type_var in set(type_vars):
+    for type_var in dict.fromkeys(type_vars):
         if type_var not in type_vars_in_env_set:
             filtered_type_vars.append(type_var)
 
     return TypeScheme(filtered_type_vars, t)
 
 
-def try_inference(expr: Expr):
+def default_env() -> TypeEnv:
     env = TypeEnv()
-    env.vars['square'] = TypeScheme([], fn_type(IntType, IntType))
+    env.bind('square', TypeScheme([], fn_type(IntType, IntType)))
+    return env
+
+
+# 算法 W 只实现了 λ 演算和 let：字面量（字符串除外）、变量、λ、应用和 let
+UNSUPPORTED_SYNTAX_NAMES: dict[type, str] = {
+    ExprLitStr: '字符串',
+    ExprStmt: '语句序列',
+    ExprReturn: 'return',
+    ExprIf: 'if',
+    ExprLetRec: 'let rec',
+}
+
+
+def unsupported_syntax_name(expr: Expr) -> str:
+    return UNSUPPORTED_SYNTAX_NAMES.get(type(expr), type(expr).__name__)
+
+
+# 在推导之前检查整个程序，使用了不支持的语法时抛出 UnsupportedSyntax，
+# 这样结果不取决于推导先遇到类型错误还是先遇到不支持的语法
+def check_supported(expr: Expr):
+    stack: list[Expr] = [expr]
+    while len(stack) > 0:
+        e = stack.pop()
+        if isinstance(e, ExprLitInt) or isinstance(e, ExprLitBool) or isinstance(e, ExprVar):
+            pass
+        elif isinstance(e, ExprAbs):
+            stack.append(e.body)
+        elif isinstance(e, ExprApp):
+            stack.append(e.e2)
+            stack.append(e.e1)
+        elif isinstance(e, ExprLet):
+            stack.append(e.e2)
+            stack.append(e.e1)
+        else:
+            raise UnsupportedSyntax(unsupported_syntax_name(e), e)
 
-    print(f'w(Γ, {expr})')
-    try:
-        s, t = w(env, expr)
-        t_scheme = generalize(env, t)
-        print(f'=> t = {t_scheme}, S = {s}')
-    except TyckException as e:
-        print(f'=> {e.text}')
-
-
-# 成功：let id = \x. x in (id square) (id 5)
-try_inference(ExprLet(
-    'id', ExprAbs('x', ExprVar('x')),
-    ExprApp(ExprApp(ExprVar('id'), ExprVar('square')), ExprApp(ExprVar('id'), ExprLitInt(5)))
-))
-print('------\n')
-
-# 成功：let id = \x. x in (id id) (id id)
-try_inference(ExprLet(
-    'id', ExprAbs('x', ExprVar('x')),
-    ExprApp(ExprApp(ExprVar('id'), ExprVar('id')), ExprApp(ExprVar('id'), ExprVar('id')))
-))
-print('------\n')
-
-# 失败，因为存在无限类型：let id = \x. x in (\f. f f) id
-try_inference(ExprLet(
-    'id', ExprAbs('x', ExprVar('x')),
-    ExprApp(ExprAbs('f', ExprApp(ExprVar('f'), ExprVar('f'))), ExprVar('id'))
-))
-print('------\n')
-
-# 失败，因为 lambda 引入的变量没有多态性：(\id. (id square) (id 5)) (\x. x)
-try_inference(ExprApp(
-    ExprAbs('id', ExprApp(ExprApp(ExprVar('id'), ExprVar('square')), ExprApp(ExprVar('id'), ExprLitInt(5)))),
-    ExprAbs('x', ExprVar('x'))
-))
-print('------\n')
-
-# 失败，因为 let 绑定的变量来自 lambda，同样没有多态性：(\id. (let id1 = id in (id1 square) (id1 5))) (\x. x)
-try_inference(ExprApp(
-    ExprAbs('id', ExprLet(
-        'id1', ExprVar('id'),
-        ExprApp(ExprApp(ExprVar('id1'), ExprVar('square')), ExprApp(ExprVar('id1'), ExprLitInt(5)))
-    )),
-    ExprAbs('x', ExprVar('x'))
-))
+
+def infer(expr: Expr, env: TypeEnv | None = None) -> TypeScheme:
+    with entry_context():
+        if env is None:
+            env = default_env()
+        check_supported(expr)
+        _, t = w(env, expr)
+        return generalize(env, t)
+
+
+def try_inference(expr: Expr, env: TypeEnv | None = None):
+    with entry_context():
+        if env is None:
+            env = default_env()
+
+        print(f'w(Γ, {expr})')
+        try:
+            s, t = w(env, expr)
+            t_scheme = generalize(env, t)
+            print(f'=> t = {t_scheme}, S = {s}')
+        except TyckException as e:
+            print(f'=> {e.text}')
+
+
+if __name__ == '__main__':
+    # 成功：let id = \x. x in (id square) (id 5)
+    try_inference(ExprLet(
+        'id', ExprAbs('x', ExprVar('x')),
+        ExprApp(ExprApp(ExprVar('id'), ExprVar('square')), ExprApp(ExprVar('id'), ExprLitInt(5)))
+    ))
+    print('------\n')
+
+    # 成功：let id = \x. x in (id id) (id id)
+    try_inference(ExprLet(
+        'id', ExprAbs('x', ExprVar('x')),
+        ExprApp(ExprApp(ExprVar('id'), ExprVar('id')), ExprApp(ExprVar('id'), ExprVar('id')))
+    ))
+    print('------\n')
+
+    # 失败，因为存在无限类型：let id = \x. x in (\f. f f) id
+    try_inference(ExprLet(
+        'id', ExprAbs('x', ExprVar('x')),
+        ExprApp(ExprAbs('f', ExprApp(ExprVar('f'), ExprVar('f'))), ExprVar('id'))
+    ))
+    print('------\n')
+
+    # 失败，因为 lambda 引入的变量没有多态性：(\id. (id square) (id 5)) (\x. x)
+    try_inference(ExprApp(
+        ExprAbs('id', ExprApp(ExprApp(ExprVar('id'), ExprVar('square')), ExprApp(ExprVar('id'), ExprLitInt(5)))),
+        ExprAbs('x', ExprVar('x'))
+    ))
+    print('------\n')
+
+    # 失败，因为 let 绑定的变量来自 lambda，同样没有多态性：(\id. (let id1 = id in (id1 square) (id1 5))) (\x. x)
+    try_inference(ExprApp(
+        ExprAbs('id', ExprLet(
+            'id1', ExprVar('id'),
+            ExprApp(ExprApp(ExprVar('id1'), ExprVar('square')), ExprApp(ExprVar('id1'), ExprLitInt(5)))
+        )),
+        ExprAbs('x', ExprVar('x'))
+    ))
@@ -5,15 +5,27 @@
 # 采用 Algorithm J 的 HM 类型系统的实现，同时经过一定程度的扩展
 
 from __future__ import annotations
+import sys
+import threading
 from abc import abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from contextlib import nullcontext
+from typing import ContextManager, Generator, Iterable
+from weakref import WeakValueDictionary
 
 from ghaik import Greek
 from syntax import *
-from parse import tokenize, parse
+from parse import tokenize_compact, parse
+from hamt import PersistentMap
+from diagnostic import Frame, FrameKind, TyckException
+from printer import Printer, print_scheme, print_type, to_string
+from trampoline import trampoline
+from scc import strongly_connected_components
 
 
 class Type:
+    __slots__ = ()
+
     @abstractmethod
     def contains_type_var(self, type_var: TypeVar) -> bool:
         pass
@@ -30,134 +42,450 @@ class Type:
     def prune(self) -> Type:
         pass
 
+    @abstractmethod
+    def find(self) -> Type:
+        pass
+
     def need_quote(self) -> bool:
         return False
 
+    def pretty(self, p: Printer):
+        print_type(p, self)
+
+
+# 类型变量的并查集。类型变量用整数编号，parent、rank、display、bound 和 level 都是按编号索引的数组：
+# parent 指向同一等价类中的另一个类型变量，rank 用于按秩合并。
+# 其余几项只对等价类的代表元（根）有意义：display 是对外代表这个等价类的类型变量的编号，
+# bound 记录这个等价类被归一化成的类型算子，level 是这个等价类所在的 let 层级。
+#
+# 层级（Rémy 的做法）：类型变量创建时记录当前的 let 层级 current_level，推导 let 绑定的表达式时层级加一。
+# 归一化时把两边类型变量的层级降低到其中较小的一个，这样 let 绑定推导完成之后，
+# 层级仍然大于当前层级的类型变量就不会在环境中出现，可以直接泛化
+#
+# 出现检查：默认在每次 bind 时进行。如果 defer_occurs_check 为真，bind 只调整层级，
+# 被绑定的等价类记录在 unchecked 中，等到泛化时用 check_cycles 一次性检查这些绑定中有没有环。
+# escaped 记录等价类中是否有类型变量曾经作为参数出现在类型算子中，没有的话这个等价类不可能出现在任何类型中，
+# 不需要做出现检查（例如 lambda 的返回类型变量 η，它只会被归一化，不会出现在其他类型中）
+class TypeVarStore:
+    vars: list[TypeVar]
+    parent: list[int]
+    rank: list[int]
+    display: list[int]
+    bound: list[TypeOp | None]
+    level: list[int]
+    escaped: list[bool]
+    current_level: int
+    defer_occurs_check: bool
+    unchecked: list[int]
+    unifying_type_ops: set[tuple[TypeOp, TypeOp]]
+    # bind 和 check_cycles 访问过的节点数，用于性能分析（instrument.py）
+    occurs_visits: int
+
+    def __init__(self):
+        self.vars = []
+        self.parent = []
+        self.rank = []
+        self.display = []
+        self.bound = []
+        self.level = []
+        self.escaped = []
+        self.current_level = 0
+        self.defer_occurs_check = False
+        self.unchecked = []
+        self.unifying_type_ops = set()
+        self.occurs_visits = 0
+
+    def add(self, type_var: TypeVar) -> int:
+        id = len(self.vars)
+        self.vars.append(type_var)
+        self.parent.append(id)
+        self.rank.append(0)
+        self.display.append(id)
+        self.bound.append(None)
+        self.level.append(self.current_level)
+        self.escaped.append(False)
+        return id
+
+    def enter_level(self):
+        self.current_level += 1
+
+    def leave_level(self):
+        self.current_level -= 1
+
+    def find(self, id: int) -> int:
+        parent = self.parent
+        root = id
+        while parent[root] != root:
+            root = parent[root]
+        # 路径压缩
+        while parent[id] != root:
+            parent[id], id = root, parent[id]
+        return root
+
+    # 把 id1 所在的等价类合并到 id2 所在的等价类中，两者都不能已经被归一化成类型算子。
+    # 哪个根成为新的根由秩决定，但合并后的等价类总是由原先代表 id2 的类型变量来代表
+    def union(self, id1: int, id2: int):
+        root1 = self.find(id1)
+        root2 = self.find(id2)
+        if root1 == root2:
+            return
+        display = self.display[root2]
+        level = min(self.level[root1], self.level[root2])
+        escaped = self.escaped[root1] or self.escaped[root2]
+        rank = self.rank
+        if rank[root1] > rank[root2]:
+            root1, root2 = root2, root1
+        self.parent[root1] = root2
+        if rank[root1] == rank[root2]:
+            rank[root2] += 1
+        self.display[root2] = display
+        self.level[root2] = level
+        self.escaped[root2] = escaped
+
+    # 把 id 所在的等价类归一化成类型算子 t。同时做出现检查，并把 t 中类型变量的层级降低到不超过这个等价类的层级。
+    # 如果 t 中出现了这个等价类本身，返回 False。
+    #
+    # 类型算子的 level_bound 是其中所有类型变量层级的上界（层级只会降低，所以上界一直有效）。
+    # 上界小于 level 的子树中不可能出现这个等价类，层级也无需调整，可以整个跳过；
+    # 不需要出现检查时（推迟检查，或者等价类没有出现在任何类型中），上界等于 level 的子树也可以跳过
+    def bind(self, id: int, t: TypeOp) -> bool:
+        root = self.find(id)
+        level = self.level[root]
+        defer = self.defer_occurs_check
+        skip_check = defer or not self.escaped[root]
+        visited: set[TypeOp] = set()
+        stack: list[Type] = [t]
+        while len(stack) > 0:
+            t1 = stack.pop()
+            if isinstance(t1, TypeVar):
+                root1 = self.find(t1.id)
+                bound = self.bound[root1]
+                if bound is None:
+                    if root1 == root and not skip_check:
+                        return False
+                    if self.level[root1] > level:
+                        self.level[root1] = level
+                    continue
+                t1 = bound
+            assert isinstance(t1, TypeOp)
+            if t1.ground or t1 in visited:
+                continue
+            if t1.level_bound < level or (skip_check and t1.level_bound == level):
+                continue
+            visited.add(t1)
+            stack.extend(t1.args)
+        for t1 in visited:
+            t1.level_bound = level
+        self.occurs_visits += len(visited)
+        self.bound[root] = t
+        if defer:
+            self.unchecked.append(root)
+        return True
+
+    # 检查 unchecked 中的等价类被绑定的类型中是否有环，有的话返回类型中有环的那个等价类的代表。
+    # 用三色标记的深度优先搜索，每个类型算子和等价类在一次检查中只访问一次
+    def check_cycles(self) -> TypeVar | None:
+        unchecked = self.unchecked
+        self.unchecked = []
+        done: set[int | TypeOp] = set()
+        for start in unchecked:
+            # 栈中的项是 (节点, 是否已经展开)；节点是等价类的根（整数）或者类型算子
+            in_progress: set[int | TypeOp] = set()
+            stack: list[tuple[int | TypeOp, bool]] = [(self.find(start), False)]
+            while len(stack) > 0:
+                node, expanded = stack.pop()
+                if expanded:
+                    in_progress.discard(node)
+                    done.add(node)
+                    continue
+                if node in done:
+                    continue
+                if node in in_progress:
+                    return self.vars[self.display[self.find(start)]]
+                in_progress.add(node)
+                stack.append((node, True))
+                if isinstance(node, int):
+                    bound = self.bound[node]
+                    if bound is not None and not bound.ground:
+                        stack.append((bound, False))
+                else:
+                    for arg in node.args:
+                        if isinstance(arg, TypeVar):
+                            stack.append((self.find(arg.id), False))
+                        elif not arg.ground:
+                            stack.append((arg, False))
+        self.occurs_visits += len(done)
+        return None
+
+
+# 一次类型检查的上下文：类型变量的编号和并查集都属于上下文，而不是模块的全局状态。
+# 类型变量的 id 是它在并查集中的下标，从 0 开始连续分配；希腊字母和 timestamp 只用于显示，每个字母各自从 0 开始编号。
+#
+# 每个线程有自己的当前上下文（current_context），with InferContext() 在代码块中换用一个新的上下文，
+# 这样每个程序都可以从空白的状态开始检查，多个线程也可以同时检查不同的程序。
+# 类型变量记住自己所属的并查集，不同上下文中的类型变量不能混用。
+# 线程默认的上下文从不被丢弃，其中的类型变量会一直留在并查集中，所以 infer 等入口在没有进入任何上下文时
+# 使用一个新的上下文（见 entry_context），推导中创建的类型变量可以随结果一起被回收
+class InferContext:
+    store: TypeVarStore
+    timestamps: list[int]
+    saved: list[InferContext]
+
+    def __init__(self, defer_occurs_check: bool = False):
+        self.store = TypeVarStore()
+        self.store.defer_occurs_check = defer_occurs_check
+        self.timestamps = [0] * len(Greek)
+        self.saved = []
+
+    def __enter__(self) -> InferContext:
+        self.saved.append(current_context())
+        local_context.value = self
+        return self
+
+    def __exit__(self, *exc_info):
+        local_context.value = self.saved.pop()
+
+    def next_timestamp(self, greek: Greek) -> int:
+        ret = self.timestamps[greek.ordinal]
+        self.timestamps[greek.ordinal] = ret + 1
+        return ret
+
+
+local_context = threading.local()
+
+
+def current_context() -> InferContext:
+    try:
+        return local_context.value
+    except AttributeError:
+        local_context.value = local_context.default = InferContext()
+        return local_context.value
+
 
-global_timestamp: dict[Greek, int] = {}
+# 推导的入口使用的上下文：已经用 with 进入了某个上下文时沿用它，否则换用一个新的上下文
+def entry_context() -> ContextManager[object]:
+    if current_context() is local_context.default:
+        return InferContext()
+    return nullcontext()
 
 
 @dataclass
 class TypeVar(Type):
     greek: Greek
     timestamp: int
-    resolve: Type | None
+    id: int
+    store: TypeVarStore = field(repr=False)
 
     def __init__(self, greek: Greek):
-        global global_timestamp
+        context = current_context()
         self.greek = greek
-        if self.greek in global_timestamp:
-            self.timestamp = global_timestamp[self.greek]
-            global_timestamp[self.greek] += 1
-        else:
-            self.timestamp = 0
-            global_timestamp[self.greek] = 1
-        self.resolve = None
+        self.timestamp = context.next_timestamp(greek)
+        self.store = context.store
+        self.id = self.store.add(self)
 
     def __str__(self) -> str:
         if self.greek == Greek.Eta:
             return '!'
         return str(self.greek) + str(self.timestamp)
 
+    # id 只是类型变量在自己的并查集中的下标，不同上下文中的类型变量可能有相同的 id，所以还要比较并查集。
+    # 哈希值只用 id，不同上下文中 id 相同的类型变量哈希冲突，但不会相等
     def __eq__(self, value: object) -> bool:
         if isinstance(value, TypeVar):
-            return self.greek == value.greek and self.timestamp == value.timestamp
+            return self.id == value.id and self.store is value.store
         return False
 
     def __hash__(self) -> int:
-        return hash(self.greek) + hash(self.timestamp) if self.timestamp is not None else 0
+        return self.id
+
+    # 返回等价类的代表：如果等价类已经被归一化成类型算子，返回这个类型算子，否则返回代表这个等价类的类型变量
+    def find(self) -> Type:
+        store = self.store
+        root = store.find(self.id)
+        bound = store.bound[root]
+        return bound if bound is not None else store.vars[store.display[root]]
 
     def prune(self) -> Type:
-        if self.resolve is not None:
-            pruned = self.resolve.prune()
-            self.resolve = pruned
-            return pruned
-        else:
-            return self
+        t = self.find()
+        return t if isinstance(t, TypeVar) else t.prune()
 
     def fresh(self) -> TypeVar:
         return TypeVar(self.greek)
 
     def contains_type_var(self, type_var: TypeVar) -> bool:
-        return self == type_var
+        t = self.find()
+        if isinstance(t, TypeVar):
+            return t == type_var.find()
+        return t.contains_type_var(type_var)
 
     def collect_type_vars(self, dst: list[TypeVar]):
         dst.append(self)
 
+    # 已经被归一化的类型变量不会是被泛化的类型变量，归一化成的类型中也不会含有被泛化的类型变量
+    # （否则后者的层级会被降低，不会被泛化），所以直接返回这个类型即可，不需要复制
     def instantiate(self, free: dict[TypeVar, TypeVar]) -> Type:
-        return free.get(self, self)
+        t = self.find()
+        if isinstance(t, TypeVar):
+            return free.get(t, t)
+        return t
 
 
-@dataclass
+# 类型算子是不可变的。不含类型变量的类型算子（ground 为真）经过散列合并（hash consing）：
+# 运算符和参数都相同的只有一个实例，各处的签名共享同一份结构，这样的类型在实例化、剪枝和出现检查时可以直接跳过。
+# 含有类型变量的类型算子大多来自刚刚实例化出的新类型变量，几乎不会重复，所以不放进表中，只预先算好哈希值
+#
+# 含有类型变量的类型算子记录这些类型变量所属的并查集 store（不含类型变量时为 None），
+# 参数中的类型变量来自不同的上下文时报错。构造类型算子不改变并查集，参数中有类型变量时用 type_op 构造
 class TypeOp(Type):
+    __slots__ = ('op', 'args', 'hash', 'ground', 'level_bound', 'store', '__weakref__')
     op: str
-    args: list[Type]
+    args: tuple[Type, ...]
+    hash: int
+    ground: bool
+    level_bound: int
+    store: TypeVarStore | None
+
+    def __new__(cls, op: str, args: Iterable[Type]) -> TypeOp:
+        args = tuple(args)
+        ground = True
+        store = None
+        for arg in args:
+            if isinstance(arg, TypeVar):
+                ground = False
+                arg_store = arg.store
+            elif not arg.ground:
+                ground = False
+                arg_store = arg.store
+            else:
+                continue
+            if store is None:
+                store = arg_store
+            elif store is not arg_store:
+                raise Exception(MIXED_CONTEXTS)
+        key = (op, args)
+        if ground:
+            ret = type_op_table.get(key)
+            if ret is not None:
+                return ret
+        ret = super().__new__(cls)
+        ret.op = op
+        ret.args = args
+        ret.hash = hash(key)
+        ret.ground = ground
+        ret.level_bound = sys.maxsize
+        ret.store = store
+        if ground:
+            type_op_table[key] = ret
+        return ret
 
-    def __str__(self) -> str:
-        if self.op == 'unit':
-            return '()'
+    def __hash__(self) -> int:
+        return self.hash
 
-        if len(self.args) == 0:
-            return self.op
+    def __repr__(self) -> str:
+        return f'TypeOp({self.op!r}, {self.args!r})'
 
-        ret = ''
-        if self.op == '*' or self.op == '->':
-            for (idx, arg) in enumerate(self.args):
-                if arg.need_quote():
-                    ret += f'({arg})'
-                else:
-                    ret += str(arg)
-                if idx != len(self.args) - 1:
-                    ret += ' × ' if self.op == '*' else '→'
-        else:
-            ret += self.op
-            for (idx, arg) in enumerate(self.args):
-                if arg.need_quote():
-                    ret += f'({arg})'
-                else:
-                    ret += str(arg)
-                if idx != len(self.args) - 1:
-                    ret += ' '
-        return ret
+    def __str__(self) -> str:
+        return to_string(self)
 
+    # 以下几个操作都用显式的栈遍历类型，避免类型嵌套很深时超出 Python 的递归深度限制
     def contains_type_var(self, type_var: TypeVar) -> bool:
-        for arg in self.args:
-            if arg.contains_type_var(type_var):
-                return True
+        target = type_var.find()
+        stack: list[Type] = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            if isinstance(t, TypeVar):
+                t = t.find()
+                if isinstance(t, TypeVar):
+                    if t == target:
+                        return True
+                    continue
+            assert isinstance(t, TypeOp)
+            if not t.ground:
+                stack.extend(t.args)
         return False
 
+    # 共享的子树只遍历一次：先序遍历中再次遇到它时，其中的类型变量都已经收集过了
     def collect_type_vars(self, dst: list[TypeVar]):
-        for arg in self.args:
-            arg.collect_type_vars(dst)
+        visited: set[TypeOp] = set()
+        stack: list[Type] = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            if isinstance(t, TypeVar):
+                dst.append(t)
+            else:
+                assert isinstance(t, TypeOp)
+                if not t.ground and t not in visited:
+                    visited.add(t)
+                    stack.extend(reversed(t.args))
 
     def instantiate(self, free: dict[TypeVar, TypeVar]) -> Type:
-        if len(self.args) == 0:
+        if self.ground:
             return self
-        return TypeOp(self.op, [arg.instantiate(free) for arg in self.args])
+        return type_op(self.op, [arg.instantiate(free) for arg in self.args])
 
+    # 返回把类型变量都替换为其等价类的代表之后的类型。类型算子是共享的，不能原地修改，
+    # 所以自底向上重建，pruned 记录已经重建好的类型算子。
+    # 推迟出现检查时类型中可能有环（例如显示错误信息时），visiting 是正在重建的类型算子，
+    # 指回它们的类型变量保持原样
     def prune(self) -> Type:
-        if len(self.args) == 0:
+        if self.ground:
             return self
-        for idx in range(0, len(self.args)):
-            self.args[idx] = self.args[idx].prune()
+        pruned: dict[int, Type] = {}
+        visiting: set[int] = set()
+        stack: list[TypeOp] = [self]
+        while len(stack) > 0:
+            t = stack[-1]
+            if id(t) in pruned:
+                stack.pop()
+                continue
+            args = [arg.find() for arg in t.args]
+            pending = [arg for arg in args if isinstance(arg, TypeOp) and not arg.ground
+                       and id(arg) not in pruned and id(arg) not in visiting]
+            if len(pending) > 0:
+                visiting.add(id(t))
+                stack.extend(pending)
+                continue
+            stack.pop()
+            visiting.discard(id(t))
+            pruned[id(t)] = TypeOp(t.op, [orig if id(arg) in visiting else pruned.get(id(arg), arg)
+                                          for (orig, arg) in zip(t.args, args)])
+        return pruned[id(self)]
+
+    def find(self) -> Type:
         return self
 
     def need_quote(self) -> bool:
         return len(self.args) > 0
 
 
+type_op_table: WeakValueDictionary[tuple[str, tuple[Type, ...]], TypeOp] = WeakValueDictionary()
+
+
+# 构造含有类型变量的类型算子，并在并查集中记录这些类型变量的等价类出现在了类型算子中（见 TypeVarStore 的 escaped）。
+# TypeOp 的构造本身不改变任何状态，所以参数中可能有新的类型变量时都要通过这里构造，否则 bind 可能错误地跳过出现检查。
+# 剪枝得到的类型算子（prune）除外：其中的类型变量是原有参数的等价类的代表，这些等价类已经记录过了
+def type_op(op: str, args: Iterable[Type]) -> TypeOp:
+    ret = TypeOp(op, args)
+    if not ret.ground:
+        for arg in ret.args:
+            if isinstance(arg, TypeVar):
+                store = arg.store
+                store.escaped[store.find(arg.id)] = True
+    return ret
+
+
 def product_type(*types: Type) -> TypeOp:
-    return TypeOp('*', list(types))
+    return type_op('*', types)
 
 
 def fn_type(arg_type: Type, ret_type: Type) -> TypeOp:
-    return TypeOp('->', [arg_type, ret_type])
+    return type_op('->', (arg_type, ret_type))
 
 
-UnitType = TypeOp('unit', [])
-IntType = TypeOp('int', [])
-BoolType = TypeOp('bool', [])
-StrType = TypeOp('str', [])
+UnitType = TypeOp('unit', ())
+IntType = TypeOp('int', ())
+BoolType = TypeOp('bool', ())
+StrType = TypeOp('str', ())
 
 
 @dataclass
@@ -169,33 +497,79 @@ class TypeScheme:
         self.free = free
         self.ty = ty
         self.free_accel = set(free)
+        self.template = None
 
     def __str__(self) -> str:
-        if len(self.free) == 0:
-            return str(self.ty)
+        return to_string(self)
 
-        ret = ''
-        for item in self.free:
-            if item.greek != Greek.Eta:
-                ret += '∀' + str(item)
-        ret += '. ' + str(self.ty)
-        return ret
+    def pretty(self, p: Printer):
+        print_scheme(p, self.free, self.ty)
 
+    # 没有被泛化的类型变量时直接返回共享的类型；否则在第一次实例化时编译出模板，之后每次按照模板复制
     def instantiate(self) -> Type:
-        free = {}
-        for item in self.free:
-            free[item] = item.fresh()
-        return self.ty.instantiate(free)
-
-
-@dataclass
-class TyckException(Exception):
-    text: str
+        if len(self.free) == 0:
+            return self.ty.find()
+        template = self.template
+        if template is None:
+            template = self.template = compile_template(self.ty, self.free)
+        regs: list[Type] = [item.fresh() for item in self.free]
+        for (op, args) in template.ops:
+            regs.append(type_op(op, [regs[arg] if type(arg) is int else arg for arg in args]))
+        result = template.result
+        return regs[result] if type(result) is int else result
+
+
+# 类型方案的实例化模板。寄存器 0 到 k - 1 是 k 个被泛化的类型变量的新副本，
+# 之后依次是 ops 中每一项 (运算符, 参数) 构造出的类型算子；参数和 result 是寄存器的编号，或者直接共享的类型。
+# 只有含有被泛化的类型变量的类型算子才需要复制，其余的子树（包括没有被泛化的类型变量）原样共享，
+# 类型中共享的子树也只在模板中出现一次，实例化的结果保持同样的共享
+@dataclass(slots=True)
+class Template:
+    ops: list[tuple[str, tuple[int | Type, ...]]]
+    result: int | Type
+
+
+def compile_template(ty: Type, free: list[TypeVar]) -> Template:
+    regs: dict[Type, int | Type] = {item: idx for (idx, item) in enumerate(free)}
+    if isinstance(ty, TypeVar):
+        t = ty.find()
+        return Template([], regs.get(t, t))
+    ops: list[tuple[str, tuple[int | Type, ...]]] = []
+    stack: list[TypeOp] = [ty]
+    while len(stack) > 0:
+        t = stack[-1]
+        if t in regs:
+            stack.pop()
+            continue
+        # 和 TypeVar.instantiate 一样，已经被归一化的类型变量直接共享归一化成的类型，不深入其中
+        # （推迟出现检查时，其中可能暂时有环）
+        refs: list[int | Type] = []
+        pending: list[TypeOp] = []
+        for arg in t.args:
+            if isinstance(arg, TypeVar):
+                arg = arg.find()
+                refs.append(regs.get(arg, arg) if isinstance(arg, TypeVar) else arg)
+            elif arg.ground:
+                refs.append(arg)
+            elif arg in regs:
+                refs.append(regs[arg])
+            else:
+                pending.append(arg)
+        if len(pending) > 0:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        if any(type(ref) is int for ref in refs):
+            ops.append((t.op, tuple(refs)))
+            regs[t] = len(free) + len(ops) - 1
+        else:
+            regs[t] = t
+    return Template(ops, regs[ty])
 
 
 def unify(t1: Type, t2: Type):
-    t1 = t1.prune()
-    t2 = t2.prune()
+    t1 = t1.find()
+    t2 = t2.find()
 
     fresh_exception = False
     try:
@@ -207,74 +581,107 @@ def unify(t1: Type, t2: Type):
             return unify_type_var(t2, t1)
         else:
             fresh_exception = True
-            raise TyckException(f'错误：无法归一化类型 {t1} 和 {t2}')
+            raise TyckException('错误：无法归一化类型 {} 和 {}', t1, t2)
     except TyckException as e:
         if not fresh_exception:
-            e.text += f'\n  - 当归一化类型 {t1} 和 {t2} 时发生'
+            e.add_frame(Frame(FrameKind.Unify, t1=t1, t2=t2))
         raise e
 
 
+MIXED_CONTEXTS = '错误：不能混用不同推导上下文（InferContext）中的类型变量'
+
+
+# t1 和 t2 都是 find 的结果，t1 是一个尚未被归一化成类型算子的等价类的代表
 def unify_type_var(t1: TypeVar, t2: Type):
     if t1 == t2:
         return
-    if t2.contains_type_var(t1):
-        raise TyckException(f'错误：无法归一化类型变量 {t1} 和类型 {t2}：后者中存在对前者的引用，这是不允许的')
-    t1.resolve = t2
+    if isinstance(t2, TypeVar):
+        if t1.store is not t2.store:
+            raise Exception(MIXED_CONTEXTS)
+        t1.store.union(t1.id, t2.id)
+        return
+    assert isinstance(t2, TypeOp)
+    if t2.store is not None and t2.store is not t1.store:
+        raise Exception(MIXED_CONTEXTS)
+    if not t1.store.bind(t1.id, t2):
+        raise TyckException('错误：无法归一化类型变量 {} 和类型 {}：后者中存在对前者的引用，这是不允许的', t1, t2)
 
 
+# 推迟出现检查时，类型中可能暂时存在环，正在归一化的类型算子对记录在并查集的 unifying_type_ops 中。
+# 再次遇到同一对类型算子时可以直接认为成功，这样在有环的类型上归一化也能终止。
+# 并查集取自两个类型算子本身；两者都不含类型变量时其中不可能有环，不需要记录
 def unify_type_op(t1: TypeOp, t2: TypeOp):
+    if t1 is t2:
+        return
+
     if t1.op != t2.op:
-        raise TyckException(f'错误：无法归一化类型算子 {t1} 和 {t2}（运算符不同）')
+        raise TyckException('错误：无法归一化类型算子 {} 和 {}（运算符不同）', t1, t2)
 
     if len(t1.args) != len(t2.args):
-        raise TyckException(f'错误：无法归一化类型算子 {t1} 和 {t2}（类型算子的参数数目不同）')
-
-    for idx in range(0, len(t1.args)):
-        try:
-            unify(t1.args[idx], t2.args[idx])
-        except TyckException as e:
-            e.text += f'\n  - 当归一化类型算子的第 {idx + 1} 个参数（{t1.args[idx]} 和 {t2.args[idx]}）时发生'
-            raise e
-
+        raise TyckException('错误：无法归一化类型算子 {} 和 {}（类型算子的参数数目不同）', t1, t2)
+
+    store = t1.store
+    if store is None:
+        store = t2.store
+    elif t2.store is not None and t2.store is not store:
+        raise Exception(MIXED_CONTEXTS)
+    pair = (t1, t2)
+    tracking = store is not None and store.defer_occurs_check
+    if tracking:
+        if pair in store.unifying_type_ops:
+            return
+        store.unifying_type_ops.add(pair)
 
+    try:
+        for idx in range(0, len(t1.args)):
+            try:
+                unify(t1.args[idx], t2.args[idx])
+            except TyckException as e:
+                e.add_frame(Frame(FrameKind.UnifyArg, t1=t1.args[idx], t2=t2.args[idx], arg_index=idx))
+                raise e
+    finally:
+        if tracking:
+            store.unifying_type_ops.discard(pair)
+
+
+# 类型环境是持久化的：内层作用域创建新的 TypeEnv，和外层共享 PersistentMap 的绝大部分结构，
+# 因此扩展环境不需要复制已有的绑定，查找也不需要沿着作用域链逐层进行
 @dataclass
 class TypeEnv:
-    parent: TypeEnv | None
-    vars: dict[str, TypeScheme]
-    non_generic_type_vars: set[TypeVar]
+    vars: PersistentMap
     return_ty: TypeVar | None
 
     def __init__(self, parent: TypeEnv | None = None):
-        self.parent = parent
-        self.vars = {}
-        self.non_generic_type_vars = set()
-        self.return_ty = None
+        if parent is not None:
+            self.vars = parent.vars
+            self.return_ty = parent.return_ty
+        else:
+            self.vars = PersistentMap()
+            self.return_ty = None
 
     def lookup(self, var_name: str) -> TypeScheme | None:
-        if var_name in self.vars:
-            return self.vars[var_name]
+        return self.vars.get(var_name)
 
-        if self.parent is not None:
-            return self.parent.lookup(var_name)
+    def bind(self, var_name: str, scheme: TypeScheme):
+        self.vars = self.vars.set(var_name, scheme)
 
     def collect_type_vars(self, dst: list[TypeVar]):
         for var_scheme in self.vars.values():
             var_scheme.ty.collect_type_vars(dst)
-        if self.parent is not None:
-            self.parent.collect_type_vars(dst)
-
-    def is_non_generic(self, v: TypeVar) -> bool:
-        if v in self.non_generic_type_vars:
-            return True
-        return self.parent.is_non_generic(v) if self.parent is not None else False
 
     def closest_return_ty(self) -> TypeVar | None:
-        if self.return_ty is not None:
-            return self.return_ty
-        return self.parent.closest_return_ty() if self.parent is not None else None
+        return self.return_ty
+
+
+JGenerator = Generator[tuple[TypeEnv, Expr], Type, Type]
 
 
 def j(env: TypeEnv, expr: Expr) -> Type:
+    return trampoline(j_step, env, expr)
+
+
+# j 的一步：字面量和变量直接得到结果，其余的表达式交给 j_node 创建的生成器
+def j_step(env: TypeEnv, expr: Expr) -> Type | JGenerator:
     try:
         if isinstance(expr, ExprLitInt):
             return IntType
@@ -287,35 +694,40 @@ def j(env: TypeEnv, expr: Expr) -> Type:
             if scheme is not None:
                 return scheme.instantiate()
             else:
-                raise TyckException(f'变量或函数 {expr.x} 尚未定义')
-        elif isinstance(expr, ExprAbs):
+                raise TyckException('变量或函数 {} 尚未定义', expr.x)
+    except TyckException as e:
+        e.add_frame(Frame(FrameKind.Expr, expr=expr))
+        raise e
+    return j_node(env, expr)
+
+
+# 推导子表达式时产生 (环境, 子表达式)，由 trampoline 推导之后把结果交还，见 trampoline.py
+def j_node(env: TypeEnv, expr: Expr) -> JGenerator:
+    try:
+        if isinstance(expr, ExprAbs):
             beta = TypeVar(Greek.Beta)
             env1 = TypeEnv(env)
-            env1.vars[expr.x] = TypeScheme([], beta)
-            env1.non_generic_type_vars.add(beta)
+            env1.bind(expr.x, TypeScheme([], beta))
             env1.return_ty = TypeVar(Greek.Eta)
-            t1 = j(env1, expr.body)
+            t1 = yield env1, expr.body
             unify(env1.return_ty, t1)
             return fn_type(beta, t1)
         elif isinstance(expr, ExprApp):
             pi = TypeVar(Greek.Pi)
-            t1 = j(env, expr.e1)
-            t2 = j(env, expr.e2)
+            t1 = yield env, expr.e1
+            t2 = yield env, expr.e2
             unify(fn_type(t2, pi), t1)
-            if pi.resolve is None:
+            if pi.find() is pi:
                 eta = TypeVar(Greek.Eta)
                 pi.greek = Greek.Eta
                 pi.timestamp = eta.timestamp
             return pi
         elif isinstance(expr, ExprLet):
-            env1 = TypeEnv(env)
-            t1 = j(env1, expr.e1)
-            x_scheme = generalize(env1, t1)
-            env1.vars[expr.x] = x_scheme
-            return j(env1, expr.e2)
+            env1 = yield from j_bindings(env, expr)
+            return (yield env1, expr.e2)
         elif isinstance(expr, ExprStmt):
             for (idx, stmt) in enumerate(expr.stmts):
-                t = j(env, stmt)
+                t = yield env, stmt
                 if idx == len(expr.stmts) - 1:
                     return t
             assert False
@@ -324,47 +736,90 @@ def j(env: TypeEnv, expr: Expr) -> Type:
             if return_ty is None:
                 raise TyckException('错误：return 只能在函数体内使用')
             if expr.e is not None:
-                t_ret = j(env, expr.e)
+                t_ret = yield env, expr.e
             else:
                 t_ret = UnitType
             unify(return_ty, t_ret)
             return TypeVar(Greek.Eta)
         elif isinstance(expr, ExprLetRec):
-            env1 = TypeEnv(env)
-            type_vars = []
-            for (name, _) in expr.decls:
-                tvar = TypeVar(Greek.Gamma)
-                type_vars.append(tvar)
-                env1.vars[name] = TypeScheme([], tvar)
-                env1.non_generic_type_vars.add(tvar)
-            for (idx, (_, decl)) in enumerate(expr.decls):
-                actual_ty = j(env1, decl)
-                unify(type_vars[idx], actual_ty)
-            for (idx, (name, _)) in enumerate(expr.decls):
-                env1.vars[name] = generalize(env1, type_vars[idx])
-            return j(env1, expr.body)
+            env1 = yield from j_bindings(env, expr)
+            return (yield env1, expr.body)
         elif isinstance(expr, ExprIf):
-            t1 = j(env, expr.e1)
-            t2 = j(env, expr.e2)
-            t3 = j(env, expr.e3)
+            t1 = yield env, expr.e1
+            t2 = yield env, expr.e2
+            t3 = yield env, expr.e3
             unify(t1, BoolType)
             unify(t2, t3)
             return t2
         else:
             raise Exception(f'表达式 {expr} 的类型未知')
     except TyckException as e:
-        e.text += f'\n  - 当检查表达式 {expr} 时发生'
+        e.add_frame(Frame(FrameKind.Expr, expr=expr))
         raise e
 
 
-def generalize(env: TypeEnv, t: Type) -> TypeScheme:
+# 推导 let 或 let rec 绑定的表达式，返回加入这些绑定之后的环境。
+# 除了 j_node 之外，增量检查（incremental.py）也用它单独推导顶层的绑定。
+#
+# 和 Haskell 一样，let rec 中的绑定先按照相互引用的关系分成强连通分量，
+# 再按依赖的顺序逐个推导和泛化每个分量：只有真正相互递归的绑定才需要在同一个单态的作用域中推导，
+# 后面的绑定可以多态地使用前面已经泛化的绑定，每次归一化的问题也更小
+def j_bindings(env: TypeEnv, expr: ExprLet | ExprLetRec) -> Generator[tuple[TypeEnv, Expr], Type, TypeEnv]:
+    env1 = TypeEnv(env)
+    store = current_context().store
+    if isinstance(expr, ExprLet):
+        store.enter_level()
+        try:
+            t1 = yield env1, expr.e1
+        finally:
+            store.leave_level()
+        x_scheme = generalize(t1)
+        env1.bind(expr.x, x_scheme)
+        return env1
+
+    for group in let_rec_groups(expr.decls):
+        type_vars = []
+        store.enter_level()
+        try:
+            for idx in group:
+                tvar = TypeVar(Greek.Gamma)
+                type_vars.append(tvar)
+                env1.bind(expr.decls[idx][0], TypeScheme([], tvar))
+            for (idx, tvar) in zip(group, type_vars):
+                actual_ty = yield env1, expr.decls[idx][1]
+                unify(tvar, actual_ty)
+        finally:
+            store.leave_level()
+        for (idx, tvar) in zip(group, type_vars):
+            env1.bind(expr.decls[idx][0], generalize(tvar))
+    return env1
+
+
+# 把 let rec 中的绑定按相互引用的关系分成强连通分量，每个分量排在它所引用的分量之后。
+# 同名的绑定以最后一个为准，和它们在环境中的绑定一致
+def let_rec_groups(decls: list[tuple[str, Expr]]) -> list[list[int]]:
+    index = {name: idx for (idx, (name, _)) in enumerate(decls)}
+    successors = []
+    for (_, decl) in decls:
+        successors.append(sorted(index[x] for x in free_vars(decl) if x in index))
+    return strongly_connected_components(successors)
+
+
+# 层级大于当前层级的类型变量只可能来自刚刚推导完成的 let 绑定，不会出现在环境中，可以泛化
+def generalize(t: Type) -> TypeScheme:
+    store = current_context().store
+    if len(store.unchecked) > 0:
+        cyclic = store.check_cycles()
+        if cyclic is not None:
+            # 这里要显示的是类型变量本身的名字，不能剪枝
+            raise TyckException('错误：类型变量 {} 的类型中存在对其自身的引用，这是不允许的', str(cyclic))
     t = t.prune()
     type_vars: list[TypeVar] = []
     t.collect_type_vars(type_vars)
 
     filtered_type_vars: list[TypeVar] = []
-    for type_var in set(type_vars):
-        if not env.is_non_generic(type_var):
+    for type_var in dict.fromkeys(type_vars):
+        if store.level[store.find(type_var.id)] > store.current_level:
             filtered_type_vars.append(type_var)
 
     return TypeScheme(filtered_type_vars, t)
@@ -372,35 +827,49 @@ def generalize(env: TypeEnv, t: Type) -> TypeScheme:
 
 def default_env() -> TypeEnv:
     env = TypeEnv()
-    env.vars['square'] = TypeScheme([], fn_type(IntType, IntType))
-    env.vars['print'] = TypeScheme([], fn_type(StrType, UnitType))
+    env.bind('square', TypeScheme([], fn_type(IntType, IntType)))
+    env.bind('print', TypeScheme([], fn_type(StrType, UnitType)))
 
-    env.vars['condint'] = TypeScheme([], fn_type(IntType, BoolType))
+    env.bind('condint', TypeScheme([], fn_type(IntType, BoolType)))
     return env
 
 
-def try_inference(expr: Expr, env: TypeEnv = default_env()):
+def infer(expr: Expr, env: TypeEnv | None = None) -> TypeScheme:
+    with entry_context():
+        if env is None:
+            env = default_env()
+        store = current_context().store
+        store.enter_level()
+        try:
+            t = j(env, expr)
+        finally:
+            store.leave_level()
+        return generalize(t)
+
+
+def try_inference(expr: Expr, env: TypeEnv | None = None):
     try:
-        t = j(env, expr)
-        t_scheme = generalize(env, t)
+        t_scheme = infer(expr, env)
         print(f'j(Γ, {expr}) = {t_scheme}')
     except TyckException as e:
         print(f'j(Γ, {expr})\n错误: {e.text}')
     print()
 
-try_inference(parse(tokenize('let rec f = \\x. x, g = f in g')))
-try_inference(parse(tokenize(r'''
-let rec g = f,
-    f = \x.
-        let ret = if (condint x) then
-                (print "电灯熄灭 物换星移 移牛入海");
-                (return 42)
-            else
-                (print "独脚大盗 百万富翁 摸爬滚打");
-                x
-            in
-                (print "黑暗好像 一颗巨石 按在胸口");
-        ret
-    in g
-''')))
-try_inference(parse(tokenize('let id = \\x. x in (id id) (id id)')))
+
+if __name__ == '__main__':
+    try_inference(parse(tokenize_compact('let rec f = \\x. x, g = f in g')))
+    try_inference(parse(tokenize_compact(r'''
+    let rec g = f,
+        f = \x.
+            let ret = if (condint x) then
+                    (print "电灯熄灭 物换星移 移牛入海");
+                    (return 42)
+                else
+                    (print "独脚大盗 百万富翁 摸爬滚打");
+                    x
+                in
+                    (print "黑暗好像 一颗巨石 按在胸口");
+            ret
+        in g
+    ''')))
+    try_inference(parse(tokenize_compact('let id = \\x. x in (id id) (id id)')))
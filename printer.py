@@ -0,0 +1,252 @@
+# 表达式、类型和类型方案的打印
+#
+# 打印的对象把输出的片段依次交给 Printer：text 是原样输出的文本，line 是可以换行的位置，
+# begin 和 end 之间是一组。syntax.py 中的表达式和 pl9、pl9je 中的类型都用显式的栈遍历，
+# 所以打印的耗时与输出的长度成正比，和嵌套的深度无关。
+#
+# 不指定宽度时不换行，每个 line 都按原样输出，片段直接收集起来最后拼接一次。
+# 指定宽度时按 Oppen 的算法排版：一组在一行中放得下时整组不换行，否则这一组中的每个 line 都换行，
+# 换行之后缩进到外层的缩进加上这一组的 indent。为了判断一组是否放得下，Printer 最多缓存一行宽度的输出，
+# 缓存的内容超过剩余的宽度时，最外层还没有结束的组一定放不下，可以先输出这部分，
+# 因此排版同样是线性的，并且可以边打印边写入文件
+#
+# 类型算子是带有 op 和 args 的对象（pl9 和 pl9je 中的 TypeOp），其他类型（类型变量）按 str 输出
+
+from __future__ import annotations
+from collections import deque
+from typing import IO, Any, Callable
+
+from ghaik import Greek
+
+# 缓存的片段达到这么多时写入文件
+FLUSH_PARTS = 4096
+
+
+class Printer:
+    out: IO[str] | None
+    width: int | None
+    parts: list[str]
+    text: Callable[[str], None]
+    # 以下用于按宽度排版：column 是当前的列，groups 是正在输出的组 (是否换行, 换行之后的缩进)
+    column: int
+    groups: list[tuple[bool, int]]
+    # 还不知道是否放得下的组之后的片段，每项是 [种类, 内容, 长度]，组的长度在遇到 end 时确定，
+    # left_total 和 right_total 是已经离开和进入 buffer 的片段按一行输出时的总长度，
+    # scan_stack 是 buffer 中还没有结束的组
+    buffer: deque[list[Any]]
+    left_total: int
+    right_total: int
+    scan_stack: deque[list[Any]]
+
+    def __init__(self, out: IO[str] | None = None, width: int | None = None):
+        self.out = out
+        self.width = width
+        self.parts = []
+        self.column = 0
+        self.groups = [(False, 0)]
+        self.buffer = deque()
+        self.left_total = 0
+        self.right_total = 0
+        self.scan_stack = deque()
+        if width is None:
+            # 不排版时 text 直接追加到 parts，写入文件的时机由 line 和 end 检查
+            self.text = self.parts.append
+
+    def text(self, s: str):
+        if len(self.scan_stack) == 0:
+            self.emit(TEXT, s)
+        else:
+            self.buffer.append([TEXT, s, len(s)])
+            self.right_total += len(s)
+            self.check_buffer()
+
+    # 可以换行的位置，不换行时输出 flat
+    def line(self, flat: str = ' '):
+        if self.width is None:
+            self.parts.append(flat)
+            if len(self.parts) >= FLUSH_PARTS and self.out is not None:
+                self.flush()
+        elif len(self.scan_stack) == 0:
+            self.emit(LINE, flat)
+        else:
+            self.buffer.append([LINE, flat, len(flat)])
+            self.right_total += len(flat)
+            self.check_buffer()
+
+    def begin(self, indent: int = 0):
+        if self.width is None:
+            return
+        # 组的长度先记为 -right_total，在 end 时加上那时的 right_total
+        token = [BEGIN, indent, -self.right_total]
+        self.buffer.append(token)
+        self.scan_stack.append(token)
+
+    def end(self):
+        if self.width is None:
+            if len(self.parts) >= FLUSH_PARTS and self.out is not None:
+                self.flush()
+            return
+        if len(self.scan_stack) == 0:
+            self.emit(END, None)
+            return
+        self.buffer.append([END, None, 0])
+        token = self.scan_stack.pop()
+        token[2] += self.right_total
+        if len(self.scan_stack) == 0:
+            self.advance()
+
+    # 缓存的内容在一行中已经放不下：最外层的组一定要换行，输出到下一个还不知道长度的组为止
+    def check_buffer(self):
+        assert self.width is not None
+        while len(self.scan_stack) > 0 and self.right_total - self.left_total > self.width - self.column:
+            self.scan_stack.popleft()[2] = INFINITY
+            self.advance()
+
+    def advance(self):
+        buffer = self.buffer
+        while len(buffer) > 0 and buffer[0][2] >= 0:
+            kind, value, size = buffer.popleft()
+            if kind == BEGIN:
+                self.emit(kind, value, size)
+            else:
+                self.left_total += size
+                self.emit(kind, value)
+
+    def emit(self, kind: int, value: Any, size: int = 0):
+        assert self.width is not None
+        if kind == TEXT:
+            self.parts.append(value)
+            self.column += len(value)
+        elif kind == LINE:
+            broken, indent = self.groups[-1]
+            if broken:
+                self.parts.append('\n' + ' ' * indent)
+                self.column = indent
+            else:
+                self.parts.append(value)
+                self.column += len(value)
+        elif kind == BEGIN:
+            indent = self.groups[-1][1] + value
+            self.groups.append((size > self.width - self.column, indent))
+        else:
+            self.groups.pop()
+        if len(self.parts) >= FLUSH_PARTS and self.out is not None:
+            self.flush()
+
+    # 把已经确定的输出写入文件。还在 buffer 中的片段要等到确定是否换行之后才能写入
+    def flush(self):
+        if self.out is not None and len(self.parts) > 0:
+            self.out.write(''.join(self.parts))
+            self.parts.clear()
+
+    def getvalue(self) -> str:
+        return ''.join(self.parts)
+
+
+TEXT, LINE, BEGIN, END = range(4)
+INFINITY = 1 << 62
+
+
+# 打印实现了 pretty(printer) 的对象（表达式、类型和类型方案）
+def to_string(obj: Any, width: int | None = None) -> str:
+    p = Printer(width=width)
+    obj.pretty(p)
+    return p.getvalue()
+
+
+def dump(obj: Any, out: IO[str], width: int | None = None):
+    p = Printer(out, width)
+    obj.pretty(p)
+    p.flush()
+
+
+# 可以换行的位置，放在遍历的栈中
+class LineBreak:
+    __slots__ = ('flat',)
+
+    flat: str
+
+    def __init__(self, flat: str):
+        self.flat = flat
+
+
+SPACE = LineBreak(' ')
+SOFT = LineBreak('')
+
+
+# 遍历时使用的 SPACE 和 SOFT：不排版时直接换成它们不换行时的文本，作为字符串输出
+def breaks(p: Printer) -> tuple[LineBreak | str, LineBreak | str]:
+    if p.width is None:
+        return ' ', ''
+    return SPACE, SOFT
+
+
+# 遍历时栈中的项是要打印的类型、原样输出的字符串、LineBreak（可以换行的位置），或者 None（一组的结束）
+def print_type(p: Printer, ty: Any):
+    stack: list[Any] = [ty]
+    push, pop = stack.append, stack.pop
+    text, line, begin, end = p.text, p.line, p.begin, p.end
+    space, soft = breaks(p)
+    while len(stack) > 0:
+        t = pop()
+        if type(t) is str:
+            text(t)
+            continue
+        elif t is None:
+            end()
+            continue
+        elif type(t) is LineBreak:
+            line(t.flat)
+            continue
+        args = getattr(t, 'args', None)
+        if args is None:
+            text(str(t))
+            continue
+        elif len(args) == 0:
+            text(atom(t))
+            continue
+
+        op = t.op
+        begin(2)
+        if op != '*' and op != '->':
+            text(op)
+        push(None)
+        for idx in range(len(args) - 1, -1, -1):
+            # 不需要括号的参数直接转换成字符串，不再入栈展开
+            arg = args[idx]
+            arg_args = getattr(arg, 'args', None)
+            if arg_args is None:
+                push(str(arg))
+            elif len(arg_args) == 0:
+                push(atom(arg))
+            else:
+                push(')')
+                push(arg)
+                push('(')
+            if op == '*':
+                if idx != 0:
+                    push(space)
+                    push(' ×')
+            elif op == '->':
+                if idx != 0:
+                    push(soft)
+                    push('→')
+            else:
+                push(space)
+
+
+# 没有参数的类型算子
+def atom(t: Any) -> str:
+    return '()' if t.op == 'unit' else t.op
+
+
+# ∀α∀β. 类型；η 只表示函数调用的结果没有被用到，不显示
+def print_scheme(p: Printer, free: list[Any], ty: Any):
+    if len(free) > 0:
+        for item in free:
+            if getattr(item, 'greek', None) is not Greek.Eta:
+                p.text('∀' + str(item))
+        p.text('.')
+        p.line()
+    print_type(p, ty)
+
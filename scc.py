@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+
+# 用 Tarjan 算法求有向图的强连通分量。图的顶点是 0 到 n - 1，successors[v] 是从 v 出发的边指向的顶点。
+#
+# 每个分量在它能到达的所有分量之后给出：如果边表示“依赖于”，那么每个分量都排在它所依赖的分量之后，
+# 可以按照返回的顺序依次处理。分量内部的顶点按编号排序。
+# 深度优先搜索使用显式的栈，图很大、依赖链很长时也不会递归过深
+def strongly_connected_components(successors: list[list[int]]) -> list[list[int]]:
+    n = len(successors)
+    index = [-1] * n
+    low = [0] * n
+    on_stack = [False] * n
+    stack: list[int] = []
+    components: list[list[int]] = []
+    counter = 0
+
+    for root in range(n):
+        if index[root] != -1:
+            continue
+        # 搜索栈中的项是 (顶点, 下一条要访问的边的下标)
+        work: list[tuple[int, int]] = [(root, 0)]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        while len(work) > 0:
+            v, edge = work[-1]
+            if edge < len(successors[v]):
+                work[-1] = (v, edge + 1)
+                w = successors[v][edge]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, 0))
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+                continue
+
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                if low[v] < low[parent]:
+                    low[parent] = low[v]
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component.append(w)
+                    if w == v:
+                        break
+                component.sort()
+                components.append(component)
+    return components
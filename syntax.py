@@ -1,144 +1,346 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Any
+
+from printer import Printer, LineBreak, breaks, to_string
 
 
 class Expr:
+    __slots__ = ()
+
+    start: int
+    end: int
+
+    def __str__(self) -> str:
+        return to_string(self)
+
+    def pretty(self, p: Printer):
+        print_expr(p, self)
+
     def need_quote(self) -> bool:
         return False
 
 
-@dataclass
+# 每种表达式的最后两个字段 start 和 end 是它在源代码中的范围 [start, end)，按字符（Unicode 码点）计的偏移量，
+# 不是 UTF-8 字节偏移（见 diagnostic.byte_offset）。
+# 不是由解析器产生的表达式（例如在程序中直接构造的）没有位置，两者都是 -1。位置不参与表达式的比较。
+# 解析器按位置传入这两个字段，比关键字参数快得多
+def span_field() -> Any:
+    return field(default=-1, compare=False, repr=False)
+
+
+@dataclass(slots=True)
 class ExprLitInt(Expr):
     value: int
-
-    def __str__(self) -> str:
-        return str(self.value)
+    start: int = span_field()
+    end: int = span_field()
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprLitBool(Expr):
     value: bool
-
-    def __str__(self) -> str:
-        return str(self.value)
+    start: int = span_field()
+    end: int = span_field()
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprLitStr(Expr):
     value: str
-
-    def __str__(self) -> str:
-        return f'"{self.value}"'
+    start: int = span_field()
+    end: int = span_field()
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprVar(Expr):
     x: str
-
-    def __str__(self) -> str:
-        return str(self.x)
+    start: int = span_field()
+    end: int = span_field()
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprAbs(Expr):
     x: str
     body: Expr
-
-    def __str__(self) -> str:
-        body = f'({self.body})' if self.body.need_quote() else str(self.body)
-        return f'λ{self.x}. {body}'
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprApp(Expr):
     e1: Expr
     e2: Expr
-
-    def __str__(self) -> str:
-        e1 = f'({self.e1})' if self.e1.need_quote() else str(self.e1)
-        e2 = f'({self.e2})' if self.e2.need_quote() else str(self.e2)
-        return f'{e1} {e2}'
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprLet(Expr):
     x: str
     e1: Expr
     e2: Expr
-
-    def __str__(self) -> str:
-        e1 = f'({self.e1})' if self.e1.need_quote() else str(self.e1)
-        e2 = f'({self.e2})' if isinstance(self.e2, ExprLet) else str(self.e2)
-        return f'let {self.x} = {e1} in {e2}'
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprStmt(Expr):
     stmts: list[Expr]
-
-    def __str__(self) -> str:
-        ret = ''
-        for (idx, stmt) in enumerate(self.stmts):
-            ret += str(stmt)
-            if idx != len(self.stmts) - 1:
-                ret += '; '
-        return ret
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprReturn(Expr):
     e: Expr | None
-
-    def __str__(self) -> str:
-        return f'return {self.e}' if self.e is not None else 'return'
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprIf(Expr):
     e1: Expr
     e2: Expr
     e3: Expr
-
-    def __str__(self) -> str:
-        e1 = f'({self.e1})' if self.e1.need_quote() else str(self.e1)
-        e2 = f'({self.e2})' if self.e2.need_quote() else str(self.e2)
-        e3 = f'({self.e3})' if self.e3.need_quote() else str(self.e3)
-        return f'if {e1} then {e2} else {e3}'
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprLetRec(Expr):
     decls: list[tuple[str, Expr]]
     body: Expr
-
-    def __str__(self) -> str:
-        ret = 'let rec '
-        for (idx, (name, expr)) in enumerate(self.decls):
-            expr_s = f'({expr}))' if expr.need_quote() else str(expr)
-            ret += f'{name} = {expr_s}'
-            if idx != len(self.decls) - 1:
-                ret += '; '
-        ret += ' in '
-        body_s = f'({self.body})' if self.body.need_quote() else str(self.body)
-        ret += body_s
-        return ret
+    start: int = span_field()
+    end: int = span_field()
 
     def need_quote(self):
         return True
+
+
+# 打印表达式，见 printer.py。字面量、变量之外的表达式作为子表达式时加上括号，
+# 但是语句序列中的语句、return 的返回值和 let 的主体（主体也是 let 时除外）不加括号。
+# 每个表达式是一组：函数应用在参数之前换行，λ 在函数体之前换行，let 在主体之前换行，语句序列在每条语句之前换行
+def print_expr(p: Printer, expr: Expr):
+    # 栈中的项是表达式、原样输出的字符串、LineBreak，或者 None（一组的结束）
+    stack: list[Any] = [expr]
+    push = stack.append
+
+    def push_quoted(e: Expr):
+        if type(e) is ExprVar:
+            push(e.x)
+        elif e.need_quote():
+            push(')')
+            push(e)
+            push('(')
+        else:
+            push(e)
+
+    pop = stack.pop
+    text, line, begin, end = p.text, p.line, p.begin, p.end
+    space, _ = breaks(p)
+    while len(stack) > 0:
+        e = pop()
+        if type(e) is str:
+            text(e)
+        elif e is None:
+            end()
+        elif type(e) is LineBreak:
+            line(e.flat)
+        elif isinstance(e, ExprVar):
+            text(e.x)
+        elif isinstance(e, ExprApp):
+            # 左结合的一串应用 ((f a) b) c 是一组，换行时各个参数的缩进相同
+            args: list[Expr] = []
+            head: Expr = e
+            while type(head) is ExprApp:
+                args.append(head.e2)
+                head = head.e1
+            begin(2)
+            text('(' * (len(args) - 1))
+            push(None)
+            for idx in range(len(args)):
+                if idx != 0:
+                    push(')')
+                push_quoted(args[idx])
+                push(space)
+            push_quoted(head)
+        elif isinstance(e, ExprLitInt) or isinstance(e, ExprLitBool):
+            text(str(e.value))
+        elif isinstance(e, ExprLitStr):
+            text(f'"{e.value}"')
+        elif isinstance(e, ExprAbs):
+            # 连续的 λx. (λy. ...) 是一组，参数写在同一行，只在最内层的函数体之前换行
+            params = [f'λ{e.x}.']
+            body = e.body
+            while type(body) is ExprAbs:
+                params.append(f'(λ{body.x}.')
+                body = body.body
+            begin(2)
+            text(' '.join(params))
+            push(None)
+            if len(params) > 1:
+                push(')' * (len(params) - 1))
+            push_quoted(body)
+            push(space)
+        elif isinstance(e, ExprLet):
+            begin()
+            text(f'let {e.x} = ')
+            push(None)
+            if isinstance(e.e2, ExprLet):
+                push_quoted(e.e2)
+            else:
+                push(e.e2)
+            push(space)
+            push(' in')
+            push_quoted(e.e1)
+        elif isinstance(e, ExprStmt):
+            begin()
+            push(None)
+            for idx in range(len(e.stmts) - 1, -1, -1):
+                push(e.stmts[idx])
+                if idx != 0:
+                    push(space)
+                    push(';')
+        elif isinstance(e, ExprReturn):
+            if e.e is None:
+                text('return')
+            else:
+                text('return ')
+                push(e.e)
+        elif isinstance(e, ExprIf):
+            begin()
+            text('if ')
+            push(None)
+            push_quoted(e.e3)
+            push('else ')
+            push(space)
+            push_quoted(e.e2)
+            push('then ')
+            push(space)
+            push_quoted(e.e1)
+        elif isinstance(e, ExprLetRec):
+            # 所有绑定是一组，主体在另一组中
+            begin()
+            begin(2)
+            text('let rec ')
+            push(None)
+            push_quoted(e.body)
+            push(space)
+            push(' in')
+            push(None)
+            for idx in range(len(e.decls) - 1, -1, -1):
+                name, decl = e.decls[idx]
+                push_quoted(decl)
+                push(f'{name} = ')
+                if idx != 0:
+                    push(space)
+                    push(';')
+        else:
+            raise Exception(f'未知的表达式 {e!r}')
+
+
+# 表达式结构的键：按前序把每个节点的种类和字段（不含位置）展开成一个元组。
+# 结构相同的表达式得到相等的键，可以用作字典的键，例如缓存表达式的推导结果
+def structure_key(expr: Expr) -> tuple[Any, ...]:
+    items: list[Any] = []
+    stack: list[Expr] = [expr]
+    while len(stack) > 0:
+        e = stack.pop()
+        items.append(type(e))
+        if isinstance(e, ExprLitInt) or isinstance(e, ExprLitBool) or isinstance(e, ExprLitStr):
+            items.append(e.value)
+        elif isinstance(e, ExprVar):
+            items.append(e.x)
+        elif isinstance(e, ExprAbs):
+            items.append(e.x)
+            stack.append(e.body)
+        elif isinstance(e, ExprApp):
+            stack.append(e.e2)
+            stack.append(e.e1)
+        elif isinstance(e, ExprLet):
+            items.append(e.x)
+            stack.append(e.e2)
+            stack.append(e.e1)
+        elif isinstance(e, ExprStmt):
+            items.append(len(e.stmts))
+            stack.extend(reversed(e.stmts))
+        elif isinstance(e, ExprReturn):
+            items.append(e.e is not None)
+            if e.e is not None:
+                stack.append(e.e)
+        elif isinstance(e, ExprIf):
+            stack.append(e.e3)
+            stack.append(e.e2)
+            stack.append(e.e1)
+        elif isinstance(e, ExprLetRec):
+            items.append(len(e.decls))
+            stack.append(e.body)
+            for (name, decl) in reversed(e.decls):
+                items.append(name)
+                stack.append(decl)
+        else:
+            raise Exception(f'未知的表达式 {e}')
+    return tuple(items)
+
+
+# 表达式中的自由变量
+def free_vars(expr: Expr) -> set[str]:
+    free: set[str] = set()
+    # 每个名字当前被多少层作用域绑定
+    bound: dict[str, int] = {}
+    # 栈中的项是表达式，或者 (名字, 是否进入作用域)，表示在此处进入或者离开这些名字的作用域
+    stack: list[Expr | tuple[list[str], bool]] = [expr]
+    while len(stack) > 0:
+        e = stack.pop()
+        if isinstance(e, tuple):
+            names, enter = e
+            for name in names:
+                bound[name] = bound.get(name, 0) + (1 if enter else -1)
+        elif isinstance(e, ExprVar):
+            if bound.get(e.x, 0) == 0:
+                free.add(e.x)
+        elif isinstance(e, ExprAbs):
+            stack.append(([e.x], False))
+            stack.append(e.body)
+            stack.append(([e.x], True))
+        elif isinstance(e, ExprApp):
+            stack.append(e.e2)
+            stack.append(e.e1)
+        elif isinstance(e, ExprLet):
+            # let 不是递归的，e1 中的 x 指的是外层的 x
+            stack.append(([e.x], False))
+            stack.append(e.e2)
+            stack.append(([e.x], True))
+            stack.append(e.e1)
+        elif isinstance(e, ExprStmt):
+            stack.extend(reversed(e.stmts))
+        elif isinstance(e, ExprReturn):
+            if e.e is not None:
+                stack.append(e.e)
+        elif isinstance(e, ExprIf):
+            stack.append(e.e3)
+            stack.append(e.e2)
+            stack.append(e.e1)
+        elif isinstance(e, ExprLetRec):
+            names = [name for (name, _) in e.decls]
+            stack.append((names, False))
+            stack.append(e.body)
+            stack.extend(reversed([decl for (_, decl) in e.decls]))
+            stack.append((names, True))
+    return free
@@ -0,0 +1,173 @@
+import random
+import unittest
+
+import arena
+import pl9je
+from arena import KIND_ABS, KIND_LET, KIND_LETREC, KIND_RETURN, KIND_VAR, Arena, from_expr, parse_arena
+from diagnostic import TyckException
+from parse import tokenize_compact, parse
+from syntax import Expr, ExprLitInt, ExprLitBool, ExprLitStr, ExprVar, ExprAbs, ExprApp, ExprLet, ExprStmt, ExprReturn, ExprIf, ExprLetRec
+from test_constraints import gen_expr
+
+FIELDS = ['kinds', 'a', 'b', 'c', 'starts', 'ends', 'extra', 'strings', 'ints', 'root']
+
+
+# 先序遍历中每个表达式的位置，表达式的比较不包括位置
+def spans(e: Expr) -> list[tuple[int, int]]:
+    ret = []
+    stack = [e]
+    while len(stack) > 0:
+        e = stack.pop()
+        ret.append((e.start, e.end))
+        stack.extend(reversed(arena.children(e)))
+    return ret
+
+
+# 推导的结果：通过时是类型方案，出错时是错误信息和出错的位置。每次都在新的上下文中推导，类型变量的编号可以直接比较
+def outcome(infer):
+    with pl9je.InferContext():
+        try:
+            return 'ok', str(infer())
+        except TyckException as e:
+            return 'error', e.text, e.span
+
+
+class TestArena(unittest.TestCase):
+    def assert_same_arena(self, a: Arena, b: Arena):
+        for name in FIELDS:
+            self.assertEqual(getattr(a, name), getattr(b, name), name)
+
+    # 随机的程序：直接解析成 arena 与先解析成表达式再转换相同，转换回表达式得到原来的表达式（包括位置），
+    # 在 arena 上推导的类型方案、错误信息和出错位置都与 pl9je 相同
+    def test_random_against_pl9je(self):
+        rng = random.Random(23)
+        for _ in range(1000):
+            source = gen_expr(rng, 4, [])
+            with self.subTest(source=source):
+                expr = parse(tokenize_compact(source))
+                ast = parse_arena(tokenize_compact(source))
+                self.assert_same_arena(ast, from_expr(expr))
+                round_trip = ast.to_expr()
+                self.assertEqual(round_trip, expr)
+                self.assertEqual(spans(round_trip), spans(expr))
+                self.assertEqual(outcome(lambda: arena.infer(ast)), outcome(lambda: pl9je.infer(expr)))
+
+    # 超出 32 位整数范围的字面量和不带值的 return
+    def test_literals(self):
+        for source in ['\\x. square 12345678901234567890', '\\x. return nothing', 'let f = \\x. (return nothing); x in f']:
+            with self.subTest(source=source):
+                expr = parse(tokenize_compact(source))
+                ast = parse_arena(tokenize_compact(source))
+                self.assertEqual(ast.to_expr(), expr)
+                self.assertEqual(outcome(lambda: arena.infer(ast)), outcome(lambda: pl9je.infer(expr)))
+
+
+NAMES = ['x', 'y', 'f']
+
+
+# 随机的表达式树：名字很少，所以经常有同名的绑定相互遮盖；已经生成的子表达式有时被原样重复使用，
+# 同一个对象出现在不同的作用域中
+def gen_tree(rng: random.Random, depth: int, pool: list[Expr]) -> Expr:
+    if len(pool) > 0 and rng.random() < 0.15:
+        return rng.choice(pool)
+    if depth == 0 or rng.random() < 0.2:
+        e: Expr = rng.choice([ExprVar(rng.choice(NAMES)), ExprVar('square'), ExprLitInt(1), ExprLitBool(True), ExprLitStr('s')])
+    else:
+        choice = rng.randrange(7)
+        sub = lambda: gen_tree(rng, depth - 1, pool)
+        if choice == 0:
+            e = ExprAbs(rng.choice(NAMES), sub())
+        elif choice == 1:
+            e = ExprApp(sub(), sub())
+        elif choice == 2:
+            e = ExprLet(rng.choice(NAMES), sub(), sub())
+        elif choice == 3:
+            e = ExprLetRec([(rng.choice(NAMES), sub()) for _ in range(rng.randrange(1, 4))], sub())
+        elif choice == 4:
+            e = ExprIf(sub(), sub(), sub())
+        elif choice == 5:
+            e = ExprStmt([sub(), sub()])
+        else:
+            e = ExprReturn(sub() if rng.random() < 0.8 else None)
+    pool.append(e)
+    return e
+
+
+# 节点中种类为 kind 的节点，按下标排列
+def nodes_of(ast: Arena, kind: int) -> list[int]:
+    return [n for n in range(len(ast)) if ast.kinds[n] == kind]
+
+
+class TestResolve(unittest.TestCase):
+    def assert_same_inference(self, expr: Expr):
+        ast = from_expr(expr)
+        self.assertEqual(outcome(lambda: arena.infer(ast)), outcome(lambda: pl9je.infer(expr)))
+
+    # 随机的表达式树（有遮盖、重复的 let rec 名字和共享的子树），按槽查找的推导与 pl9je 按名字查找的结果相同
+    def test_random_trees(self):
+        rng = random.Random(25)
+        for _ in range(3000):
+            expr = gen_tree(rng, 5, [])
+            with self.subTest(expr=str(expr)):
+                self.assert_same_inference(expr)
+
+    # 变量指向最内层的同名绑定；let 绑定的表达式中还看不到它自己的名字
+    def test_shadowing(self):
+        ast = parse_arena(tokenize_compact('\\x. \\x. x'))
+        ast.resolve()
+        inner = nodes_of(ast, KIND_ABS)[0]
+        self.assertEqual(ast.slots[nodes_of(ast, KIND_VAR)[0]], ast.slots[inner])
+
+        ast = parse_arena(tokenize_compact('let x = 1 in let x = x in x'))
+        ast.resolve()
+        outer, inner = nodes_of(ast, KIND_LET)[1], nodes_of(ast, KIND_LET)[0]
+        self.assertEqual([ast.slots[n] for n in nodes_of(ast, KIND_VAR)], [ast.slots[outer], ast.slots[inner]])
+        self.assert_same_inference(parse(tokenize_compact('let x = true in let x = condint x in x')))
+
+    # let rec 中重复的名字以最后一个绑定为准，和 pl9je 的环境一致
+    def test_duplicate_let_rec(self):
+        source = 'let rec f = \\y. 1, f = \\y. true in f'
+        ast = parse_arena(tokenize_compact(source))
+        ast.resolve()
+        letrec = nodes_of(ast, KIND_LETREC)[0]
+        self.assertEqual(ast.slots[nodes_of(ast, KIND_VAR)[-1]], ast.slots[letrec] + 1)
+        self.assertEqual(outcome(lambda: arena.infer(ast)), ('ok', '∀β2. β2→bool'))
+        self.assert_same_inference(parse(tokenize_compact(source)))
+        self.assert_same_inference(parse(tokenize_compact('let rec f = \\y. g y, g = \\y. 1, f = \\y. true in f')))
+
+    # 同一个表达式对象出现在不同的作用域中，每次出现都有自己的节点，指向各自的绑定
+    def test_shared_subtree(self):
+        shared = ExprVar('x')
+        expr = ExprLet('x', ExprLitBool(True), ExprApp(ExprAbs('x', ExprApp(ExprVar('square'), shared)), ExprApp(ExprVar('condint'), shared)))
+        ast = from_expr(expr)
+        ast.resolve()
+        slots = [ast.slots[n] for n in nodes_of(ast, KIND_VAR) if ast.strings[ast.a[n]] == 'x']
+        self.assertEqual(slots, [ast.slots[nodes_of(ast, KIND_ABS)[0]], ast.slots[nodes_of(ast, KIND_LET)[0]]])
+        self.assert_same_inference(expr)
+
+    # return 指向最内层的 λ 的参数的槽，let 不会改变所在的函数
+    def test_return(self):
+        ast = parse_arena(tokenize_compact('\\f. let g = \\y. return 1 in return true'))
+        ast.resolve()
+        inner, outer = nodes_of(ast, KIND_ABS)
+        self.assertEqual([ast.slots[n] for n in nodes_of(ast, KIND_RETURN)], [ast.slots[inner], ast.slots[outer]])
+        self.assertEqual(outcome(lambda: arena.infer(ast)), ('ok', '∀β0. β0→bool'))
+        self.assert_same_inference(ast.to_expr())
+        self.assert_same_inference(parse(tokenize_compact('return 1')))
+
+    # 以子表达式为根推导时重新解析作用域，之后再推导整个程序时也重新解析
+    def test_infer_subtree(self):
+        source = 'let f = \\x. x in let g = \\y. f y in g 1'
+        ast = parse_arena(tokenize_compact(source))
+        expr = parse(tokenize_compact(source))
+        self.assertEqual(outcome(lambda: arena.infer(ast)), outcome(lambda: pl9je.infer(expr)))
+        for (node, sub) in [(nodes_of(ast, KIND_ABS)[0], expr.e1), (nodes_of(ast, KIND_LET)[0], expr.e2)]:
+            with self.subTest(sub=str(sub)):
+                self.assertEqual(outcome(lambda: arena.infer(ast, node=node)), outcome(lambda: pl9je.infer(sub)))
+                self.assertEqual(ast.resolved, node)
+        self.assertEqual(outcome(lambda: arena.infer(ast)), outcome(lambda: pl9je.infer(expr)))
+        self.assertEqual(ast.resolved, ast.root)
+
+
+if __name__ == '__main__':
+    unittest.main()
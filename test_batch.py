@@ -0,0 +1,150 @@
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from batch import check_batch, check_program, init_worker, main, read_programs
+
+PROGRAMS = [
+    ('id', '\\x. x'),
+    ('error', 'let f = \\x. x in\nf 1 true'),
+    ('if', 'if true then 1 else 2'),
+    ('syntax', 'let x = in'),
+    ('app', '(\\x. x) 1'),
+]
+
+
+class TestCheckProgram(unittest.TestCase):
+    def tearDown(self):
+        init_worker('j')
+
+    def test_ok(self):
+        init_worker('j')
+        self.assertEqual(check_program(('a', 'let id = \\x. x in id')), {'id': 'a', 'ok': True, 'type': '∀β1. β1→β1'})
+
+    # 类型错误附带最内层的带有位置的表达式的范围，以及它的行列号
+    def test_type_error(self):
+        for algorithm in ['j', 'w', 'c']:
+            with self.subTest(algorithm=algorithm):
+                init_worker(algorithm)
+                result = check_program(PROGRAMS[1])
+                self.assertFalse(result['ok'])
+                self.assertNotIn('unsupported', result)
+                self.assertIn('当检查第 2 行第 1 列的表达式时发生', result['error'])
+                self.assertEqual((result['span'], result['line'], result['column']), ([17, 25], 2, 1))
+
+    # span 和 column 按字符计，byte_span 是 UTF-8 字节偏移
+    def test_byte_span(self):
+        init_worker('j')
+        source = 'let s = "中文" in\nsquare s; s'
+        result = check_program(('utf8', source))
+        self.assertEqual(result['span'], [16, 24])
+        self.assertEqual(source[16:24], 'square s')
+        self.assertEqual(result['byte_span'], [20, 28])
+        self.assertEqual(source.encode('utf-8')[20:28], b'square s')
+        self.assertEqual((result['line'], result['column']), (2, 1))
+
+    def test_syntax_error(self):
+        init_worker('j')
+        result = check_program(PROGRAMS[3])
+        self.assertEqual(result['ok'], False)
+        self.assertNotIn('span', result)
+
+    # 算法 W 不支持的语法不算作类型错误
+    def test_unsupported(self):
+        init_worker('w')
+        self.assertEqual(check_program(PROGRAMS[2]), {
+            'id': 'if', 'ok': False, 'unsupported': True, 'error': '不支持的语法：if',
+            'span': [0, 21], 'byte_span': [0, 21], 'line': 1, 'column': 1,
+        })
+        result = check_program(('stmt', 'let x = 1 in\nsquare x; x'))
+        self.assertTrue(result['unsupported'])
+        self.assertEqual((result['line'], result['column']), (2, 1))
+        init_worker('j')
+        self.assertEqual(check_program(PROGRAMS[2]), {'id': 'if', 'ok': True, 'type': 'int'})
+
+    # 每个程序在新的推导上下文中检查，结果与之前检查过什么无关
+    def test_independent(self):
+        init_worker('j')
+        first = check_program(PROGRAMS[0])
+        for program in PROGRAMS:
+            check_program(program)
+        self.assertEqual(check_program(PROGRAMS[0]), first)
+
+
+class TestCheckBatch(unittest.TestCase):
+    def tearDown(self):
+        init_worker('j')
+
+    def test_in_process(self):
+        results = list(check_batch(PROGRAMS, jobs=1))
+        self.assertEqual([r['id'] for r in results], [id for (id, _) in PROGRAMS])
+        self.assertEqual([r['ok'] for r in results], [True, False, True, False, True])
+
+    # 工作进程的结果与在当前进程中检查的结果相同，并且按输入的顺序返回
+    def test_pool(self):
+        programs = [(f'{idx}', source) for idx in range(10) for (_, source) in PROGRAMS]
+        for algorithm in ['j', 'w', 'c']:
+            with self.subTest(algorithm=algorithm):
+                expected = list(check_batch(programs, algorithm, jobs=1))
+                self.assertEqual(list(check_batch(programs, algorithm, jobs=2, chunksize=3)), expected)
+                self.assertEqual(list(check_batch(programs, algorithm, jobs=2)), expected)
+
+    # 使用缓存时（第一次写入，第二次读出）结果与不使用缓存时相同
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            expected = list(check_batch(PROGRAMS, jobs=1))
+            self.assertEqual(list(check_batch(PROGRAMS, jobs=1, cache_dir=Path(root))), expected)
+            self.assertEqual(list(check_batch(PROGRAMS, jobs=2, cache_dir=Path(root))), expected)
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+        init_worker('j')
+
+    def write_jsonl(self, programs: list[tuple[str, str]]) -> Path:
+        path = self.root / 'input.jsonl'
+        path.write_text(''.join(json.dumps({'id': id, 'source': source}) + '\n' for (id, source) in programs),
+                        encoding='utf-8')
+        return path
+
+    def test_output(self):
+        output = self.root / 'output.jsonl'
+        self.assertEqual(main([str(self.write_jsonl(PROGRAMS[:1])), '-j', '1', '-o', str(output)]), 0)
+        self.assertEqual(main([str(self.write_jsonl(PROGRAMS)), '-j', '1', '-o', str(output)]), 1)
+        lines = output.read_text(encoding='utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], list(check_batch(PROGRAMS, jobs=1)))
+
+    # 缓存只支持算法 J
+    def test_cache_requires_j(self):
+        input = self.write_jsonl(PROGRAMS)
+        for algorithm in ['w', 'c']:
+            with self.subTest(algorithm=algorithm):
+                with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as e:
+                        main([str(input), '-a', algorithm, '--cache', str(self.root / 'cache')])
+                self.assertEqual(e.exception.code, 2)
+                self.assertIn('--cache', stderr.getvalue())
+        self.assertFalse((self.root / 'cache').exists())
+
+    def test_read_programs(self):
+        (self.root / 'src' / 'sub').mkdir(parents=True)
+        (self.root / 'src' / 'b.9').write_text('1', encoding='utf-8')
+        (self.root / 'src' / 'sub' / 'a.9').write_text('true', encoding='utf-8')
+        (self.root / 'src' / 'c.txt').write_text('"s"', encoding='utf-8')
+        self.assertEqual(list(read_programs(self.root / 'src', '*.9')), [('b.9', '1'), ('sub/a.9', 'true')])
+
+        path = self.root / 'input.jsonl'
+        path.write_text('{"source": "1"}\n\n{"id": "x", "source": "true"}\n', encoding='utf-8')
+        self.assertEqual(list(read_programs(path)), [(1, '1'), ('x', 'true')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from cache import CachedResult, TypeCache, decode_result, encode_result
+from parse import tokenize, parse
+from pl9je import InferContext, default_env, infer
+
+PROGRAMS = [
+    'let id = \\x. x in id',
+    'let id = \\x. x in let k = \\x. \\y. x in k (id 1) (id true)',
+    'let rec even = \\n. odd n, odd = \\n. even n in even',
+    'let rec f = \\x. if condint x then f x else square x in f',
+    'let s = "hello" in print s; \\x. return x',
+    '\\f. \\g. \\x. f (g x)',
+]
+
+ERRORS = [
+    'square true',
+    'let f = \\x. x x in f',
+    'let x = 1 in\nlet y = x true in y',
+    'let rec f = \\x. square (f x) in f true true',
+]
+
+
+class TestTypeCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # 第一次检查写入缓存，之后的检查（包括新的 TypeCache）读出同样的结果
+    def roundtrip(self, source: str) -> tuple[CachedResult, CachedResult]:
+        first = TypeCache(self.root).check(source)
+        self.assertFalse(first.hit)
+        second = TypeCache(self.root).check(source)
+        self.assertTrue(second.hit)
+        self.assertEqual(second.ok, first.ok)
+        self.assertEqual(second.error, first.error)
+        self.assertEqual(second.span, first.span)
+        self.assertEqual(str(second.scheme), str(first.scheme))
+        self.assertEqual([(name, str(scheme)) for (name, scheme) in second.bindings],
+                         [(name, str(scheme)) for (name, scheme) in first.bindings])
+        self.assertEqual(second.expr, first.expr)
+        return first, second
+
+    def test_scheme(self):
+        for source in PROGRAMS:
+            with self.subTest(source=source):
+                first, second = self.roundtrip(source)
+                self.assertTrue(second.ok)
+                with InferContext():
+                    expected = infer(parse(tokenize(source)), default_env())
+                self.assertEqual(str(second.scheme), str(expected))
+
+    def test_error_and_span(self):
+        for source in ERRORS:
+            with self.subTest(source=source):
+                first, second = self.roundtrip(source)
+                self.assertFalse(second.ok)
+                self.assertIsNone(second.scheme)
+                self.assertIsNotNone(second.error)
+                self.assertIsNotNone(second.span)
+                start, end = second.span
+                self.assertTrue(0 <= start < end <= len(source))
+
+    def test_bindings(self):
+        _, second = self.roundtrip('let id = \\x. x in let rec f = \\x. f x, g = \\y. y in g 1')
+        self.assertEqual([name for (name, _) in second.bindings], ['id', 'f', 'g'])
+        self.assertEqual(len(second.bindings[0][1].free), 1)
+
+    # 语法树的解码不依赖于先解码绑定，解码完两节之后释放文件的内容
+    def test_ast_lazy(self):
+        source = 'let s = "ab" in if true then (print s; 1) else let rec f = \\x. f x in f 2'
+        first = TypeCache(self.root).check(source)
+        second = TypeCache(self.root).check(source)
+        self.assertTrue(second.hit)
+        self.assertEqual(second.expr, first.expr)
+        self.assertIsNotNone(second._data)
+        second.bindings
+        self.assertIsNone(second._data)
+
+    def test_encode_decode(self):
+        expr = parse(tokenize('let x = 1 in x'))
+        with InferContext():
+            scheme = infer(expr, default_env())
+        for result in [CachedResult(False, scheme, None, None, [('x', scheme)], expr),
+                       CachedResult(False, None, '错误', (3, 7), [], expr),
+                       CachedResult(False, None, '没有位置的错误', None, [], expr)]:
+            decoded = decode_result(memoryview(encode_result(result)))
+            self.assertTrue(decoded.hit)
+            self.assertEqual(decoded.ok, result.ok)
+            self.assertEqual(str(decoded.scheme), str(result.scheme))
+            self.assertEqual(decoded.error, result.error)
+            self.assertEqual(decoded.span, result.span)
+            self.assertEqual([(name, str(s)) for (name, s) in decoded.bindings],
+                             [(name, str(s)) for (name, s) in result.bindings])
+            self.assertEqual(decoded.expr, expr)
+
+    # 损坏的缓存文件当作没有命中，重新检查并覆盖
+    def test_corrupted(self):
+        source = 'let id = \\x. x in id 1'
+        cache = TypeCache(self.root)
+        first = cache.check(source)
+        cache.path(source).write_bytes(b'garbage')
+        again = cache.check(source)
+        self.assertFalse(again.hit)
+        self.assertEqual(str(again.scheme), str(first.scheme))
+        self.assertTrue(cache.check(source).hit)
+
+    # 环境不同时不共享缓存项
+    def test_env_fingerprint(self):
+        env = default_env()
+        env.bind('one', infer(parse(tokenize('1'))))
+        self.assertNotEqual(TypeCache(self.root).path('one'), TypeCache(self.root, env).path('one'))
+        result = TypeCache(self.root, env).check('one')
+        self.assertTrue(result.ok)
+        self.assertFalse(TypeCache(self.root).check('one').ok)
+
+    def test_evict(self):
+        cache = TypeCache(self.root, max_bytes=4096)
+        for i in range(200):
+            cache.check(f'let x{i} = {i} in \\y. y x{i}')
+        total = sum(path.stat().st_size for path in self.root.glob('*/*.bin'))
+        self.assertLessEqual(total, 4096)
+        self.assertGreater(total, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
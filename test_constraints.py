@@ -0,0 +1,74 @@
+import random
+import unittest
+
+import constraints
+import pl9je
+from diagnostic import TyckException
+from incremental import scheme_key
+from parse import tokenize, parse
+
+VARS = ['x', 'y', 'f', 'g']
+
+
+# 随机的程序：变量大多是已经绑定的名字，其余的来自默认环境（或者尚未定义）
+def gen_expr(rng: random.Random, depth: int, bound: list[str]) -> str:
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice([*bound, *bound, 'square', 'condint', '1', 'true', '"s"', 'h'])
+    choice = rng.randrange(7)
+    if choice == 0:
+        x = rng.choice(VARS)
+        return f'(\\{x}. {gen_expr(rng, depth - 1, bound + [x])})'
+    elif choice == 1:
+        return f'({gen_expr(rng, depth - 1, bound)} {gen_expr(rng, depth - 1, bound)})'
+    elif choice == 2:
+        x = rng.choice(VARS)
+        return f'(let {x} = {gen_expr(rng, depth - 1, bound)} in {gen_expr(rng, depth - 1, bound + [x])})'
+    elif choice == 3:
+        names = rng.sample(VARS, rng.randrange(1, 3))
+        inner = bound + names
+        decls = ', '.join(f'{x} = {gen_expr(rng, depth - 1, inner)}' for x in names)
+        return f'(let rec {decls} in {gen_expr(rng, depth - 1, inner)})'
+    elif choice == 4:
+        return f'(if {gen_expr(rng, depth - 1, bound)} then {gen_expr(rng, depth - 1, bound)} else {gen_expr(rng, depth - 1, bound)})'
+    elif choice == 5:
+        return f'({gen_expr(rng, depth - 1, bound)}; {gen_expr(rng, depth - 1, bound)})'
+    else:
+        return f'(return {gen_expr(rng, depth - 1, bound)})'
+
+
+# 通过检查时是类型方案的规范形式（与类型变量的编号无关），出错时只记录出错
+def outcome(infer, expr, defer_occurs_check: bool):
+    with pl9je.InferContext(defer_occurs_check=defer_occurs_check):
+        try:
+            return 'ok', scheme_key(infer(expr))
+        except TyckException:
+            return 'error', None
+
+
+class TestSolve(unittest.TestCase):
+    # 求解器推迟等式之后，结果与算法 J 相同（α 等价），出错的程序也同样出错
+    def test_random_against_j(self):
+        rng = random.Random(19)
+        counts = {'ok': 0, 'error': 0}
+        for _ in range(2000):
+            source = gen_expr(rng, 4, [])
+            expr = parse(tokenize(source))
+            for defer in [False, True]:
+                expected = outcome(pl9je.infer, expr, defer)
+                self.assertEqual(outcome(constraints.infer, expr, defer), expected, source)
+                counts[expected[0]] += 1
+        self.assertGreater(counts['ok'], 100)
+
+    # 出错的等式被推迟之后，错误信息仍然带有出错的表达式的上下文，层级也恢复到求解之前
+    def test_error_context(self):
+        expr = parse(tokenize('let f = \\x. square (condint x) in f'))
+        with pl9je.InferContext() as context:
+            level = context.store.current_level
+            with self.assertRaises(TyckException) as e:
+                constraints.solve(constraints.generate(expr), pl9je.default_env())
+            self.assertEqual(context.store.current_level, level)
+        self.assertGreater(len(e.exception.frames), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import sys
+import unittest
+
+import constraints
+import pl9
+import pl9je
+from diagnostic import TyckException
+from parse import tokenize_compact, parse
+
+# 远大于 Python 的递归深度限制：解析、推导和生成错误信息都不能依赖 Python 的调用栈
+DEPTH = 20000
+
+
+# let x0 = 1 in let x1 = square x0 in ... in xn
+def let_chain(n: int, last: str | None = None) -> str:
+    return 'let x0 = 1 in ' + ' '.join(f'let x{i + 1} = square x{i} in' for i in range(n)) + (last or f' x{n}')
+
+
+# \x0. \x1. ... \xn. x0
+def lambda_nest(n: int) -> str:
+    return ' '.join(f'\\x{i}.' for i in range(n)) + ' x0'
+
+
+# square (square (... (square 1)))
+def app_nest(n: int) -> str:
+    return 'square (' * n + '1' + ')' * n
+
+
+class TestDeep(unittest.TestCase):
+    def test_depth_exceeds_recursion_limit(self):
+        self.assertGreater(DEPTH, 10 * sys.getrecursionlimit())
+
+    def test_infer(self):
+        cases = [
+            ('let chain', let_chain(DEPTH), 'int', True),
+            ('lambda nest', lambda_nest(DEPTH), None, True),
+            ('app nest', app_nest(DEPTH), 'int', True),
+            # 语句序列和括号嵌套得再深，解析的结果也是浅的
+            ('statements', '; '.join(['square 1'] * DEPTH), 'int', False),
+            ('parens', '(' * DEPTH + '1' + ')' * DEPTH, 'int', True),
+        ]
+        for (name, source, expected, w) in cases:
+            with self.subTest(name=name):
+                expr = parse(tokenize_compact(source))
+                checkers = [pl9je.infer, constraints.infer] + ([pl9.infer] if w else [])
+                for infer in checkers:
+                    scheme = infer(expr)
+                    if expected is not None:
+                        self.assertEqual(str(scheme), expected, infer.__module__)
+                    else:
+                        self.assertEqual(len(scheme.free), DEPTH, infer.__module__)
+
+    # 最内层出错时，错误从很深的地方向外传播，每一层都补充一条上下文
+    def test_error_text(self):
+        source = let_chain(DEPTH, ' square true')
+        expr = parse(tokenize_compact(source))
+        for infer in [pl9je.infer, constraints.infer, pl9.infer]:
+            with self.subTest(infer=infer.__module__):
+                with self.assertRaises(TyckException) as cm:
+                    infer(expr)
+                e = cm.exception
+                self.assertGreater(len(e.frames), DEPTH)
+                e.source = source
+                text = e.text
+                self.assertGreater(text.count('\n'), DEPTH)
+                self.assertEqual(e.span, (len(source) - len('square true'), len(source)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import random
+import unittest
+
+from hamt import PersistentMap
+
+
+# 哈希值可以任意指定的键，用于构造哈希冲突
+class Key:
+    __slots__ = ('name', 'h')
+
+    def __init__(self, name: str, h: int):
+        self.name = name
+        self.h = h
+
+    def __hash__(self) -> int:
+        return self.h
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Key) and self.name == other.name
+
+    def __repr__(self) -> str:
+        return f'Key({self.name!r}, {self.h:#x})'
+
+
+class TestPersistentMap(unittest.TestCase):
+    def assert_same(self, m: PersistentMap, expected: dict):
+        self.assertEqual(len(m), len(expected))
+        self.assertEqual(dict(m.items()), expected)
+        for (key, value) in expected.items():
+            self.assertIn(key, m)
+            self.assertEqual(m.get(key), value)
+
+    def test_set_get(self):
+        m = PersistentMap()
+        expected = {}
+        for i in range(1000):
+            m = m.set(f'x{i}', i)
+            expected[f'x{i}'] = i
+        self.assert_same(m, expected)
+        self.assertIsNone(m.get('y'))
+        self.assertEqual(m.get('y', 42), 42)
+        self.assertNotIn('y', m)
+
+    def test_overwrite(self):
+        m = PersistentMap().set('a', 1).set('b', 2)
+        m2 = m.set('a', 3)
+        self.assert_same(m2, {'a': 3, 'b': 2})
+        self.assert_same(m, {'a': 1, 'b': 2})
+
+    def test_persistent(self):
+        maps = [PersistentMap()]
+        for i in range(200):
+            maps.append(maps[-1].set(i, str(i)))
+        for (n, m) in enumerate(maps):
+            self.assert_same(m, {i: str(i) for i in range(n)})
+
+    # 哈希值完全相同的键放进同一个冲突节点
+    def test_full_collision(self):
+        keys = [Key(f'k{i}', 0x1234) for i in range(10)]
+        m = PersistentMap()
+        for (i, key) in enumerate(keys):
+            m = m.set(key, i)
+        self.assert_same(m, {key: i for (i, key) in enumerate(keys)})
+        self.assertIsNone(m.get(Key('other', 0x1234)))
+        self.assertNotIn(Key('other', 0x1234), m)
+
+        # 覆盖冲突节点中的键不增加大小，旧的映射保持不变
+        m2 = m.set(keys[3], 'new')
+        self.assertEqual(len(m2), len(keys))
+        self.assertEqual(m2.get(keys[3]), 'new')
+        self.assertEqual(m.get(keys[3]), 3)
+        for (i, key) in enumerate(keys):
+            if i != 3:
+                self.assertEqual(m2.get(key), i)
+
+    # 低位相同、只在高位不同的哈希值要一直下降到很深的层次才能分开
+    def test_shared_prefix(self):
+        keys = [Key(f'k{i}', (i << 55) | 0x7) for i in range(16)]
+        m = PersistentMap()
+        for (i, key) in enumerate(keys):
+            m = m.set(key, i)
+        self.assert_same(m, {key: i for (i, key) in enumerate(keys)})
+        self.assertGreater(m.depth(keys[0]), 10)
+
+    # 冲突节点所在的位置又插入了哈希值不同、但前缀相同的键，冲突节点被移到下一层
+    def test_collision_then_split(self):
+        a = Key('a', 0x21)
+        b = Key('b', 0x21)
+        c = Key('c', 0x41)
+        d = Key('d', 0x21 | (1 << 40))
+        m = PersistentMap().set(a, 1).set(b, 2)
+        m = m.set(c, 3).set(d, 4)
+        self.assert_same(m, {a: 1, b: 2, c: 3, d: 4})
+        m2 = m.set(Key('e', 0x21), 5).set(b, 6)
+        self.assert_same(m2, {a: 1, b: 6, c: 3, d: 4, Key('e', 0x21): 5})
+        self.assert_same(m, {a: 1, b: 2, c: 3, d: 4})
+
+    # 负的哈希值与截断到 64 位之后的哈希值应当一致
+    def test_negative_hash(self):
+        keys = [Key(f'n{i}', -i - 1) for i in range(100)] + [Key(f'p{i}', i) for i in range(100)]
+        m = PersistentMap()
+        for (i, key) in enumerate(keys):
+            m = m.set(key, i)
+        self.assert_same(m, {key: i for (i, key) in enumerate(keys)})
+
+    # 与 dict 对比：哈希值只取很少的几种，冲突、分裂和覆盖都会频繁发生
+    def test_random_against_dict(self):
+        rng = random.Random(9)
+        choices = [0, 1, 32, 33, 1 << 35, (1 << 35) | 1, 1 << 63, -1]
+        # 同一个名字总是有同一个哈希值
+        hashes = {f'k{i}': rng.choice(choices) for i in range(300)}
+        m = PersistentMap()
+        expected = {}
+        for step in range(3000):
+            name = f'k{rng.randrange(300)}'
+            key = Key(name, hashes[name])
+            m = m.set(key, step)
+            expected[key] = step
+        self.assert_same(m, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import random
+import unittest
+from unittest import mock
+
+import incremental
+from diagnostic import TyckException
+from incremental import IncrementalChecker, scheme_key
+from parse import tokenize_compact, parse
+from pl9je import InferContext, infer
+
+BODIES = [
+    '\\x. x',
+    '\\x. \\y. x',
+    '\\f. \\x. f (f x)',
+    '\\x. square x',
+    '\\p. \\q. q p',
+    'k id',
+    'id 1',
+    'twice (k 1)',
+    'k true 1',
+    '\\x. x x',
+    'a',
+]
+NAMES = ['id', 'k', 'twice', 'a', 'b', 'c']
+
+
+# 检查的结果：通过时是类型方案的规范形式（与类型变量的名字无关），出错时是出错的位置
+def outcome(check, source: str):
+    try:
+        return 'ok', str(scheme_key(check(parse(tokenize_compact(source)), source)))
+    except TyckException as e:
+        return 'error', e.span
+
+
+def full_check(expr, source):
+    with InferContext():
+        return infer(expr)
+
+
+class TestIncrementalChecker(unittest.TestCase):
+    def assert_same(self, checker: IncrementalChecker, source: str):
+        self.assertEqual(outcome(checker.check, source), outcome(full_check, source), source)
+
+    def test_edits(self):
+        checker = IncrementalChecker()
+        sources = [
+            'let id = \\x. x in let k = \\x. \\y. x in k id 1',
+            # 修改最后的表达式
+            'let id = \\x. x in let k = \\x. \\y. x in k 1 id',
+            # 修改一个绑定的实现，但不改变它的类型
+            'let id = \\y. y in let k = \\x. \\y. x in k 1 id',
+            # 改变一个绑定的类型，用到它的绑定需要重新推导
+            'let id = \\y. square y in let k = \\x. \\y. x in let z = id 1 in k z id',
+            # 引入类型错误，再改回来
+            'let id = \\y. square y in let k = \\x. \\y. x in let z = id true in k z id',
+            'let id = \\y. y in let k = \\x. \\y. x in let z = id true in k z id',
+            'let rec f = \\x. g x, g = \\x. f x in let h = f 1 in h',
+            'let rec f = \\x. g x, g = \\x. square (f x) in let h = f 1 in h',
+        ]
+        for source in sources:
+            self.assert_same(checker, source)
+
+    # 错误信息中的上下文与完整检查时相同
+    def test_error_text(self):
+        source = 'let id = \\x. x in\nlet y = square true in\ny'
+        checker = IncrementalChecker()
+        with self.assertRaises(TyckException) as incremental_error:
+            checker.check(parse(tokenize_compact(source)), source)
+        with self.assertRaises(TyckException) as full_error:
+            full_check(parse(tokenize_compact(source)), source)
+        self.assertEqual(incremental_error.exception.span, full_error.exception.span)
+        self.assertEqual(len(incremental_error.exception.frames), len(full_error.exception.frames))
+
+    # 只修改最后一个绑定时，前面的绑定都命中缓存
+    def test_reuse(self):
+        checker = IncrementalChecker()
+        prefix = ''.join(f'let x{i} = \\y. y x{i - 1} in ' if i > 0 else 'let x0 = 1 in ' for i in range(20))
+        self.assert_same(checker, prefix + 'x19')
+        misses = checker.misses
+        self.assert_same(checker, prefix + 'x18')
+        self.assertEqual(checker.misses, misses + 1)
+        # 不带源代码时同样复用
+        misses = checker.misses
+        checker.check(parse(tokenize_compact(prefix + 'x17')))
+        self.assertEqual(checker.misses, misses + 1)
+
+    # 随机的修改序列，与完整检查对比；整理上下文的阈值调低，使得整理经常发生
+    def test_random_against_full(self):
+        rng = random.Random(16)
+        with mock.patch.object(incremental, 'COMPACT_MIN_VARS', 8):
+            checker = IncrementalChecker()
+            for _ in range(300):
+                source = ''.join(f'let {name} = {rng.choice(BODIES)} in ' for name in NAMES) + rng.choice(NAMES)
+                self.assert_same(checker, source)
+
+    # 上下文的大小与缓存的大小成正比，不随检查的次数增长
+    def test_bounded_context(self):
+        checker = IncrementalChecker()
+        for i in range(3000):
+            source = f'let f = \\x. \\y. \\z. x (y z) {i} in let g = \\a. f a in g'
+            checker.check(parse(tokenize_compact(source)), source)
+        self.assertLessEqual(len(checker.context.store.vars), 2 * incremental.COMPACT_MIN_VARS)
+        self.assertEqual(len(checker.cache), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
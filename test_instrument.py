@@ -0,0 +1,105 @@
+import random
+import sys
+import unittest
+from collections import Counter
+
+import arena
+import constraints
+import pl9je
+from instrument import Profile, hooks, profile_source
+from parse import tokenize_compact, parse
+from syntax import Expr
+from test_constraints import gen_expr
+
+
+# 被替换的每个属性：(所在的对象, 属性名, 原来的值)，包括在其他模块中直接导入的同一个函数
+def patched_attributes() -> list[tuple[object, str, object]]:
+    ret = []
+    for (owner, name, _) in hooks(Profile()):
+        original = getattr(owner, name)
+        ret.append((owner, name, original))
+        for module in list(sys.modules.values()):
+            if module is not owner and getattr(module, name, None) is original:
+                ret.append((module, name, original))
+    return ret
+
+
+# 每种表达式的节点个数
+def node_kinds(e: Expr) -> Counter[str]:
+    ret: Counter[str] = Counter()
+    stack = [e]
+    while len(stack) > 0:
+        e = stack.pop()
+        ret['j:' + type(e).__name__] += 1
+        stack.extend(arena.children(e))
+    return ret
+
+
+class TestProfile(unittest.TestCase):
+    # 退出时每个被替换的属性都换回原来的值，包括其他模块中直接导入的副本（例如 constraints 和 arena 中的 unify）
+    def test_restore(self):
+        before = patched_attributes()
+        owners = {(owner, name) for (owner, name, _) in before}
+        self.assertIn((constraints, 'unify'), owners)
+        self.assertIn((arena, 'unify'), owners)
+        self.assertIn((arena, 'generalize'), owners)
+
+        with Profile():
+            for (owner, name, original) in before:
+                self.assertIsNot(getattr(owner, name), original, (owner, name))
+        for (owner, name, original) in before:
+            self.assertIs(getattr(owner, name), original, (owner, name))
+
+        with self.assertRaises(ZeroDivisionError):
+            with Profile():
+                1 / 0
+        for (owner, name, original) in before:
+            self.assertIs(getattr(owner, name), original, (owner, name))
+
+    # 同一时刻只能有一个 Profile，嵌套时报错，外层的替换不受影响
+    def test_nested(self):
+        unify = pl9je.unify
+        with Profile():
+            patched = pl9je.unify
+            with self.assertRaises(Exception):
+                with Profile():
+                    pass
+            self.assertIs(pl9je.unify, patched)
+        self.assertIs(pl9je.unify, unify)
+        with Profile():
+            pass
+
+    # j:<种类> 的调用次数等于这种节点的个数，包括直接得到结果的叶子（变量和字面量）
+    def test_node_counts(self):
+        rng = random.Random(20)
+        checked = 0
+        for _ in range(300):
+            source = gen_expr(rng, 4, [])
+            ok, profile = profile_source(source)
+            if not ok:
+                continue
+            checked += 1
+            calls = {name: stats.calls for (name, stats) in profile.frames.items() if name.startswith('j:')}
+            self.assertEqual(calls, dict(node_kinds(parse(tokenize_compact(source)))), source)
+        self.assertGreater(checked, 50)
+
+    # 出错时也能正确地离开每一帧：调用栈恢复为空，节点的个数不超过表达式中的个数
+    def test_error(self):
+        source = 'let f = \\x. square x in (f 1; f true)'
+        ok, profile = profile_source(source)
+        self.assertFalse(ok)
+        self.assertEqual(profile.stack, [])
+        expected = node_kinds(parse(tokenize_compact(source)))
+        for (name, stats) in profile.frames.items():
+            if name.startswith('j:'):
+                self.assertLessEqual(stats.calls, expected[name], name)
+
+    def test_constraints(self):
+        ok, profile = profile_source('let id = \\x. x in id 1', constraints)
+        self.assertTrue(ok)
+        self.assertEqual(profile.frames['generate'].calls, 1)
+        self.assertGreater(profile.frames['solve'].calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import io
+import random
+import unittest
+from collections import deque
+
+import pl9je
+from diagnostic import TyckException
+from parse import STREAM_INTERN_LIMIT, tokenize, tokenize_compact, tokenize_stream, parse
+from syntax import ExprVar, ExprAbs, ExprApp, ExprLet, ExprStmt, ExprReturn, ExprIf, ExprLetRec
+
+PIECES = ['let', 'rec', 'in', 'x', 'foo1', '变量', '12', '345', '"a b"', '"电灯熄灭"', '""',
+          '\\', '.', ',', ';', '(', ')', '=', ' ', '  ', '\n', '\t']
+
+
+class TestTokenizeStream(unittest.TestCase):
+    # 无论怎样分块，逐块分析的结果都和一次分析整个输入相同
+    def test_chunk_boundaries(self):
+        rng = random.Random(56)
+        for _ in range(200):
+            source = ''.join(rng.choice(PIECES) for _ in range(rng.randrange(1, 40)))
+            expected = tokenize(source)
+            store = tokenize_compact(source)
+            for chunk_size in [1, 2, 3, 7, 64]:
+                with self.subTest(source=source, chunk_size=chunk_size):
+                    self.assertEqual(list(tokenize_stream(io.StringIO(source), chunk_size)), expected)
+                    spans: deque[tuple[int, int]] = deque()
+                    self.assertEqual(list(tokenize_stream(io.BytesIO(source.encode()), chunk_size, spans)), expected)
+                    self.assertEqual(list(spans), list(store.spans()))
+
+    # 跨越很多块的 Token 只在它结束时分析一次，耗时与长度成线性关系
+    def test_long_tokens(self):
+        n = 200000
+        for source in ['print "' + 'a' * n + '" x', 'a' * n + ' 1']:
+            with self.subTest(source=source[:10]):
+                self.assertEqual(list(tokenize_stream(io.StringIO(source), 64)), tokenize(source))
+
+    # 不同的名字很多时，合并表的大小不超过上限
+    def test_intern_limit(self):
+        source = ' '.join(f'x{i}' for i in range(3 * STREAM_INTERN_LIMIT))
+        tokens = list(tokenize_stream(io.StringIO(source), 256))
+        self.assertEqual([token.data for token in tokens[:-1]], source.split())
+
+
+def v(x: str) -> ExprVar:
+    return ExprVar(x)
+
+
+class TestParse(unittest.TestCase):
+    def assert_parses(self, source: str, expected):
+        self.assertEqual(parse(tokenize(source)), expected, source)
+
+    # 函数应用是左结合的
+    def test_application(self):
+        self.assert_parses('f a b', ExprApp(ExprApp(v('f'), v('a')), v('b')))
+        self.assert_parses('(f a) b', ExprApp(ExprApp(v('f'), v('a')), v('b')))
+        self.assert_parses('f (a b)', ExprApp(v('f'), ExprApp(v('a'), v('b'))))
+        self.assert_parses('f (a; b) c', ExprApp(ExprApp(v('f'), ExprStmt([v('a'), v('b')])), v('c')))
+
+    # ; 的优先级低于函数应用，λ、let、return 和 if 的各部分都尽量向右延伸，包括其中的 ;
+    def test_semicolon(self):
+        self.assert_parses('a b; c d', ExprStmt([ExprApp(v('a'), v('b')), ExprApp(v('c'), v('d'))]))
+        self.assert_parses('a; b; c', ExprStmt([v('a'), v('b'), v('c')]))
+        self.assert_parses('\\x. a; b', ExprAbs('x', ExprStmt([v('a'), v('b')])))
+        self.assert_parses('f \\x. x y', ExprApp(v('f'), ExprAbs('x', ExprApp(v('x'), v('y')))))
+        self.assert_parses('let x = a; b in c; d', ExprLet('x', ExprStmt([v('a'), v('b')]), ExprStmt([v('c'), v('d')])))
+        self.assert_parses('return a; b', ExprReturn(ExprStmt([v('a'), v('b')])))
+        self.assert_parses('(return a); b', ExprStmt([ExprReturn(v('a')), v('b')]))
+        self.assert_parses('return nothing', ExprReturn(None))
+        self.assert_parses('if a then b; c else d; e',
+                           ExprIf(v('a'), ExprStmt([v('b'), v('c')]), ExprStmt([v('d'), v('e')])))
+        self.assert_parses('if a then b else c d', ExprIf(v('a'), v('b'), ExprApp(v('c'), v('d'))))
+        self.assert_parses('let rec f = a; b, g = c in d',
+                           ExprLetRec([('f', ExprStmt([v('a'), v('b')])), ('g', v('c'))], v('d')))
+
+    def test_errors(self):
+        for (source, message) in [
+            ('', '解析到末尾'),
+            ('f (', '解析到末尾'),
+            ('(a b', '期望 \\)'),
+            ('let = 1 in x', '期望标识符'),
+            ('\\. x', '期望标识符'),
+            ('let x = 1', '期望 in'),
+            ('if a then b', '期望 else'),
+            ('if a b else c', '期望 then'),
+        ]:
+            with self.subTest(source=source):
+                with self.assertRaisesRegex(Exception, message):
+                    parse(tokenize(source))
+
+    # 解析不使用 Python 的调用栈，嵌套的深度只受内存限制
+    def test_deep(self):
+        n = 100000
+        for source in ['(' * n + 'x' + ')' * n, 'f ' + ' '.join(['x'] * n), '\\x. ' * n + 'x',
+                       'let x = 1 in ' * n + 'x', 'f (' * n + 'x' + ')' * n, 'return ' * n + 'x']:
+            with self.subTest(source=source[:20]):
+                parse(tokenize(source))
+        spine = parse(tokenize('f ' + ' '.join(['x'] * n)))
+        depth = 0
+        while isinstance(spine, ExprApp):
+            spine = spine.e1
+            depth += 1
+        self.assertEqual(depth, n)
+
+    # 只有 tokenize_compact 记录位置，按字符计；tokenize 解析出的表达式位置都是 -1，类型错误没有 span，
+    # 错误信息的每一层显示整个表达式
+    def test_spans(self):
+        source = 'let s = "中文" in\nsquare s'
+        compact = parse(tokenize_compact(source))
+        self.assertEqual((compact.start, compact.end), (0, len(source)))
+        self.assertEqual((compact.e2.start, compact.e2.end), (16, 24))
+        plain = parse(tokenize(source))
+        self.assertEqual(plain, compact)
+        self.assertEqual((plain.start, plain.end, plain.e2.start, plain.e2.end), (-1, -1, -1, -1))
+
+        for (expr, span) in [(compact, (16, 24)), (plain, None)]:
+            with self.assertRaises(TyckException) as e:
+                pl9je.infer(expr)
+            e.exception.source = source
+            self.assertEqual(e.exception.span, span)
+            self.assertEqual('当检查表达式 square s 时发生' in e.exception.text, span is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
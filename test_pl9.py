@@ -0,0 +1,28 @@
+import unittest
+
+import pl9
+import pl9je
+from parse import tokenize, parse
+
+
+class TestEntryContext(unittest.TestCase):
+    # 没有进入任何上下文时，每次检查都从新的上下文开始，重复检查同一个程序得到完全相同的类型方案
+    def test_repeated_infer(self):
+        expr = parse(tokenize('let f = \\x. \\y. x in f 1'))
+        for infer in [pl9.infer, pl9je.infer]:
+            with self.subTest(infer=infer.__module__):
+                schemes = [str(infer(expr)) for _ in range(3)]
+                self.assertEqual(schemes, [schemes[0]] * 3)
+
+    # 在 with 中检查时沿用同一个上下文，类型变量继续编号
+    def test_explicit_context(self):
+        expr = parse(tokenize('\\x. x'))
+        with pl9.InferContext():
+            first = pl9.infer(expr)
+            second = pl9.infer(expr)
+        self.assertNotEqual(str(first), str(second))
+        self.assertEqual(str(pl9.infer(expr)), str(pl9.infer(expr)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import random
+import unittest
+
+from diagnostic import TyckException
+from ghaik import Greek
+from incremental import scheme_key
+from parse import tokenize, parse
+from test_constraints import gen_expr, outcome
+from pl9je import InferContext, Template, TypeOp, TypeScheme, TypeVar, compile_template, fn_type, product_type, type_op, unify, \
+    generalize, infer, IntType, BoolType
+
+
+class TestInferContext(unittest.TestCase):
+    # 不同上下文中的类型变量即使 id 相同也不相等，混用时报错，而不是改动无关的类型变量
+    def test_mixed_contexts(self):
+        with InferContext():
+            a0, a1 = TypeVar(Greek.Alpha), TypeVar(Greek.Alpha)
+        with InferContext():
+            b0 = TypeVar(Greek.Beta)
+        self.assertEqual(a0.id, b0.id)
+        self.assertNotEqual(a0, b0)
+        self.assertEqual(len({a0, b0}), 2)
+
+        for (t1, t2) in [(a1, b0), (a1, fn_type(b0, IntType)), (fn_type(a0, IntType), fn_type(b0, IntType))]:
+            with self.subTest(t1=t1, t2=t2):
+                with self.assertRaises(Exception):
+                    unify(t1, t2)
+        self.assertIs(a1.find(), a1)
+        self.assertIs(a0.find(), a0)
+        self.assertIs(b0.find(), b0)
+        with self.assertRaises(Exception):
+            fn_type(a0, b0)
+
+
+
+class TestTypeOp(unittest.TestCase):
+    # 结构相同的不含类型变量的类型算子是同一个对象，与在哪个上下文中构造无关
+    def test_hash_consing(self):
+        ty = fn_type(product_type(IntType, BoolType), IntType)
+        self.assertIs(TypeOp('->', [TypeOp('*', (TypeOp('int', ()), BoolType)), IntType]), ty)
+        with InferContext():
+            a = TypeVar(Greek.Alpha)
+            unify(a, product_type(IntType, BoolType))
+            self.assertIs(fn_type(a, IntType).prune(), ty)
+        self.assertIsNot(fn_type(IntType, BoolType), fn_type(BoolType, IntType))
+
+    # 构造类型算子不改变并查集；type_op 记录参数中的类型变量出现在了类型算子中，之后归一化时要做出现检查
+    def test_escaped(self):
+        with InferContext() as context:
+            store = context.store
+            a = TypeVar(Greek.Alpha)
+            TypeOp('->', (a, IntType))
+            self.assertFalse(store.escaped[a.id])
+            ty = fn_type(IntType, type_op('list', [a]))
+            self.assertTrue(store.escaped[a.id])
+            with self.assertRaises(TyckException):
+                unify(a, ty)
+
+
+class TestTypeVarStore(unittest.TestCase):
+    # 合并之后的等价类由原先代表第二个等价类的类型变量代表（与秩无关），层级取较小的一个
+    def test_union(self):
+        with InferContext() as context:
+            store = context.store
+            a, b = TypeVar(Greek.Alpha), TypeVar(Greek.Alpha)
+            store.enter_level()
+            c = TypeVar(Greek.Alpha)
+            store.union(a.id, b.id)
+            self.assertIs(a.find(), b)
+            self.assertEqual(store.rank[store.find(b.id)], 1)
+            store.union(b.id, c.id)
+            self.assertIs(a.find(), c)
+            self.assertIs(b.find(), c)
+            self.assertEqual(store.find(c.id), store.find(a.id))
+            self.assertEqual(store.level[store.find(c.id)], 0)
+
+    # 归一化成类型算子之后，find 返回这个类型算子，同一等价类中的其他类型变量也是如此
+    def test_bind(self):
+        with InferContext():
+            a, b = TypeVar(Greek.Alpha), TypeVar(Greek.Alpha)
+            unify(a, b)
+            unify(b, fn_type(IntType, BoolType))
+            self.assertIs(a.find(), fn_type(IntType, BoolType))
+            self.assertEqual(str(fn_type(a, b).prune()), '(int→bool)→(int→bool)')
+
+
+
+class TestGeneralize(unittest.TestCase):
+    # let 绑定中新建的类型变量与外层的类型变量归一化之后，层级被降低到外层，不能泛化
+    def test_lowered_level(self):
+        with InferContext() as context:
+            store = context.store
+            store.enter_level()
+            outer = TypeVar(Greek.Alpha)
+            store.enter_level()
+            inner, local = TypeVar(Greek.Beta), TypeVar(Greek.Beta)
+            unify(inner, outer)
+            store.leave_level()
+            scheme = generalize(fn_type(inner, local))
+            self.assertEqual(scheme.free, [local])
+
+    # 同样的情形出现在程序中：f 的参数类型与外层的 x 相同，f 不是多态的
+    def test_lowered_level_program(self):
+        expr = parse(tokenize('\\x. let f = \\y. if true then x else y in f'))
+        self.assertEqual(str(infer(expr)), '∀β1. β1→(β1→β1)')
+        with self.assertRaises(TyckException):
+            infer(parse(tokenize('\\x. let f = \\y. if true then x else y in (f 1; f true)')))
+        self.assertEqual(str(infer(parse(tokenize('let f = \\y. \\z. if true then y else z in (f 1 2; f true false)')))),
+                         'bool')
+
+
+
+# 推迟出现检查时报告的错误
+CYCLIC = '错误：类型变量 {} 的类型中存在对其自身的引用，这是不允许的'
+
+
+class TestOccursCheck(unittest.TestCase):
+    # 推迟出现检查只改变报告错误的时机和措辞，通过检查的程序和推导出的类型方案都相同。
+    # 随机的程序中有一些是因为类型中有环而出错的（推迟检查时在泛化时才发现）
+    def test_random_programs(self):
+        rng = random.Random(10)
+        counts = {'ok': 0, 'error': 0}
+        cyclic = 0
+        for _ in range(2000):
+            source = gen_expr(rng, 4, [])
+            expr = parse(tokenize(source))
+            expected = outcome(infer, expr, False)
+            self.assertEqual(outcome(infer, expr, True), expected, source)
+            counts[expected[0]] += 1
+            if expected[0] == 'error':
+                with InferContext(defer_occurs_check=True):
+                    try:
+                        infer(expr)
+                    except TyckException as e:
+                        cyclic += e.message == CYCLIC
+        self.assertGreater(counts['ok'], 100)
+        self.assertGreater(counts['error'], 100)
+        self.assertGreater(cyclic, 10)
+
+    def test_self_application(self):
+        for source in ['\\x. x x', 'let f = \\x. x x in 1', '\\f. let g = \\x. f (x x) in g']:
+            for defer in [False, True]:
+                with self.subTest(source=source, defer=defer):
+                    with InferContext(defer_occurs_check=defer):
+                        with self.assertRaises(TyckException):
+                            infer(parse(tokenize(source)))
+
+
+
+class TestTemplate(unittest.TestCase):
+    # 没有被泛化的类型变量时，实例化直接返回共享的类型
+    def test_ground(self):
+        ty = fn_type(IntType, BoolType)
+        scheme = TypeScheme([], ty)
+        self.assertIs(scheme.instantiate(), ty)
+        self.assertIsNone(scheme.template)
+        with InferContext():
+            a = TypeVar(Greek.Alpha)
+            ty = fn_type(a, a)
+            self.assertIs(TypeScheme([], ty).instantiate(), ty)
+
+    # 只复制含有被泛化的类型变量的类型算子；其余的子树和没有被泛化的类型变量共享，共享的子树在结果中仍然共享
+    def test_sharing(self):
+        with InferContext():
+            a, b = TypeVar(Greek.Alpha), TypeVar(Greek.Alpha)
+            ground = product_type(IntType, BoolType)
+            fixed = fn_type(b, ground)
+            shared = fn_type(a, ground)
+            ty = product_type(shared, shared, fixed)
+            template = compile_template(ty, [a])
+            self.assertEqual([op for (op, _) in template.ops], ['->', '*'])
+            self.assertEqual(template.ops[1][1], (1, 1, fixed))
+
+            scheme = TypeScheme([a], ty)
+            t1, t2 = scheme.instantiate(), scheme.instantiate()
+            self.assertIsNot(t1, t2)
+            self.assertIs(t1.args[0], t1.args[1])
+            self.assertIs(t1.args[0].args[1], ground)
+            self.assertIs(t1.args[2], fixed)
+            self.assertNotEqual(t1.args[0].args[0], a)
+            self.assertNotEqual(t1.args[0].args[0], t2.args[0].args[0])
+
+    # 类型本身是被泛化的类型变量；已经被归一化的类型变量直接共享归一化成的类型
+    def test_type_var(self):
+        with InferContext():
+            a, b = TypeVar(Greek.Alpha), TypeVar(Greek.Alpha)
+            self.assertEqual(compile_template(a, [a]), Template([], 0))
+            unify(b, fn_type(IntType, BoolType))
+            self.assertEqual(compile_template(fn_type(b, a), [a]), Template([('->', (fn_type(IntType, BoolType), 0))], 1))
+
+    # 实例化的结果与推导出的类型方案 α 等价
+    def test_instantiate(self):
+        for source in ['\\f. \\g. \\x. f (g x)', 'let rec f = \\x. \\y. (f y x; y) in f', 'let twice = \\f. \\x. f (f x) in twice twice']:
+            with self.subTest(source=source), InferContext() as context:
+                scheme = infer(parse(tokenize(source)))
+                context.store.enter_level()
+                ty = scheme.instantiate()
+                context.store.leave_level()
+                self.assertEqual(scheme_key(generalize(ty)), scheme_key(scheme))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import io
+import random
+import unittest
+
+import pl9je
+from ghaik import Greek
+from parse import tokenize, parse
+from printer import FLUSH_PARTS, dump, to_string
+from syntax import *
+from test_arena import gen_tree
+
+# 至少这么多节点的树，远大于 Python 的递归深度限制
+NODES = 100000
+
+
+# 改为显式的栈遍历之前的 __str__（递归实现），作为不换行时输出的参照。
+# 只有两处不同，都是当时的错误：let rec 的绑定加括号时多一个 ')'，以及 -> 和 * 以外的类型算子与第一个参数之间没有空格
+def old_str_expr(e: Expr) -> str:
+    def quoted(e: Expr) -> str:
+        return f'({old_str_expr(e)})' if e.need_quote() else old_str_expr(e)
+
+    if isinstance(e, ExprLitInt) or isinstance(e, ExprLitBool):
+        return str(e.value)
+    elif isinstance(e, ExprLitStr):
+        return f'"{e.value}"'
+    elif isinstance(e, ExprVar):
+        return e.x
+    elif isinstance(e, ExprAbs):
+        return f'λ{e.x}. {quoted(e.body)}'
+    elif isinstance(e, ExprApp):
+        return f'{quoted(e.e1)} {quoted(e.e2)}'
+    elif isinstance(e, ExprLet):
+        e2 = f'({old_str_expr(e.e2)})' if isinstance(e.e2, ExprLet) else old_str_expr(e.e2)
+        return f'let {e.x} = {quoted(e.e1)} in {e2}'
+    elif isinstance(e, ExprStmt):
+        return '; '.join(old_str_expr(stmt) for stmt in e.stmts)
+    elif isinstance(e, ExprReturn):
+        return f'return {old_str_expr(e.e)}' if e.e is not None else 'return'
+    elif isinstance(e, ExprIf):
+        return f'if {quoted(e.e1)} then {quoted(e.e2)} else {quoted(e.e3)}'
+    else:
+        assert isinstance(e, ExprLetRec)
+        decls = '; '.join(f'{name} = {quoted(decl)}' for (name, decl) in e.decls)
+        return f'let rec {decls} in {quoted(e.body)}'
+
+
+def old_str_type(t: pl9je.Type) -> str:
+    if not isinstance(t, pl9je.TypeOp):
+        return str(t)
+    if t.op == 'unit':
+        return '()'
+    if len(t.args) == 0:
+        return t.op
+    args = [f'({old_str_type(arg)})' if arg.need_quote() else old_str_type(arg) for arg in t.args]
+    if t.op == '*':
+        return ' × '.join(args)
+    elif t.op == '->':
+        return '→'.join(args)
+    return t.op + ' ' + ' '.join(args)
+
+
+def gen_type(rng: random.Random, depth: int, tvars: list[pl9je.TypeVar]) -> pl9je.Type:
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice([*tvars, pl9je.IntType, pl9je.BoolType, pl9je.UnitType])
+    choice = rng.randrange(3)
+    if choice == 0:
+        return pl9je.fn_type(gen_type(rng, depth - 1, tvars), gen_type(rng, depth - 1, tvars))
+    elif choice == 1:
+        return pl9je.product_type(*(gen_type(rng, depth - 1, tvars) for _ in range(rng.randrange(2, 4))))
+    return pl9je.TypeOp('list', [gen_type(rng, depth - 1, tvars)])
+
+
+# 记录每次 write 的文件对象
+class RecordingIO(io.StringIO):
+    writes: int = 0
+
+    def write(self, s: str) -> int:
+        self.writes += 1
+        return super().write(s)
+
+
+class TestUnlimitedWidth(unittest.TestCase):
+    def test_random_exprs(self):
+        rng = random.Random(24)
+        for _ in range(2000):
+            expr = gen_tree(rng, 5, [])
+            self.assertEqual(str(expr), old_str_expr(expr))
+
+    def test_parsed(self):
+        source = 'let rec f = \\x. if x then g 1 else 2, g = \\y. f true in (f false; return "s"; return f)'
+        expr = parse(tokenize(source))
+        self.assertEqual(str(expr), old_str_expr(expr))
+        self.assertEqual(to_string(expr, None), str(expr))
+
+    def test_random_types(self):
+        rng = random.Random(24)
+        with pl9je.InferContext():
+            tvars = [pl9je.TypeVar(Greek.Alpha) for _ in range(3)]
+            for _ in range(2000):
+                ty = gen_type(rng, 5, tvars)
+                self.assertEqual(str(ty), old_str_type(ty))
+
+    def test_scheme(self):
+        expr = parse(tokenize('\\f. \\x. f (f x)'))
+        with pl9je.InferContext():
+            self.assertEqual(str(pl9je.infer(expr)), '∀β1. (β1→β1)→(β1→β1)')
+
+
+class TestWidth(unittest.TestCase):
+    SOURCE = 'let compose = \\f. \\g. \\x. f (g x) in let twice = \\f. compose f f in twice (twice square) 1000000'
+
+    def test_fits(self):
+        expr = parse(tokenize(self.SOURCE))
+        flat = str(expr)
+        self.assertEqual(to_string(expr, len(flat)), flat)
+        self.assertNotEqual(to_string(expr, len(flat) - 1), flat)
+
+    # 放不下的组在每个 line 处换行，缩进到外层的缩进加上这一组的 indent；放得下的内层组不换行
+    def test_break(self):
+        expr = parse(tokenize(self.SOURCE))
+        self.assertEqual(to_string(expr, 40), '\n'.join([
+            'let compose = (λf. (λg. (λx. (f (g x))))) in',
+            '(let twice = (λf. ((compose f) f)) in',
+            '(twice (twice square)) 1000000)',
+        ]))
+        self.assertEqual(to_string(expr, 20), '\n'.join([
+            'let compose = (λf. (λg. (λx.',
+            '  (f (g x))))) in',
+            '(let twice = (λf.',
+            '  ((compose f) f)) in',
+            '(twice',
+            '  (twice square))',
+            '  1000000)',
+        ]))
+
+    # 换行只是把 line 换成换行和缩进（表达式中的 line 都是空格）：去掉缩进之后按空格拼接各行得到不换行时的输出。
+    # 放得下时不换行
+    def test_random_exprs(self):
+        rng = random.Random(24)
+        for _ in range(500):
+            expr = gen_tree(rng, 5, [])
+            flat = str(expr)
+            for width in [10, 30, 60]:
+                lines = to_string(expr, width).split('\n')
+                self.assertEqual(' '.join(line.lstrip(' ') for line in lines), flat)
+                if len(flat) <= width:
+                    self.assertEqual(len(lines), 1)
+
+    def test_type(self):
+        a = pl9je.product_type(pl9je.IntType, pl9je.BoolType, pl9je.UnitType)
+        ty = pl9je.fn_type(a, pl9je.fn_type(pl9je.fn_type(pl9je.IntType, pl9je.IntType), a))
+        self.assertEqual(to_string(ty, None), '(int × bool × ())→((int→int)→(int × bool × ()))')
+        self.assertEqual(to_string(ty, 30), '\n'.join([
+            '(int × bool × ())→',
+            '  ((int→int)→(int × bool × ()))',
+        ]))
+        self.assertEqual(to_string(ty, 12), '\n'.join([
+            '(int ×',
+            '    bool ×',
+            '    ())→',
+            '  ((int→int)→',
+            '    (int ×',
+            '      bool ×',
+            '      ()))',
+        ]))
+
+
+class TestDump(unittest.TestCase):
+    # 写入文件的内容与 to_string 相同；输出很长时在打印的过程中分多次写入
+    def test_file(self):
+        expr = parse(tokenize('; '.join(f'square (x{i} y{i})' for i in range(FLUSH_PARTS))))
+        for width in [None, 40]:
+            out = RecordingIO()
+            dump(expr, out, width)
+            self.assertEqual(out.getvalue(), to_string(expr, width))
+            self.assertGreater(out.writes, 1)
+
+    def test_small(self):
+        out = io.StringIO()
+        dump(parse(tokenize('\\x. x')), out)
+        self.assertEqual(out.getvalue(), 'λx. x')
+
+
+# 嵌套很深的树，递归实现的 __str__ 会超出递归深度限制。
+# 按宽度排版时每层嵌套的组都增加缩进，所以排版的测试用缩进不增加的 let 链，否则输出的长度是深度的平方
+class TestDeep(unittest.TestCase):
+    def test_expr(self):
+        expr: Expr = ExprLitInt(1)
+        for _ in range(NODES):
+            expr = ExprApp(ExprVar('f'), expr)
+        self.assertEqual(str(expr), 'f (' * (NODES - 1) + 'f 1' + ')' * (NODES - 1))
+
+    def test_let(self):
+        expr: Expr = ExprVar('x')
+        for _ in range(NODES):
+            expr = ExprLet('x', ExprAbs('y', ExprVar('y')), expr)
+        flat = str(expr)
+        self.assertEqual(flat, 'let x = (λy. y) in (' * (NODES - 1) + 'let x = (λy. y) in x' + ')' * (NODES - 1))
+        out = io.StringIO()
+        dump(expr, out, 80)
+        lines = out.getvalue().split('\n')
+        self.assertGreater(len(lines), NODES - 10)
+        self.assertEqual(' '.join(lines), flat)
+
+    def test_type(self):
+        ty: pl9je.Type = pl9je.IntType
+        for _ in range(NODES):
+            ty = pl9je.fn_type(ty, pl9je.BoolType)
+        out = io.StringIO()
+        dump(ty, out)
+        self.assertEqual(out.getvalue(), '(' * (NODES - 1) + 'int' + '→bool)' * (NODES - 1) + '→bool')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import random
+import unittest
+
+from parse import tokenize, parse
+from pl9je import let_rec_groups
+from scc import strongly_connected_components
+
+
+# 每个顶点能到达的顶点（包括自身）
+def reachable(successors: list[list[int]]) -> list[set[int]]:
+    ret = []
+    for v in range(len(successors)):
+        seen = {v}
+        stack = [v]
+        while len(stack) > 0:
+            u = stack.pop()
+            for w in successors[u]:
+                if w not in seen:
+                    seen.add(w)
+                    stack.append(w)
+        ret.append(seen)
+    return ret
+
+
+class TestStronglyConnectedComponents(unittest.TestCase):
+    # 分量恰好是互相可达的顶点，并且每个分量排在它能到达的所有分量之后
+    def check(self, successors: list[list[int]]):
+        components = strongly_connected_components(successors)
+        n = len(successors)
+        self.assertEqual(sorted(v for component in components for v in component), list(range(n)))
+
+        reach = reachable(successors)
+        position = {}
+        for (i, component) in enumerate(components):
+            self.assertEqual(component, sorted(component))
+            for v in component:
+                position[v] = i
+        for v in range(n):
+            for w in range(n):
+                mutual = w in reach[v] and v in reach[w]
+                self.assertEqual(position[v] == position[w], mutual, (v, w))
+                if w in reach[v]:
+                    self.assertLessEqual(position[w], position[v], (v, w))
+        return components
+
+    def test_empty(self):
+        self.assertEqual(strongly_connected_components([]), [])
+
+    def test_chain(self):
+        # 0 → 1 → 2：被依赖的排在前面
+        self.assertEqual(self.check([[1], [2], []]), [[2], [1], [0]])
+
+    def test_cycle(self):
+        self.assertEqual(self.check([[1], [2], [0]]), [[0, 1, 2]])
+
+    def test_self_loop(self):
+        self.assertEqual(self.check([[0], [0, 1]]), [[0], [1]])
+
+    def test_cycles_in_order(self):
+        # {0, 1} → {2, 3} → {4}，另有孤立的 5
+        components = self.check([[1, 2], [0], [3], [2, 4], [], []])
+        self.assertEqual(components, [[4], [2, 3], [0, 1], [5]])
+
+    # 很长的依赖链不会递归过深
+    def test_long_chain(self):
+        n = 100000
+        successors = [[v + 1] for v in range(n - 1)] + [[0]]
+        self.assertEqual(strongly_connected_components(successors), [list(range(n))])
+        successors[-1] = []
+        components = strongly_connected_components(successors)
+        self.assertEqual(components, [[v] for v in reversed(range(n))])
+
+    def test_random(self):
+        rng = random.Random(17)
+        for _ in range(200):
+            n = rng.randrange(1, 12)
+            successors = [sorted(rng.sample(range(n), rng.randrange(0, 3) if n > 2 else 0)) for _ in range(n)]
+            self.check(successors)
+
+
+class TestLetRecGroups(unittest.TestCase):
+    def groups(self, source: str) -> list[list[str]]:
+        expr = parse(tokenize(source))
+        return [[expr.decls[idx][0] for idx in group] for group in let_rec_groups(expr.decls)]
+
+    def test_dependency_order(self):
+        self.assertEqual(self.groups('let rec f = \\x. g x, g = \\x. h x, h = \\x. x in f'),
+                         [['h'], ['g'], ['f']])
+
+    def test_mutual_recursion(self):
+        self.assertEqual(self.groups('let rec even = \\n. odd n, odd = \\n. even n, id = \\x. x in even'),
+                         [['even', 'odd'], ['id']])
+
+    # 引用外层变量的名字不算依赖
+    def test_free_outer(self):
+        self.assertEqual(self.groups('let rec f = \\x. square x, g = \\y. f y in g'), [['f'], ['g']])
+
+
+if __name__ == '__main__':
+    unittest.main()
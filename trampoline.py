@@ -0,0 +1,55 @@
+from types import GeneratorType
+from typing import Any, Callable, Generator
+
+
+# 用显式的栈代替递归
+#
+# 递归的推导函数写成生成器：需要推导子表达式时，产生（yield）子问题的参数，
+# 由 trampoline 调用 step 处理子问题，子问题的结果再通过 send 交还给上一层。
+# step 可以直接返回结果（例如字面量和变量，不需要为它们创建生成器），也可以返回一个生成器，这时把它压栈。
+# 子问题中的异常通过 throw 交给上一层的生成器，因此其中的 try/except（补充错误信息）
+# 和 try/finally（恢复状态）都和递归写法一样生效。
+# Python 调用栈的深度与输入的嵌套深度无关
+def trampoline(step: Callable[..., Any | Generator[Any, Any, Any]], *args: Any) -> Any:
+    return drive(step, step(*args))
+
+
+# 从 root 开始运行：root 可以是 step 直接返回的结果，也可以是一个生成器，其中的子问题同样交给 step 处理
+def drive(step: Callable[..., Any | Generator[Any, Any, Any]], root: Any | Generator[Any, Any, Any]) -> Any:
+    if type(root) is not GeneratorType:
+        return root
+    stack: list[Generator[Any, Any, Any]] = [root]
+    push = stack.append
+    pop = stack.pop
+    value: Any = None
+    error: BaseException | None = None
+    sub_args: tuple[Any, ...] | None = None
+    while True:
+        if sub_args is not None:
+            try:
+                value = step(*sub_args)
+                if type(value) is GeneratorType:
+                    push(value)
+                    value = None
+            except BaseException as e:
+                error = e
+            sub_args = None
+
+        if len(stack) == 0:
+            break
+        try:
+            if error is None:
+                sub_args = stack[-1].send(value)
+            else:
+                e, error = error, None
+                sub_args = stack[-1].throw(e)
+        except StopIteration as stop:
+            pop()
+            value = stop.value
+        except BaseException as e:
+            pop()
+            error = e
+
+    if error is not None:
+        raise error
+    return value